@@ -12,6 +12,8 @@ from sklearn.base import BaseEstimator, TransformerMixin
 
 from modules.models.utils import custom_print, save_fibers, np_placeholder
 from modules.models.example_loader import PointExamples, aff_to_rot
+from modules.models.fibers import FiberState, split_fibers
+from modules.models.seeding import find_borders, sample_seeds
 
 from tensorflow.python.estimator.export.export import (
     build_raw_serving_input_receiver_fn as input_receiver_fn)
@@ -246,6 +248,8 @@ class BaseTracker(BaseTF):
 
         # Get brain information
         self.brain_data = X['dwi']
+        # Padded once, blocks of all fibers are gathered from it in every round
+        self.padded_brain_data = PointExamples.pad_data(self.brain_data, self.block_size)
 
         # If no seeds are specified, build them from the wm mask
         if 'seeds' not in self.args:
@@ -254,7 +258,7 @@ class BaseTracker(BaseTF):
         # The final result will be here
         self.tractography = []
         # Fibers that are still under construction. At first seeds.
-        self.ongoing_fibers = seeds
+        self.fiber_state = self._new_fiber_state(seeds)
 
         if predictor is not None:
             # Start tractography generation
@@ -285,82 +289,81 @@ class BaseTracker(BaseTF):
                 the process.
         """
 
+        state = self.fiber_state
         i = 0
-        while self.ongoing_fibers:
+        while state.n_active() > 0:
             i += 1
-            predictions = predictor(self._build_next_X(affine))["predictions"]
+            indices = state.get_active_indices()
+            predictions = predictor(self._build_next_X(affine, indices))["predictions"]
             directions = self.get_directions_from_predictions(predictions, affine)
 
             # Update the positions of the fibers and check if they are still ongoing
-            cur_ongoing = []
-            for j, fiber in enumerate(self.ongoing_fibers):
-                new_position = fiber[-1] + directions[j] * self.args.step_size
-
-                if i == 1 and self._is_border(new_position):
-                    # First step is ambiguous and leads into boarder -> flip it.
-                    new_position = fiber[-1] - directions[j] * self.args.step_size
-
-                # Only continue fibers inside the boundaries and short enough
-                if self._is_border(new_position) or \
-                        i * self.args.step_size > self.max_fiber_length:
-                    self.tractography.append(fiber)
-                else:
-                    fiber.append(new_position)
-                    cur_ongoing.append(fiber)
-            self.ongoing_fibers = cur_ongoing
+            last_positions = state.positions[indices, state.lengths[indices] - 1]
+            new_positions = last_positions + directions * self.args.step_size
+
+            if i == 1:
+                # First step is ambiguous and leads into boarder -> flip it.
+                flip = self._is_border_batch(new_positions)
+                new_positions[flip] = last_positions[flip] - directions[flip] * self.args.step_size
+
+            # Only continue fibers inside the boundaries and short enough
+            if i * self.args.step_size > self.max_fiber_length:
+                completed = np.ones(len(indices), dtype=bool)
+            else:
+                completed = self._is_border_batch(new_positions)
+            state.complete(indices[completed])
+            state.append(indices[~completed], new_positions[~completed])
 
             end = "\r"
             if i % 25 == 0:
                 end = "\n"
-            custom_print("Round num:", '%4d' % i, "; ongoing:", '%7d' % len(self.ongoing_fibers),
-                  "; completed:", '%7d' % len(self.tractography), end=end)
+            custom_print("Round num:", '%4d' % i, "; ongoing:", '%7d' % state.n_active(),
+                  "; completed:", '%7d' % (len(self.tractography) + state.n_completed()), end=end)
+
+        points, lengths = state.get_completed()
+        self.tractography += split_fibers(points, lengths)
 
         if reseed_endpoints:
-            ending_seeds = [[fiber[-1]] for fiber in self.tractography]
-            self.ongoing_fibers = ending_seeds
-            self._generate_masked_tractography(reseed_endpoints=False, affine=affine)
+            ending_seeds = np.array([fiber[-1] for fiber in self.tractography])
+            self.fiber_state = self._new_fiber_state(ending_seeds)
+            self._generate_masked_tractography(reseed_endpoints=False, affine=affine,
+                                               predictor=predictor)
+
+    def _new_fiber_state(self, seeds):
+        """Creates the state for fibers starting at the given seeds.
+
+        Args:
+            seeds: Array of shape (N, 3).
+        """
+        # Seed and one point per step until the maximal fiber length is exceeded
+        max_len = int(self.max_fiber_length / self.args.step_size) + 2
+        return FiberState(seeds, max_len)
 
-    def _build_next_X(self, affine):
+    def _build_next_X(self, affine, indices=None):
         """Builds the next X-batch to be fed to the model.
 
         The X-batch created continues the streamline based on the outgoing directions obtained at
         the previous step.
 
+        Args:
+            indices: Indices of the fibers in the batch, all ongoing fibers if None.
+
         Returns:
             next_X: The next batch of point values (blocks, incoming, centers).
         """
-        label_type = "point"
+        if indices is None:
+            indices = self.fiber_state.get_active_indices()
+        # Centers followed by the previous n_incoming points, zero if not existent
+        points = self.fiber_state.get_last_points(indices, self.n_incoming + 1)
+
         X = {
-            'centers': [],
-            'incoming': [],
-            'blocks': []
+            'centers': points[:, 0],
+            'incoming': PointExamples.build_incoming(points, affine),
+            'blocks': PointExamples.build_datablocks(self.padded_brain_data,
+                                                     self.block_size,
+                                                     points[:, 0])
         }
 
-        for fiber in self.ongoing_fibers:
-            center_point = fiber[-1]
-            incoming_point = np.zeros((self.n_incoming, 3))
-            outgoing = np.zeros(3)
-            for i in range(min(self.n_incoming, len(fiber)-1)):
-                incoming_point[i] = fiber[-i - 2]
-            sample = PointExamples.build_datablock(self.brain_data,
-                                                   self.block_size,
-                                                   center_point,
-                                                   incoming_point,
-                                                   outgoing,
-                                                   label_type,
-                                                   affine)
-            X_sample = {
-                'centers': sample['center'],
-                'incoming': sample['incoming'],
-                'blocks': sample['data_block']
-            }
-            # Add example to examples by appending individual lists
-            for key, cur_list in X.items():
-                cur_list.append(X_sample[key])
-
-        for key, _ in X.items():
-            X[key] = np.array(X[key])
-
         return X
 
     @abstractmethod
@@ -385,19 +388,19 @@ class BaseTracker(BaseTF):
         The seeds are selected on the interface between white and gray matter, i.e. they are the
         white matter voxels that have at least one gray matter neighboring voxel.
         These points are furthermore perturbed with some gaussian noise to have a wider range of
-        starting points.
+        starting points. The seeds are deterministic if args.seeding_random_seed is set.
 
         Returns:
-            seeds: The list of voxel that are seeds.
+            seeds: Array of shape (n_fibers, 3) containing the seeds.
         """
         # Take te border voxels as seeds
         seeds = self._find_borders()
         custom_print("Number of seeds on the white matter mask:", len(seeds))
         custom_print("Number of requested seeds:", self.args.n_fibers)
-        new_idxs = np.random.choice(len(seeds), self.args.n_fibers, replace=True)
-        new_seeds = [[seeds[i] + np.clip(np.random.normal(0, 0.25, 3), -0.5, 0.5)]
-                     for i in new_idxs]
-        return new_seeds
+        random_state = None
+        if 'seeding_random_seed' in self.args:
+            random_state = np.random.RandomState(self.args.seeding_random_seed)
+        return sample_seeds(seeds, self.args.n_fibers, random_state)
 
     def _find_borders(self, order=1):
         """Find the wm-gm interface points.
@@ -405,20 +408,12 @@ class BaseTracker(BaseTF):
         Args:
             order: How far from the center voxel to look for differen voxels. Default 1.
         Return:
-            seeds: The seeds generated from the white matter mask
+            seeds: Array of shape (n_borders, 3), the seeds generated from the white matter mask
         """
-        dim = self.wm_mask.shape
-        borders = []
-        for x in range(order, dim[0] - order):
-            for y in range(order, dim[1] - order):
-                for z in range(order, dim[2] - order):
-                    if self.wm_mask[x, y, z] == 1:
-                        window = self.wm_mask[x - order:x + 1 + order,
-                                              y - order:y + 1 + order,
-                                              z - order:z + 1 + order]
-                        if not np.all(window):
-                            borders.append(np.array([x, y, z]))
-        return borders
+        cache_dir = None
+        if 'seed_cache_dir' in self.args:
+            cache_dir = self.args.seed_cache_dir
+        return find_borders(self.wm_mask, order, cache_dir)
 
     def _is_border(self, coord):
         """Check if the voxel is on the white matter border.
@@ -429,18 +424,28 @@ class BaseTracker(BaseTF):
         Returns:
             True if the [x, y, z] point is on the border.
         """
-        coord = np.round(coord).astype(int)
+        return self._is_border_batch(np.asarray(coord)[np.newaxis])[0]
 
-        lowerbound_condition = coord[0] < 0 or coord[1] < 0 or coord[2] < 0
-        upperbound_condition = coord[0] >= self.wm_mask.shape[0] or \
-                               coord[1] >= self.wm_mask.shape[1] or \
-                               coord[2] >= self.wm_mask.shape[2]
+    def _is_border_batch(self, coords):
+        """Vectorized _is_border.
+
+        Args:
+            coords: Numpy ndarray of shape (N, 3) containing the coordinates of the points.
+
+        Returns:
+            Boolean ndarray of shape (N,), True for the points on the border.
+        """
+        coords = np.round(coords).astype(int)
 
         # Check if out of image dimensions
-        if lowerbound_condition or upperbound_condition:
-            return True
+        outside = np.any((coords < 0) | (coords >= np.array(self.wm_mask.shape[:3])), axis=1)
+        border = np.ones(len(coords), dtype=bool)
+
         # Check if out of white matter area
-        return np.isclose(self.wm_mask[coord[0], coord[1], coord[2]], 0.0)
+        inside = coords[~outside]
+        border[~outside] = np.isclose(
+            np.asarray(self.wm_mask)[inside[:, 0], inside[:, 1], inside[:, 2]], 0.0)
+        return border
 
 
 class DeterministicTracker(BaseTracker):
@@ -473,11 +478,12 @@ class ProbabilisticTracker(BaseTracker):
         # PREDICTIONS
         mu = predictions['mean']
         k = predictions['concentration']
-        directions = ProbabilisticTracker.sample_vMF(mu, k)
+        directions = ProbabilisticTracker.sample_vMF(
+            mu, k, materialize_rotations=False)
         return directions
 
     @staticmethod
-    def sample_vMF(mu, k):
+    def sample_vMF(mu, k, materialize_rotations=True):
         """Sampe from the von Mises-Fisher distribution.
 
         See "Numerically stable sampling of the von Mises Fisher distribution
@@ -488,6 +494,8 @@ class ProbabilisticTracker(BaseTracker):
         Args:
             mu: Mean of the distribution. Shape (N, 3).
             k: Concentration of the distribution. Shape (N, 3).
+            materialize_rotations: If False, the rotations are applied with
+                Rodrigues' formula without building the (N, 3, 3) matrices.
         Returns:
             samples: Samples from the specified vMF distribution. Ndarray of
                 shape (N, 3), where N is the number of different distributions.
@@ -505,15 +513,17 @@ class ProbabilisticTracker(BaseTracker):
         # Get the values for V and W
         V = ProbabilisticTracker.sample_unif_unit_circle(n_samples)
         W = ProbabilisticTracker._sample_W_values(n_samples, k)
+        W = np.reshape(W, (n_samples, 1))
         # Compute the first part of the sampled vector with mean (0, 0, 1)
-        factor = np.matrix(np.sqrt(1 - np.square(W))).T
-        omega_1 = np.multiply(factor, V)
+        omega_1 = np.sqrt(1 - np.square(W)) * V
         # The second part is W itself
-        W = np.matrix(W).T
-        omega = np.asarray(np.hstack((omega_1, W)))
+        omega = np.hstack((omega_1, W))
         # Now apply the rotation to change the mean
         # i.e. rotate from the direction of the z-axis to the mean direction
-        reference = np.asarray([[0, 0, 1]] * omega.shape[0])
+        reference = np.zeros((n_samples, 3))
+        reference[:, 2] = 1
+        if not materialize_rotations:
+            return ProbabilisticTracker._rotate(reference, mu, omega)
         rotation = ProbabilisticTracker._rotation_matrices(reference, mu)
         samples = np.matmul(rotation, omega[:, :, np.newaxis])[:, :, 0]
         return samples
@@ -522,6 +532,11 @@ class ProbabilisticTracker(BaseTracker):
     def _rotation_matrices(vectors, references):
         """Compute all the rotation matrices from the vectors to the references.
 
+        Uses Rodrigues' formula R = I + K + K^2 / (1 + c), where K is the
+        cross-product matrix of vector x reference and c = <vector, reference>.
+        For antiparallel vectors, R is the rotation by pi around an axis
+        orthogonal to the vector.
+
         Args:
             vectors: Array of vectors that have to be rotated to match the
                 references.
@@ -530,41 +545,86 @@ class ProbabilisticTracker(BaseTracker):
             rotations: Array of matrices. Each matrix is the rotation form the
                 vector of corresponding index to its reference.
         """
-        # TODO: Fix the inefficiency of the for loop to compute the rotation
-        # matrices
-        rotations_list = []
-        for idx in range(vectors.shape[0]):
-            rot_mat = ProbabilisticTracker._to_rotation(vectors[idx, :],
-                                                        references[idx, :])
-            rotations_list.append(rot_mat)
-        rotations = np.asarray(rotations_list)
-        return np.asarray(rotations)
+        vectors = np.asarray(vectors, dtype=np.float64)
+        references = np.asarray(references, dtype=np.float64)
+        n = vectors.shape[0]
+
+        cross_mat = ProbabilisticTracker._cross_skew_symmetric(
+            np.cross(vectors, references))
+        c = np.sum(vectors * references, axis=1)
+        antiparallel = ProbabilisticTracker._antiparallel(c)
+
+        rotations = np.tile(np.eye(3), (n, 1, 1))
+        ok = ~antiparallel
+        rotations[ok] += cross_mat[ok] + \
+            np.matmul(cross_mat[ok], cross_mat[ok]) / (1 + c[ok])[:, np.newaxis, np.newaxis]
+
+        if np.any(antiparallel):
+            axes = ProbabilisticTracker._orthogonal_axes(vectors[antiparallel])
+            rotations[antiparallel] = 2 * axes[:, :, np.newaxis] * axes[:, np.newaxis, :] \
+                - np.eye(3)
+        return rotations
 
     @staticmethod
-    def _to_corss_skew_symmetric(vec, ref):
-        """Finds the skew-symmetric cross-product matrix."""
-        v = np.cross(vec, ref)
-
-        cross_mat = np.zeros(shape=(3, 3))
-        cross_mat[[0, 0, 1, 1, 2, 2], [1, 2, 0, 2, 0, 1]] = [-v[2],
-                                                             v[1],
-                                                             v[2],
-                                                             -v[0],
-                                                             -v[1],
-                                                             v[0]]
-        return cross_mat
+    def _rotate(vectors, references, points):
+        """Applies the rotations of _rotation_matrices to points, without
+        building the matrices.
+
+        Args:
+            vectors: Array of shape (N, 3) of vectors rotated to the references.
+            references: Array of shape (N, 3) of reference vectors.
+            points: Array of shape (N, 3), points[j] is rotated with the
+                rotation from vectors[j] to references[j].
+        Returns:
+            rotated: Array of shape (N, 3).
+        """
+        vectors = np.asarray(vectors, dtype=np.float64)
+        references = np.asarray(references, dtype=np.float64)
+        points = np.asarray(points, dtype=np.float64)
+
+        cross = np.cross(vectors, references)
+        c = np.sum(vectors * references, axis=1)
+        antiparallel = ProbabilisticTracker._antiparallel(c)
+
+        rotated = np.empty_like(points)
+        ok = ~antiparallel
+        # K p = cross x p
+        k_p = np.cross(cross[ok], points[ok])
+        rotated[ok] = points[ok] + k_p + \
+            np.cross(cross[ok], k_p) / (1 + c[ok])[:, np.newaxis]
+
+        if np.any(antiparallel):
+            axes = ProbabilisticTracker._orthogonal_axes(vectors[antiparallel])
+            p = points[antiparallel]
+            rotated[antiparallel] = \
+                2 * axes * np.sum(axes * p, axis=1)[:, np.newaxis] - p
+        return rotated
 
     @staticmethod
-    def _to_rotation(vec, ref):
-        """Compute rotation matrix from vec to ref.
+    def _antiparallel(c, eps=1e-12):
+        """True where the cosines c are -1, up to eps."""
+        return 1 + c <= eps
 
-        NOTE: There must be a better way to do this.
-        """
-        cross = ProbabilisticTracker._to_corss_skew_symmetric(vec, ref)
-        c = np.reshape(np.asarray(np.dot(vec, ref)), newshape=-1)
-        square = np.dot(cross, cross)
-        R = np.eye(3) + cross + square * (1 / (1 + c))
-        return R
+    @staticmethod
+    def _orthogonal_axes(vectors):
+        """Unit vectors orthogonal to the given vectors."""
+        # cross product with the coordinate axis least aligned with the vector
+        axis = np.zeros_like(vectors)
+        axis[np.arange(len(vectors)), np.argmin(np.abs(vectors), axis=1)] = 1
+        orthogonal = np.cross(vectors, axis)
+        return orthogonal / np.linalg.norm(orthogonal, axis=1)[:, np.newaxis]
+
+    @staticmethod
+    def _cross_skew_symmetric(v):
+        """Finds the skew-symmetric cross-product matrices of v of shape (N, 3)."""
+        cross_mat = np.zeros(shape=(v.shape[0], 3, 3))
+        cross_mat[:, 0, 1] = -v[:, 2]
+        cross_mat[:, 0, 2] = v[:, 1]
+        cross_mat[:, 1, 0] = v[:, 2]
+        cross_mat[:, 1, 2] = -v[:, 0]
+        cross_mat[:, 2, 0] = -v[:, 1]
+        cross_mat[:, 2, 1] = v[:, 0]
+        return cross_mat
 
     @staticmethod
     def sample_unif_unit_circle(n_samples):
@@ -576,9 +636,7 @@ class ProbabilisticTracker(BaseTracker):
             samples: (n_samples,2) ndarray.
         """
         unnormed = np.random.randn(n_samples, 2)
-        samples = np.divide(unnormed,
-                            np.matrix(np.linalg.norm(unnormed, axis=1)).T)
-        samples = np.asarray(samples)
+        samples = unnormed / np.linalg.norm(unnormed, axis=1)[:, np.newaxis]
         return samples
 
     @staticmethod
@@ -9,6 +9,7 @@ from __future__ import print_function
 
 import os
 import sys
+import builtins
 
 import numpy as np
 import nibabel as nib
@@ -36,6 +37,151 @@ def aff_to_rot(aff):
     return rotation
 
 
+class PointLabels(object):
+    """Columnar store of fiber point labels.
+
+    Holds the labels of all fiber points in three contiguous arrays instead of one
+    dictionary per point.
+
+    Attributes:
+        center: Numpy array of shape (n, 3) with the points the fibers go through.
+        incoming: Numpy array of shape (n, last_incoming, 3) with the previous points of
+          the fibers, the closest first. Zero where the fiber has no previous point.
+        outgoing: Numpy array of shape (n, 3) with the next points of the fibers. Zero
+          where the fiber has no next point.
+    """
+
+    def __init__(self, center, incoming, outgoing):
+        self.center = center
+        self.incoming = incoming
+        self.outgoing = outgoing
+
+    @staticmethod
+    def empty(last_incoming=1):
+        return PointLabels(np.zeros((0, 3)),
+                           np.zeros((0, last_incoming, 3)),
+                           np.zeros((0, 3)))
+
+    @staticmethod
+    def from_fibers(fibers, last_incoming=1, ignore_start_point=False,
+                    ignore_stop_point=True, augment_reverse_fibers=True):
+        """Computes the labels of all points of the fibers at once.
+
+        The labels are ordered by fiber and point. If augment_reverse_fibers is True, the
+        label of every point is followed by the label of the same point on the reversed
+        fiber.
+
+        Args:
+            fibers: List of arrays of shape (fiber_length, 3).
+            last_incoming: Number of previous points in the incoming labels.
+            ignore_start_point: If True, the first point of every fiber gets no label.
+            ignore_stop_point: If True, the last point of every fiber gets no label.
+            augment_reverse_fibers: Whether to add the labels of the reversed fibers.
+
+        Returns:
+            labels: PointLabels of the fibers.
+            n_labels: Integer array with the number of labels of every fiber.
+        """
+        if len(fibers) == 0:
+            return PointLabels.empty(last_incoming), np.zeros(0, dtype=int)
+
+        lengths = np.array([len(fiber) for fiber in fibers])
+        points = np.concatenate(
+            [np.asarray(fiber, dtype=np.float64).reshape(-1, 3) for fiber in fibers])
+        starts = np.cumsum(lengths) - lengths
+
+        # Labels of the points j in range(ignore_start_point, length - ignore_stop_point)
+        n_points = np.maximum(lengths - int(ignore_start_point) - int(ignore_stop_point), 0)
+        fiber_idx = np.repeat(np.arange(len(fibers)), n_points)
+        j = (np.arange(n_points.sum()) - np.repeat(np.cumsum(n_points) - n_points, n_points)
+             + int(ignore_start_point))
+        length = lengths[fiber_idx]
+        point_idx = starts[fiber_idx] + j
+
+        # Missing neighbours are gathered from a trailing zero point
+        padded = np.concatenate([points, np.zeros((1, 3))])
+
+        def gather(offset):
+            valid = (j + offset >= 0) & (j + offset < length)
+            return padded[np.where(valid, point_idx + offset, len(points))]
+
+        center = points[point_idx]
+        incoming = np.stack([gather(-1 - k) for k in range(last_incoming)], axis=1)
+        outgoing = gather(1)
+
+        if augment_reverse_fibers:
+            reverse_incoming = np.stack([gather(1 + k) for k in range(last_incoming)], axis=1)
+            center = np.repeat(center, 2, axis=0)
+            incoming = np.stack([incoming, reverse_incoming], axis=1).reshape(
+                -1, last_incoming, 3)
+            outgoing = np.stack([outgoing, incoming[0::2, 0]], axis=1).reshape(-1, 3)
+            n_points = 2 * n_points
+
+        return PointLabels(center, incoming, outgoing), n_points
+
+    def __len__(self):
+        return len(self.center)
+
+    def __getitem__(self, idx):
+        """A single label as dictionary for integer indices, else a PointLabels."""
+        if isinstance(idx, (int, np.integer)):
+            return {"center": self.center[idx],
+                    "incoming": self.incoming[idx],
+                    "outgoing": self.outgoing[idx]}
+        return PointLabels(self.center[idx], self.incoming[idx], self.outgoing[idx])
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+
+class BatchGenerator(object):
+    """Draws batches of examples from PointLabels.
+
+    Every epoch visits all labels, the first one in the stored order and every following
+    one in a new random order. A batch can span two epochs.
+    """
+
+    def __init__(self, examples, labels, label_type):
+        """
+        Args:
+            examples: PointExamples which builds the examples.
+            labels: PointLabels to draw from.
+            label_type: String which indicates the desired label type.
+        """
+        self.examples = examples
+        self.labels = labels
+        self.label_type = label_type
+        self.order = np.arange(len(labels))
+        self.position = 0
+        self.cache = None
+        if examples.cache_examples:
+            self.cache = examples.build_batch(labels, label_type)
+
+    def next_indices(self, n):
+        """Indices of the next n labels."""
+        if n > 0 and len(self.order) == 0:
+            raise ValueError("PointExamples: No labels to draw examples from")
+        indices = []
+        while n > 0:
+            if self.position == len(self.order):
+                np.random.shuffle(self.order)
+                self.position = 0
+            # copy, the order is shuffled in place at the end of the epoch
+            chunk = np.array(self.order[self.position:self.position + n])
+            indices.append(chunk)
+            self.position += len(chunk)
+            n -= len(chunk)
+        return np.concatenate(indices) if indices else np.zeros(0, dtype=int)
+
+    def next_batch(self, n):
+        """Next n examples as returned by PointExamples.build_batch."""
+        indices = self.next_indices(n)
+        if self.cache is not None:
+            return {key: value[indices] for key, value in self.cache.items()}
+        return self.examples.build_batch(self.labels[indices], self.label_type)
+
+
 class Examples(object):
     """Base Class for loading tractography training samples.
 
@@ -69,12 +215,10 @@ class Examples(object):
         block_size: Integer which indicates the entire length of the diffusion
           data block in one dimension. E.g. if 7x7x7 blocks are considered,
           then the block_size is 7. Should be odd.
-        train_labels: List which contains all training fiber labels which are
-          parsed from the track file. Each label is a dictionary which keys depend
-          on the subclass.
-        eval_labels: List which contains all evaluation fiber labels which are
-          parsed from the track file. Each label is a dictionary which keys depend
-          on the subclass.
+        train_labels: All training fiber labels which are parsed from the track
+          file. The type depends on the subclass, e.g. PointLabels.
+        eval_labels: All evaluation fiber labels which are parsed from the track
+          file. The type depends on the subclass, e.g. PointLabels.
         block_length: Integer which indicates half the block_size minus one.
           E.g. if 7x7x7 blocks are considered, the block_length is 3, i.e. the
           distance from the center in each direction in voxels.
@@ -108,7 +252,7 @@ class Examples(object):
             self.train_labels, self.eval_labels = self.initialize_labels(num_eval_examples)
         else:
             self.fibers, self.fiber_header = None, None
-            self.train_labels, self.eval_labels = [], []
+            self.train_labels, self.eval_labels = self.empty_labels(), self.empty_labels()
         self.eval_set = None
 
     def get_train_batch(self, requested_num_examples):
@@ -147,12 +291,15 @@ class Examples(object):
         For internal use.
 
         Returns:
-          Tuple of two lists of training and evaluation labels. Each label is
-          a dictionary which contains information about fiber flow. The keys of
-          a label depend on the subclass.
+          Tuple of training and evaluation labels, which contain information
+          about fiber flow. Their type depends on the subclass.
         """
         pass
 
+    def empty_labels(self):
+        """Labels used if no track file is given."""
+        return []
+
     @staticmethod
     def points_to_one_hot(center, point):
         """Calculate one-hot code for neighbor voxels.
@@ -305,6 +452,122 @@ class Examples(object):
 
         return example
 
+    @staticmethod
+    def pad_data(data, block_size):
+        """Pads the spatial dimensions of the diffusion data with zeros for build_datablocks.
+
+        Args:
+            data: MemMap to the diffusion data stored in the nifti file.
+            block_size: Integer which indicates the entire length of the diffusion
+              data block in one dimension.
+
+        Returns:
+            padded_data: Numpy array with block_size // 2 zeros added on both sides of the
+              x, y and z dimensions.
+        """
+        block_length = int(np.floor(block_size / 2))
+        return np.pad(
+            np.asarray(data),
+            [(block_length, block_length)] * 3 + [(0, 0)],
+            mode="constant")
+
+    @staticmethod
+    def build_datablocks(padded_data, block_size, center_points):
+        """Extracts the data blocks around many points at once.
+
+        Same blocks as the "data_block" of build_datablock, gathered with one fancy index
+        of the padded data.
+
+        Args:
+            padded_data: Diffusion data padded with pad_data.
+            block_size: Integer which indicates the entire length of the diffusion
+              data block in one dimension. Should be odd.
+            center_points: Numpy array of shape (N, 3) with the block centers.
+
+        Returns:
+            data_blocks: Numpy array of shape (N, block_size, block_size, block_size, C).
+              Blocks of points out of the data bounds are zero.
+        """
+        block_length = int(np.floor(block_size / 2))
+        data_shape = np.array(np.shape(padded_data)[:3]) - 2 * block_length
+
+        voxels = np.round(center_points).astype(int).reshape(-1, 3)
+        out_of_bounds = np.any((voxels < 0) | (voxels >= data_shape), axis=1)
+        for voxel in voxels[out_of_bounds]:
+            custom_print("Warning: voxel out of bounds: ({}, {}, {}), data: (0:{}, 0:{}, 0:{})".format(
+                voxel[0], voxel[1], voxel[2], data_shape[0], data_shape[1], data_shape[2]))
+        voxels[out_of_bounds] = 0
+
+        # Voxel v of the data is voxel v + block_length of the padded data, so
+        # the block of v starts at v in the padded data
+        offsets = np.arange(block_size)
+        idx = voxels[:, :, np.newaxis] + offsets
+        data_blocks = padded_data[idx[:, 0, :, np.newaxis, np.newaxis],
+                                  idx[:, 1, np.newaxis, :, np.newaxis],
+                                  idx[:, 2, np.newaxis, np.newaxis, :]].astype(np.float64)
+        data_blocks[out_of_bounds] = 0
+
+        return data_blocks
+
+    @staticmethod
+    def points_to_relative_batch(_from, to):
+        """Vectorized points_to_relative for arrays of shape (N, 3).
+
+        Returns:
+          Numpy array of shape (N, 3), zero in the rows where _from or to is zero.
+        """
+        _from = np.asarray(_from, dtype=np.float64)
+        to = np.asarray(to, dtype=np.float64)
+        relative = to - _from
+        norms = np.linalg.norm(relative, axis=1)
+        valid = np.any(_from != 0, axis=1) & np.any(to != 0, axis=1)
+        if np.any(norms[valid] < 1e-9):
+            raise ValueError("Norm of relative vector is vanishingly small.")
+
+        result = np.zeros_like(relative)
+        result[valid] = relative[valid] / norms[valid, np.newaxis]
+        return result
+
+    @staticmethod
+    def points_to_one_hot_batch(center, point):
+        """Vectorized points_to_one_hot for arrays of shape (N, 3).
+
+        Returns:
+          Numpy array of shape (N, 27).
+        """
+        center = np.asarray(center)
+        point = np.asarray(point)
+        relative = np.round(point).astype(int) - np.round(center).astype(int)
+        relative[np.all(point == 0, axis=1)] = 0
+
+        num = 13 + relative.dot([1, -3, -9])
+
+        one_hot = np.zeros((len(num), 27))
+        one_hot[np.arange(len(num)), num] = 1
+
+        return one_hot
+
+    @staticmethod
+    def build_incoming(points, affine):
+        """Computes the "incoming" point labels of build_datablock for many fibers at once.
+
+        Args:
+            points: Numpy array of shape (N, n_incoming + 1, 3). points[:, 0] are the centers,
+              points[:, i] the i-th previous points of the fibers, zero if not existent.
+            affine: The affine transformation for the voxel space.
+
+        Returns:
+            incoming: Numpy array of shape (N, 3 * n_incoming) with the rotated directions
+              from every point to the next one.
+        """
+        rot = aff_to_rot(affine)
+        n_incoming = points.shape[1] - 1
+        incoming = [
+            Examples.points_to_relative_batch(points[:, i + 1], points[:, i]).dot(rot.T)
+            for i in range(n_incoming)
+        ]
+        return np.concatenate(incoming, axis=1)
+
 
 class PointExamples(Examples):
     """Class which represents fiber point examples.
@@ -335,6 +598,7 @@ class PointExamples(Examples):
         self.eval_fibers = []
         self.train_generator = None
         self.eval_generator = None
+        self.padded_brain_data = None
         self.cache_examples = cache_examples
         self.data_corrupt_percent = data_corrupt_percent
         self.example_percent = example_percent
@@ -347,73 +611,64 @@ class PointExamples(Examples):
 
     def initialize_labels(self, num_eval_examples, augment_reverse_fibers=True):
         custom_print("Loading Fibers...")
-        fibers_filtered = []
-        for fiber in self.fibers:
-            fiber_length_mm = 0
-            for j in range(1, len(fiber)):
-                fiber_length_mm += np.linalg.norm((fiber[j] - fiber[j - 1]) * self.voxel_size)
-                if fiber_length_mm > self.min_length:
-                    fibers_filtered.append(fiber)
-                    break
-
-        np.random.shuffle(fibers_filtered)
+        fibers = [np.asarray(fiber) for fiber in self.fibers]
+        lengths = np.array([len(fiber) for fiber in fibers], dtype=int)
+        fiber_length_mm = np.zeros(len(fibers))
+        if np.any(lengths > 1):
+            points = np.concatenate([fiber.reshape(-1, 3) for fiber in fibers])
+            segments = np.linalg.norm(np.diff(points, axis=0) * self.voxel_size, axis=1)
+            # segment k joins point k and k + 1, so the segments of a fiber are
+            # starts:starts + length - 1
+            cumulative = np.concatenate([[0], np.cumsum(segments)])
+            starts = np.minimum(np.cumsum(lengths) - lengths, len(points) - 1)
+            stops = np.maximum(starts + lengths - 1, starts)
+            fiber_length_mm = cumulative[stops] - cumulative[starts]
+        long_fibers = np.flatnonzero((lengths > 1) & (fiber_length_mm > self.min_length))
+
+        np.random.shuffle(long_fibers)
+        fibers_filtered = [fibers[idx] for idx in long_fibers]
         custom_print("Found {}/{} fibers longer than {}mm".format(len(fibers_filtered), len(self.fibers),
                                                            self.min_length))
 
-        label_list = []
-        eval_labels = []
-        for fiber in fibers_filtered:
-            for j in range(self.ignore_start_point, len(fiber) - self.ignore_stop_point):
-                label = {"center": fiber[j]}
-
-                start = max(j - self.last_incoming, 0)
-                end = max(j, 0)
-                label["incoming"] = fiber[start:end][::-1]
-                label["incoming"] = np.append(
-                    label["incoming"],
-                    np.zeros((self.last_incoming - len(label["incoming"]), 3)),
-                    0)
-
-                if j == len(fiber) - 1:
-                    label["outgoing"] = np.zeros(3)
-                else:
-                    label["outgoing"] = fiber[j + 1]
-                label_list.append(label)
-                if augment_reverse_fibers:
-                    # TODO: consider ignoring start and end
-                    start = min(j + 1, len(fiber))
-                    end = min(j + 1 + self.last_incoming, len(fiber))
-                    incoming = fiber[start:end]
-                    incoming = np.append(incoming,
-                                         np.zeros((self.last_incoming - len(incoming), 3)),
-                                         0)
-                    reverse_label = {"center": label["center"], "incoming": incoming,
-                                     "outgoing": label["incoming"][0]}
-                    label_list.append(reverse_label)
-            if not eval_labels and num_eval_examples > 0:
-                self.eval_fibers.append(fiber)
-            if len(label_list) >= num_eval_examples and not eval_labels \
-                    and num_eval_examples > 0:
-                eval_labels = label_list
-                label_list = []
-
-        if len(eval_labels) < num_eval_examples:
+        labels, n_labels = PointLabels.from_fibers(
+            fibers_filtered,
+            self.last_incoming,
+            self.ignore_start_point,
+            self.ignore_stop_point,
+            augment_reverse_fibers)
+
+        # The evaluation labels are those of the first fibers which have at least
+        # num_eval_examples labels together
+        n_eval = 0
+        if num_eval_examples > 0:
+            cumulative_labels = np.cumsum(n_labels)
+            enough = np.flatnonzero(cumulative_labels >= num_eval_examples)
+            if len(enough) == 0:
+                self.eval_fibers.extend(fibers_filtered)
+            else:
+                self.eval_fibers.extend(fibers_filtered[:enough[0] + 1])
+                n_eval = cumulative_labels[enough[0]]
+
+        if n_eval < num_eval_examples:
             raise ValueError("PointExamples: Requested more evaluation examples than available")
         custom_print("finished loading, now shuffle")
-        train_labels = label_list
-        np.random.shuffle(eval_labels)
-        np.random.shuffle(train_labels)
+        eval_order = np.arange(n_eval)
+        train_order = np.arange(n_eval, len(labels))
+        np.random.shuffle(eval_order)
+        np.random.shuffle(train_order)
 
         if self.example_percent < 1.0:
             # Subsample the labels
-            n_old = len(train_labels)
+            n_old = len(train_order)
             n_wanted = np.round(n_old * self.example_percent).astype(int)
-            train_labels = train_labels[0:n_wanted]    # Subsample
-            n_new = len(train_labels)
+            train_order = train_order[0:n_wanted]    # Subsample
+            n_new = len(train_order)
             custom_print("Training labels are {} / {}, i.e. {:3.2f} %".format(n_new,
                                                                        n_old,
                                                                        n_new / n_old * 100))
 
+        eval_labels = labels[eval_order]
+        train_labels = labels[train_order]
         custom_print("Generated {} train and {} eval fiber labels\n".format(len(train_labels),
                                                                      len(eval_labels)))
         # NOTE: Here is the corruption of the training labels.
@@ -427,38 +682,60 @@ class PointExamples(Examples):
                   n_to_corrupt,
                   "on a total of",
                   len(train_labels))
-            for idx in range(n_to_corrupt):
-                cur_label = train_labels[idx]
-                cur_center = cur_label['center']
-                random_v = np.random.normal(size=3)
-                random_v = np.divide(random_v, np.linalg.norm(random_v))
-                new_outgoing = cur_center + random_v
-                cur_label['outgoing'] = new_outgoing
-                train_labels[idx] = cur_label  # QUESTION: is this really necessary?
+            random_v = np.random.normal(size=(n_to_corrupt, 3))
+            random_v = np.divide(random_v, np.linalg.norm(random_v, axis=1)[:, np.newaxis])
+            train_labels.outgoing[:n_to_corrupt] = train_labels.center[:n_to_corrupt] + random_v
         # Done with the corruption
         return (train_labels, eval_labels)
 
-    def example_generator(self, labels, label_type):
+    def empty_labels(self):
+        return PointLabels.empty(self.last_incoming)
+
+    def build_batch(self, labels, label_type):
+        """Creates the examples of many labels at once.
+
+        Args:
+          labels: PointLabels of the examples.
+          label_type: String which indicates the desired label type, "point"
+            or "one_hot".
+
+        Returns:
+          A dictionary with keys "center", "incoming", "outgoing" and
+          "data_block". Each value is an array whose i-th row is the value of
+          build_datablock for the i-th label, e.g. examples["data_block"] has
+          shape (len(labels), block_size, block_size, block_size, C). One-hot
+          incoming labels encode the closest previous point.
+        """
         if label_type not in ["one_hot", "point"]:
-            custom_print("ERROR: PointExamples: build_batch: Unknown label_type")
+            raise ValueError("PointExamples: build_batch: Unknown label_type {}".format(label_type))
 
-        examples = []
-        while True:
-            if examples:
-                for example in examples:
-                    yield example
-            else:
-                for label in labels:
-                    example = Examples.build_datablock(self.brain_data, self.block_size,
-                                                       label["center"], label["incoming"],
-                                                       label["outgoing"], label_type)
-                    yield example
-                    if self.cache_examples:
-                        examples.append(example)
-            if self.cache_examples:
-                np.random.shuffle(examples)
-            else:
-                np.random.shuffle(labels)
+        if self.padded_brain_data is None:
+            self.padded_brain_data = Examples.pad_data(self.brain_data, self.block_size)
+
+        batch = {}
+        if label_type == "one_hot":
+            batch["center"] = np.round(labels.center).astype(int)
+            batch["incoming"] = Examples.points_to_one_hot_batch(labels.center,
+                                                                 labels.incoming[:, 0])
+            batch["outgoing"] = Examples.points_to_one_hot_batch(labels.center,
+                                                                 labels.outgoing)
+        elif label_type == "point":
+            affine = self.brain_file.affine
+            batch["center"] = np.array(labels.center)
+            batch["incoming"] = Examples.build_incoming(
+                np.concatenate([labels.center[:, np.newaxis], labels.incoming], axis=1),
+                affine)
+            batch["outgoing"] = Examples.points_to_relative_batch(
+                labels.center,
+                labels.outgoing).dot(aff_to_rot(affine).T)
+
+        batch["data_block"] = Examples.build_datablocks(self.padded_brain_data,
+                                                        self.block_size,
+                                                        labels.center)
+        return batch
+
+    def batch_generator(self, labels, label_type):
+        return BatchGenerator(self, labels, label_type)
 
     def get_batch(self, generator, requested_num_examples=0):
         """ Return a dictionary of examples.
@@ -467,47 +744,34 @@ class PointExamples(Examples):
           requested_num_examples: Integer which indicates desired number of
             examples. Should be smaller or equal to num_train_examples else
             warning is raised and num_train_examples are returned.
-          generator: Generator from which to pull examples from.
+          generator: BatchGenerator from which to pull examples from.
 
         Returns:
           A dictionary with keys "center", "incoming", "outgoing" and
-          "data_block". Each value is a list of length requested_num_examples.
-          The i-th element of e.g. list "dataBlock" contains the data_block
-          array for the i-th example:
+          "data_block". Each value is an array of length requested_num_examples.
+          The i-th row of e.g. "data_block" contains the data_block array
+          for the i-th example:
           examples["center"][i] = [x,y,z] or one_hot code
           examples["incoming"][i] = [x,y,z] or one_hot code
           examples["outgoing"][i] = [x,y,z] or one_hot code
           examples["data_block"][i] = np.array
         """
-        batch = {
-            "center": [],
-            "incoming": [],
-            "outgoing": [],
-            "data_block": []
-        }
-        for i in range(requested_num_examples):
-            example = next(generator)
-
-            # Add example to examples by appending individual lists
-            for key, list in batch.items():
-                list.append(example[key])
-        return batch
+        return generator.next_batch(requested_num_examples)
 
     def get_train_batch(self, requested_num_examples, label_type="point"):
         if self.train_generator is None:
-            self.train_generator = self.example_generator(self.train_labels, label_type)
+            self.train_generator = self.batch_generator(self.train_labels, label_type)
         return self.get_batch(self.train_generator, requested_num_examples)
 
     def get_eval_batch(self, requested_num_examples, label_type="point"):
         if self.eval_generator is None:
-            self.eval_generator = self.example_generator(self.eval_labels, label_type)
+            self.eval_generator = self.batch_generator(self.eval_labels, label_type)
         return self.get_batch(self.eval_generator, requested_num_examples)
 
     def get_eval_set(self, label_type="point"):
         # only calculate once
         if self.eval_set is None:
-            eval_generator = self.example_generator(self.eval_labels, label_type)
-            self.eval_set = self.get_batch(eval_generator, len(self.eval_labels))
+            self.eval_set = self.build_batch(self.eval_labels, label_type)
         return self.eval_set
 
     def print_statistics(self):
@@ -554,13 +818,10 @@ class PointExamples(Examples):
         custom_print("-----------------------------")
 
     def check_empty_data(self, warning_only=False, threshold=0.05):
-        empty = 0
         data_blocks = self.get_eval_set()["data_block"]
         if len(data_blocks) == 0:
             return
-        for data_block in data_blocks:
-            if np.isclose(data_block, 0.0).all():
-                empty += 1
+        empty = np.sum(np.all(np.isclose(data_blocks.reshape(len(data_blocks), -1), 0.0), axis=1))
         percentage = empty / len(data_blocks)
         if warning_only:
             if percentage > threshold:
@@ -588,38 +849,22 @@ class UnsupervisedExamples(PointExamples):
 
         Returns:
           A dictionary with keys "center", "incoming", "outgoing" and
-          "data_block". Each value is a list of length requested_num_examples.
-          The i-th element of e.g. list "dataBlock" contains the data_block
+          "data_block". Each value is an array of length requested_num_examples.
+          The i-th row of e.g. "data_block" contains the flattened data_block
           array for the i-th example:
           examples["center"][i] = [x,y,z] or one_hot code
           examples["incoming"][i] = [x,y,z] or one_hot code
           examples["outgoing"][i] = [x,y,z] or one_hot code
           examples["data_block"][i] = np.array
         """
-        batch = {
-            "center": [],
-            "incoming": [],
-            "outgoing": [],
-            "data_block": []
-        }
-        for i in range(requested_num_examples):
-            example = next(generator)
-
-            # Add example to examples by appending individual lists
-            for key, list in batch.items():
-                if key == 'data_block':
-                    # still flatten the data blocks
-                    list.append(example[key].flatten())
-                else:
-                    list.append(example[key])
+        batch = PointExamples.get_batch(self, generator, requested_num_examples)
+        # still flatten the data blocks
+        batch["data_block"] = batch["data_block"].reshape(requested_num_examples, -1)
         return batch
 
     def get_unlabeled_batch(self, generator, requested_num_examples=0):
-        examples = []
-        for i in range(requested_num_examples):
-            example = next(generator)
-            examples.append(example["data_block"].flatten())
-        return np.array(examples)
+        examples = generator.next_batch(requested_num_examples)["data_block"]
+        return examples.reshape(requested_num_examples, -1)
 
     def get_train_batches(self, requested_num_examples):
         """ Return an array of examples.
@@ -635,8 +880,8 @@ class UnsupervisedExamples(PointExamples):
           each tensor is represented by the 6 values in it's upper diagonal.
         """
         if self.train_generator is None:
-            self.train_generator = self.example_generator(self.train_labels,
-                                                          "point")
+            self.train_generator = self.batch_generator(self.train_labels,
+                                                        "point")
         return self.get_unlabeled_batch(self.train_generator,
                                         requested_num_examples)
 
@@ -651,8 +896,8 @@ class UnsupervisedExamples(PointExamples):
 
         Returns:
           A dictionary with keys "center", "incoming", "outgoing" and
-          "data_block". Each value is a list of length requested_num_examples.
-          The i-th element of e.g. list "dataBlock" contains the data_block
+          "data_block". Each value is an array of length requested_num_examples.
+          The i-th row of e.g. "data_block" contains the flattened data_block
           array for the i-th example:
           examples["center"][i] = [x,y,z] or one_hot code
           examples["incoming"][i] = [x,y,z] or one_hot code
@@ -663,17 +908,15 @@ class UnsupervisedExamples(PointExamples):
         if unlabeled:
             if (not hasattr(self, 'unlabeled_eval_set')) or \
                     self.unlabeled_eval_set is None:
-                eval_generator = self.example_generator(self.eval_labels,
-                                                        "point")
-                self.unlabeled_eval_set = self.get_unlabeled_batch(
-                    eval_generator, len(self.eval_labels))
+                eval_set = self.build_batch(self.eval_labels, "point")
+                self.unlabeled_eval_set = eval_set["data_block"].reshape(
+                    len(self.eval_labels), -1)
             ret = self.unlabeled_eval_set
         else:
             if self.eval_set is None:
-                eval_generator = self.example_generator(self.eval_labels,
-                                                        label_type)
-                self.eval_set = self.get_batch(eval_generator,
-                                               len(self.eval_labels))
+                self.eval_set = self.build_batch(self.eval_labels, label_type)
+                self.eval_set["data_block"] = self.eval_set["data_block"].reshape(
+                    len(self.eval_labels), -1)
             ret = self.eval_set
         return ret
 
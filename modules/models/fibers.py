@@ -0,0 +1,126 @@
+"""This module contains the state of the fibers generated by the trackers."""
+
+import numpy as np
+
+
+class FiberState(object):
+    """Positions of fibers under construction, stored in preallocated arrays.
+
+    Attributes:
+        positions: Numpy array of shape (n_fibers, capacity, 3). positions[j, :lengths[j]]
+            are the points of fiber j.
+        lengths: Numpy array of shape (n_fibers,), number of points of every fiber.
+        active: Boolean numpy array of shape (n_fibers,), True for the ongoing fibers.
+        completion_order: List of arrays containing the indices of the completed fibers, in
+            the order they were completed.
+        max_len: Maximal number of points of a fiber. The capacity of the buffer grows
+            geometrically up to max_len, such that short tractographies don't allocate the
+            buffers for the longest possible fibers.
+    """
+
+    def __init__(self, seeds, max_len, initial_capacity=64):
+        """
+        Args:
+            seeds: Array of shape (n_fibers, 3), first point of every fiber.
+            max_len: Maximal number of points of a fiber.
+            initial_capacity: Initial number of points allocated per fiber.
+        """
+        seeds = np.asarray(seeds, dtype=np.float64).reshape(-1, 3)
+        n_fibers = seeds.shape[0]
+        self.max_len = max(int(max_len), 1)
+
+        capacity = min(initial_capacity, self.max_len)
+        self.positions = np.zeros((n_fibers, capacity, 3))
+        self.positions[:, 0] = seeds
+        self.lengths = np.ones(n_fibers, dtype=np.int64)
+        self.active = np.ones(n_fibers, dtype=bool)
+        self.completion_order = []
+
+    def n_active(self):
+        return int(np.sum(self.active))
+
+    def n_completed(self):
+        return int(sum(len(idx) for idx in self.completion_order))
+
+    def get_active_indices(self):
+        return np.nonzero(self.active)[0]
+
+    def get_last_points(self, indices, n_points):
+        """Returns the last points of the given fibers, last point first.
+
+        Args:
+            indices: Indices of the fibers.
+            n_points: Number of points to return per fiber.
+        Returns:
+            points: Array of shape (len(indices), n_points, 3). points[j, i] is the i-th
+                last point of fiber indices[j], zero if the fiber has less points.
+        """
+        points = np.zeros((len(indices), n_points, 3))
+        lengths = self.lengths[indices]
+        for i in range(n_points):
+            has_point = lengths > i
+            points[has_point, i] = self.positions[
+                indices[has_point],
+                lengths[has_point] - 1 - i
+            ]
+        return points
+
+    def _reserve(self, length):
+        capacity = self.positions.shape[1]
+        if length <= capacity:
+            return
+        new_capacity = min(max(2 * capacity, length), self.max_len)
+        if length > new_capacity:
+            raise ValueError("Fibers can have at most {} points.".format(self.max_len))
+        positions = np.zeros((self.positions.shape[0], new_capacity, 3))
+        positions[:, :capacity] = self.positions
+        self.positions = positions
+
+    def append(self, indices, points):
+        """Appends one point to each of the given fibers.
+
+        Args:
+            indices: Indices of active fibers.
+            points: Array of shape (len(indices), 3).
+        """
+        if len(indices) == 0:
+            return
+        self._reserve(int(np.max(self.lengths[indices])) + 1)
+        self.positions[indices, self.lengths[indices]] = points
+        self.lengths[indices] += 1
+
+    def complete(self, indices):
+        """Marks the given active fibers as completed."""
+        indices = np.asarray(indices, dtype=np.int64)
+        self.active[indices] = False
+        self.completion_order.append(indices)
+
+    def get_completed(self):
+        """Returns the completed fibers as ragged arrays, in the order they were completed.
+
+        Returns:
+            points: Array of shape (n_points, 3), the points of all fibers concatenated.
+            lengths: Array of shape (n_completed,), number of points of each fiber.
+        """
+        if len(self.completion_order) == 0:
+            return np.zeros((0, 3)), np.zeros(0, dtype=np.int64)
+        order = np.concatenate(self.completion_order)
+        lengths = self.lengths[order]
+        starts = np.cumsum(lengths) - lengths
+        rows = np.repeat(order, lengths)
+        cols = np.arange(np.sum(lengths)) - np.repeat(starts, lengths)
+        return self.positions[rows, cols], lengths
+
+
+def split_fibers(points, lengths):
+    """Splits ragged fiber arrays into a list of fibers.
+
+    Args:
+        points: Array of shape (n_points, 3), the points of all fibers concatenated.
+        lengths: Array of shape (n_fibers,), number of points of each fiber.
+    Returns:
+        fibers: List of arrays of shape (lengths[j], 3), views into points.
+    """
+    if len(lengths) == 0:
+        return []
+    return np.split(points, np.cumsum(lengths)[:-1])
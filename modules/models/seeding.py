@@ -0,0 +1,103 @@
+"""This module contains the computation of tractography seeds from white matter masks."""
+
+import hashlib
+import os
+import threading
+
+import numpy as np
+from scipy import ndimage
+
+
+# Border voxels by (mask digest, order), shared by all trackers of the process
+_BORDERS = {}
+_BORDERS_LOCK = threading.Lock()
+
+
+def mask_digest(mask):
+    """sha1 of the shape, type and content of a mask."""
+    mask = np.ascontiguousarray(mask)
+    h = hashlib.sha1()
+    h.update(str((mask.shape, mask.dtype.str)).encode("utf-8"))
+    h.update(mask.tobytes())
+    return h.hexdigest()
+
+
+def compute_borders(mask, order=1):
+    """Find the wm-gm interface points.
+
+    A voxel is on the interface if it is white matter (mask value 1) and the cube of
+    half-width order around it contains a zero voxel. Only voxels at least order voxels
+    away from the volume boundary are considered.
+
+    Args:
+        mask: White matter mask of shape (x, y, z).
+        order: How far from the center voxel to look for different voxels.
+    Returns:
+        borders: Integer array of shape (n_borders, 3) with the coordinates of the interface
+            voxels, in lexicographic order.
+    """
+    mask = np.asarray(mask)
+    # True where the whole cube around the voxel is non-zero
+    filled = ndimage.binary_erosion(
+        mask != 0,
+        structure=np.ones((2 * order + 1,) * 3, dtype=bool))
+    borders = (mask == 1) & ~filled
+
+    interior = np.zeros(mask.shape, dtype=bool)
+    interior[order:mask.shape[0] - order,
+             order:mask.shape[1] - order,
+             order:mask.shape[2] - order] = True
+
+    return np.argwhere(borders & interior)
+
+
+def find_borders(mask, order=1, cache_dir=None):
+    """Cached compute_borders.
+
+    The borders are memoized per mask content in the process, and stored in cache_dir
+    if it is not None.
+    """
+    key = (mask_digest(mask), order)
+    with _BORDERS_LOCK:
+        if key in _BORDERS:
+            return _BORDERS[key]
+
+    path = None
+    if cache_dir is not None:
+        path = os.path.join(cache_dir, "borders_{}_{}.npy".format(*key))
+
+    if path is not None and os.path.isfile(path):
+        borders = np.load(path)
+    else:
+        borders = compute_borders(mask, order)
+        if path is not None:
+            if not os.path.exists(cache_dir):
+                os.makedirs(cache_dir)
+            tmp_path = "{}.{}.tmp.npy".format(path, os.getpid())
+            np.save(tmp_path, borders)
+            os.replace(tmp_path, path)
+
+    with _BORDERS_LOCK:
+        _BORDERS[key] = borders
+    return borders
+
+
+def sample_seeds(borders, n_seeds, random_state=None, noise_std=0.25, max_noise=0.5):
+    """Sample seeds from the border voxels with replacement and perturb them with
+    gaussian noise.
+
+    Args:
+        borders: Array of shape (n_borders, 3).
+        n_seeds: Number of seeds.
+        random_state: np.random.RandomState for deterministic seeds, the global numpy
+            random state if None.
+        noise_std: Standard deviation of the noise.
+        max_noise: The noise is clipped to [-max_noise, max_noise].
+    Returns:
+        seeds: Array of shape (n_seeds, 3).
+    """
+    rng = np.random if random_state is None else random_state
+    idxs = rng.choice(len(borders), n_seeds, replace=True)
+    # Same random numbers as drawing the noise seed by seed
+    noise = rng.normal(0, noise_std, (n_seeds, 3))
+    return np.asarray(borders)[idxs] + np.clip(noise, -max_noise, max_noise)
@@ -231,13 +231,6 @@ def make_train_set(
         min_fiber_length=min_fiber_length,
         last_incoming=n_incoming)
 
-    X = {
-        'blocks': [],
-        'incoming': [],
-        'centers': [],
-    }
-    y = []
-
     if n_samples is None:
         n_samples = len(example_loader.train_labels)
 
@@ -246,25 +239,15 @@ def make_train_set(
 
     assert np.allclose(nii_aff, trk_aff)
 
-    for idx, label in enumerate(example_loader.train_labels):
-        if idx >= n_samples:
-            break
-        block = PointExamples.build_datablock(
-            example_loader.brain_data,
-            example_loader.block_size,
-            label['center'],
-            label['incoming'],
-            label['outgoing'],
-            label_type,
-            nii_aff)
-        X['blocks'].append(block['data_block'])
-        X['incoming'].append(block['incoming'])
-        X['centers'].append(block['center'])
-        y.append(block['outgoing'])
-
-    for key in X.keys():
-        X[key] = np.array(X[key])
-    y = np.array(y)
+    batch = example_loader.build_batch(
+        example_loader.train_labels[:n_samples],
+        label_type)
+    X = {
+        'blocks': batch['data_block'],
+        'incoming': batch['incoming'],
+        'centers': batch['center'],
+    }
+    y = batch['outgoing']
 
     joblib.dump(X, os.path.join(save_path, "train_X.pkl"))
     joblib.dump(y, os.path.join(save_path, "train_y.pkl"))
@@ -303,17 +286,17 @@ def save_fibers(fiber_list, header, out_name="fibers.trk"):
     """Save fibers form a list.
 
     Args:
-    fiber_list: The list of fibers (lists of lists of points) to be saved.
+    fiber_list: The list of fibers (lists of points or arrays of shape (n_points, 3),
+        e.g. the views returned by modules.models.fibers.split_fibers) to be saved.
     header: Original header of the fibers.
     out_name: Name with which to save the '.trk' file.
     """
     streamline = []
-    for fiber_idx, _ in enumerate(fiber_list):
-        cur_fiber = np.asarray(fiber_list[fiber_idx])
-        streamline.append([cur_fiber, None, None])
-        # Save new tractography using the header of the predicted fibers
-        nib.trackvis.write(out_name, streamline, points_space='voxel',
-        hdr_mapping=header)
+    for fiber in fiber_list:
+        streamline.append([np.asarray(fiber), None, None])
+    # Save new tractography using the header of the predicted fibers
+    nib.trackvis.write(out_name, streamline, points_space='voxel',
+                       hdr_mapping=header)
 
 
 def custom_print(*args, **kwargs):
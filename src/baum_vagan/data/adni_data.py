@@ -11,6 +11,16 @@ class adni_data():
 
     def __init__(self, exp_config):
 
+        if hasattr(exp_config, 'preproc_workers'):
+            n_workers = exp_config.preproc_workers
+        else:
+            n_workers = 1
+
+        if hasattr(exp_config, 'preproc_compression'):
+            compression = exp_config.preproc_compression
+        else:
+            compression = None
+
         data = adni_data_loader.load_and_maybe_process_data(
             input_folder=exp_config.data_root,
             preprocessing_folder=exp_config.preproc_folder,
@@ -19,7 +29,9 @@ class adni_data():
             label_list=exp_config.label_list,
             offset=exp_config.offset,
             force_overwrite=False,
-            rescale_to_one=exp_config.rescale_to_one
+            rescale_to_one=exp_config.rescale_to_one,
+            n_workers=n_workers,
+            compression=compression
         )
 
         self.data = data
@@ -65,19 +77,26 @@ class adni_data():
         val_AD_indices = val_indices[np.where(labels_val[:] == 1)]
         val_CN_indices = val_indices[np.where(labels_val[:] == 0)]
 
+        # Block-wise shuffling and prefetching of the HDF5 reads
+        provider_kwargs = {}
+        if hasattr(exp_config, 'batch_block_size'):
+            provider_kwargs['block_size'] = exp_config.batch_block_size
+        if hasattr(exp_config, 'prefetch_batches'):
+            provider_kwargs['prefetch'] = exp_config.prefetch_batches
+
         # Create the batch providers
-        self.trainAD = BatchProvider(images_train, labels_train, train_AD_indices)
-        self.trainCN = BatchProvider(images_train, labels_train, train_CN_indices)
+        self.trainAD = BatchProvider(images_train, labels_train, train_AD_indices, **provider_kwargs)
+        self.trainCN = BatchProvider(images_train, labels_train, train_CN_indices, **provider_kwargs)
 
-        self.validationAD = BatchProvider(images_val, labels_val, val_AD_indices)
-        self.validationCN = BatchProvider(images_val, labels_val, val_CN_indices)
+        self.validationAD = BatchProvider(images_val, labels_val, val_AD_indices, **provider_kwargs)
+        self.validationCN = BatchProvider(images_val, labels_val, val_CN_indices, **provider_kwargs)
 
-        self.testAD = BatchProvider(images_test, labels_test, test_AD_indices)
-        self.testCN = BatchProvider(images_test, labels_test, test_CN_indices)
+        self.testAD = BatchProvider(images_test, labels_test, test_AD_indices, **provider_kwargs)
+        self.testCN = BatchProvider(images_test, labels_test, test_CN_indices, **provider_kwargs)
 
-        self.train = BatchProvider(images_train, labels_train, train_indices)
-        self.validation = BatchProvider(images_val, labels_val, val_indices)
-        self.test = BatchProvider(images_test, labels_test, test_indices)
+        self.train = BatchProvider(images_train, labels_train, train_indices, **provider_kwargs)
+        self.validation = BatchProvider(images_val, labels_val, val_indices, **provider_kwargs)
+        self.test = BatchProvider(images_test, labels_test, test_indices, **provider_kwargs)
 
 
 if __name__ == '__main__':
@@ -5,8 +5,8 @@
 import os
 import numpy as np
 import logging
-import gc
 import h5py
+import multiprocessing
 from skimage import transform
 import math
 
@@ -23,9 +23,6 @@ gender_dict = {'Male': 0, 'Female': 1}
 viscode_dict = {'bl': 0, 'm03': 1, 'm06': 2, 'm12': 3, 'm18': 4, 'm24': 5, 'm36': 6, 'm48': 7, 'm60': 8, 'm72': 9,
                 'm84': 10, 'm96': 11, 'm108': 12, 'm120': 13}
 
-# Maximum number of data points that can be in memory at any time
-MAX_WRITE_BUFFER = 5
-
 def fix_nan_and_unknown(input, target_data_format=lambda x: x, nan_val=-1, unknown_val=-2):
     if math.isnan(float(input)):
         input = nan_val
@@ -69,10 +66,63 @@ def crop_or_pad_slice_to_size(image, target_size, offset=None):
 
     return output_volume
 
-def prepare_data(input_folder, output_file, size, target_resolution, labels_list, rescale_to_one, offset=None, image_postfix='.nii.gz'):
+def process_image(file, size, target_resolution, rescale_to_one, offset=None):
+    '''
+    Loads an image, rescales it to the target resolution, crops or pads it to size and normalises it.
+    Module level function such that it can run in a process pool.
+    '''
+
+    logging.info('Doing: %s' % file)
+
+    img_dat = utils.load_nii(file)
+    img = img_dat[0].copy()
+
+    pixel_size = (img_dat[2].structarr['pixdim'][1],
+                  img_dat[2].structarr['pixdim'][2],
+                  img_dat[2].structarr['pixdim'][3])
+
+    scale_vector = [pixel_size[0] / target_resolution[0],
+                    pixel_size[1] / target_resolution[1],
+                    pixel_size[2] / target_resolution[2]]
+
+    img_scaled = transform.rescale(img,
+                                   scale_vector,
+                                   order=1,
+                                   preserve_range=True,
+                                   multichannel=False,
+                                   mode='constant')
+
+    img_resized = crop_or_pad_slice_to_size(img_scaled, size, offset=offset)
+
+    if rescale_to_one:
+        img_resized = utils.map_image_to_intensity_range(img_resized, -1, 1, percentiles=5)
+    else:
+        img_resized = utils.normalise_image(img_resized)
+
+    ### DEBUGGING ############################################
+    # utils.create_and_save_nii(img_resized, 'debug.nii.gz')
+    # exit()
+    #########################################################
+
+    return img_resized.astype(np.float32)
+
+
+def _process_indexed_image(args):
+    '''
+    Helper function for the process pool, returns the index together with the image
+    '''
+    index, file, size, target_resolution, rescale_to_one, offset = args
+    return index, process_image(file, size, target_resolution, rescale_to_one, offset=offset)
+
+
+def prepare_data(input_folder, output_file, size, target_resolution, labels_list, rescale_to_one, offset=None,
+                 image_postfix='.nii.gz', n_workers=1, compression=None):
 
     '''
     Main function that prepares a dataset from the raw challenge data to an hdf5 dataset
+
+    :param n_workers: Number of processes loading and resampling images
+    :param compression: Compression of the image datasets, e.g. 'lzf' or 'gzip' [default: None]
     '''
 
     csv_summary_file = os.path.join(input_folder, 'summary_alldata.csv')
@@ -81,25 +131,16 @@ def prepare_data(input_folder, output_file, size, target_resolution, labels_list
     summary = summary.loc[summary['image_exists']==True]  # Use only cases that have imaging data (obs)
     summary = summary.loc[~(summary['diagnosis_3cat']=='unknown')]  # Don't use images with unknown diagnosis
 
-    # Get list of unique rids
-    rids = summary.rid.unique()
-
-    # Get initial diagnosis for rough stratification
-    diagnoses = []
-    for rid in rids:
-        diagnoses.append(summary.loc[summary['rid'] == rid]['diagnosis_3cat'].values[0])
+    # Get list of unique rids and the initial diagnosis for rough stratification
+    first_rows = summary.drop_duplicates('rid')
+    rids = first_rows['rid'].values
+    diagnoses = list(first_rows['diagnosis_3cat'].values)
 
     train_and_val_rids, test_rids, train_and_val_diagnoses, _ = train_test_split(rids, diagnoses, test_size=0.2, stratify=diagnoses)
     train_rids, val_rids = train_test_split(train_and_val_rids, test_size=0.2, stratify=train_and_val_diagnoses)
 
     print(len(train_rids), len(test_rids), len(val_rids))
 
-    # n_images_train = len(summary.loc[summary['rid'].isin(train_rids)])
-    # n_images_test = len(summary.loc[summary['rid'].isin(test_rids)])
-    # n_images_val = len(summary.loc[summary['rid'].isin(val_rids)])
-
-    hdf5_file = h5py.File(output_file, "w")
-
     diag_list = {'test': [], 'train': [], 'val': []}
     weight_list = {'test': [], 'train': [], 'val': []}
     age_list = {'test': [], 'train': [], 'val': []}
@@ -114,18 +155,18 @@ def prepare_data(input_folder, output_file, size, target_resolution, labels_list
 
     logging.info('Counting files and parsing meta data...')
 
+    labels = summary['diagnosis_3cat'].map(diagnosis_dict)
+    use_label = labels.isin(labels_list)
+
     for train_test, set_rids in zip(['train', 'test', 'val'], [train_rids, test_rids, val_rids]):
 
-        for ii, row in summary.iterrows():
+        set_rows = summary.loc[summary['rid'].isin(set_rids) & use_label]
 
-            rid = row['rid']
-            if rid not in set_rids:
-                continue
+        for ii, row in set_rows.iterrows():
 
+            rid = row['rid']
             diagnosis_str = row['diagnosis_3cat']
             diagnosis = diagnosis_dict[diagnosis_str]
-            if diagnosis not in labels_list:
-                continue
 
             rid_list[train_test].append(rid)
             diag_list[train_test].append(diagnosis)
@@ -153,129 +194,76 @@ def prepare_data(input_folder, output_file, size, target_resolution, labels_list
             file_list[train_test].append(os.path.join(input_folder, file_name))
 
 
-    # Write the small datasets
-    for tt in ['test', 'train', 'val']:
-
-        hdf5_file.create_dataset('rid_%s' % tt, data=np.asarray(rid_list[tt], dtype=np.uint16))
-        hdf5_file.create_dataset('viscode_%s' % tt, data=np.asarray(viscode_list[tt], dtype=np.uint8))
-        hdf5_file.create_dataset('diagnosis_%s' % tt, data=np.asarray(diag_list[tt], dtype=np.uint8))
-        hdf5_file.create_dataset('age_%s' % tt, data=np.asarray(age_list[tt], dtype=np.float32))
-        hdf5_file.create_dataset('weight_%s' % tt, data=np.asarray(weight_list[tt], dtype=np.float32))
-        hdf5_file.create_dataset('gender_%s' % tt, data=np.asarray(gender_list[tt], dtype=np.uint8))
-        hdf5_file.create_dataset('adas13_%s' % tt, data=np.asarray(adas13_list[tt], dtype=np.float32))
-        hdf5_file.create_dataset('mmse_%s' % tt, data=np.asarray(mmse_list[tt], dtype=np.uint8))
-        hdf5_file.create_dataset('field_strength_%s' % tt, data=np.asarray(field_strength_list[tt], dtype=np.float16))
-
-
-    n_train = len(file_list['train'])
-    n_test = len(file_list['test'])
-    n_val = len(file_list['val'])
+    # Written to a temporary file which only replaces output_file on success, such that a failed
+    # run does not leave a file that looks preprocessed
+    tmp_output_file = output_file + '.%d.tmp' % os.getpid()
+    hdf5_file = h5py.File(tmp_output_file, "w")
+    pool = None
 
-    # assert n_train == n_images_train, 'Mismatch in data sizes, %d not == %d' % (n_train, n_images_train)
-    # assert n_test == n_images_test, 'Mismatch in data sizes, %d not == %d' % (n_test, n_images_test)
-    # assert n_val == n_images_val, 'Mismatch in data sizes, %d not == %d' % (n_val, n_images_val)
+    try:
+        # Write the small datasets
+        for tt in ['test', 'train', 'val']:
 
-    # Create datasets for images and masks
-    data = {}
-    for tt, num_points in zip(['test', 'train', 'val'], [n_test, n_train, n_val]):
-        data['images_%s' % tt] = hdf5_file.create_dataset("images_%s" % tt, [num_points] + list(size), dtype=np.float32)
+            hdf5_file.create_dataset('rid_%s' % tt, data=np.asarray(rid_list[tt], dtype=np.uint16))
+            hdf5_file.create_dataset('viscode_%s' % tt, data=np.asarray(viscode_list[tt], dtype=np.uint8))
+            hdf5_file.create_dataset('diagnosis_%s' % tt, data=np.asarray(diag_list[tt], dtype=np.uint8))
+            hdf5_file.create_dataset('age_%s' % tt, data=np.asarray(age_list[tt], dtype=np.float32))
+            hdf5_file.create_dataset('weight_%s' % tt, data=np.asarray(weight_list[tt], dtype=np.float32))
+            hdf5_file.create_dataset('gender_%s' % tt, data=np.asarray(gender_list[tt], dtype=np.uint8))
+            hdf5_file.create_dataset('adas13_%s' % tt, data=np.asarray(adas13_list[tt], dtype=np.float32))
+            hdf5_file.create_dataset('mmse_%s' % tt, data=np.asarray(mmse_list[tt], dtype=np.uint8))
+            hdf5_file.create_dataset('field_strength_%s' % tt, data=np.asarray(field_strength_list[tt], dtype=np.float16))
 
-    img_list = {'test': [], 'train': [] , 'val': []}
 
-    logging.info('Parsing image files')
+        n_train = len(file_list['train'])
+        n_test = len(file_list['test'])
+        n_val = len(file_list['val'])
 
-    for train_test in ['test', 'train', 'val']:
+        # Create datasets for images, one chunk per image
+        data = {}
+        for tt, num_points in zip(['test', 'train', 'val'], [n_test, n_train, n_val]):
+            data['images_%s' % tt] = hdf5_file.create_dataset("images_%s" % tt,
+                                                               [num_points] + list(size),
+                                                               dtype=np.float32,
+                                                               chunks=tuple([1] + list(size)) if num_points > 0 else None,
+                                                               compression=compression)
 
-        write_buffer = 0
-        counter_from = 0
+        logging.info('Parsing image files')
 
-        for file in file_list[train_test]:
+        if n_workers > 1:
+            pool = multiprocessing.Pool(n_workers)
 
-            logging.info('-----------------------------------------------------------')
-            logging.info('Doing: %s' % file)
+        for train_test in ['test', 'train', 'val']:
 
-            img_dat = utils.load_nii(file)
-            img = img_dat[0].copy()
+            tasks = [(ii, file, size, target_resolution, rescale_to_one, offset)
+                     for ii, file in enumerate(file_list[train_test])]
 
-            pixel_size = (img_dat[2].structarr['pixdim'][1],
-                          img_dat[2].structarr['pixdim'][2],
-                          img_dat[2].structarr['pixdim'][3])
-
-            logging.info('Pixel size:')
-            logging.info(pixel_size)
-
-
-            scale_vector = [pixel_size[0] / target_resolution[0],
-                            pixel_size[1] / target_resolution[1],
-                            pixel_size[2] / target_resolution[2]]
-
-            img_scaled = transform.rescale(img,
-                                           scale_vector,
-                                           order=1,
-                                           preserve_range=True,
-                                           multichannel=False,
-                                           mode='constant')
-
-            img_resized = crop_or_pad_slice_to_size(img_scaled, size, offset=offset)
-
-            if rescale_to_one:
-                img_resized = utils.map_image_to_intensity_range(img_resized, -1, 1, percentiles=5)
+            if pool is not None:
+                results = pool.imap_unordered(_process_indexed_image, tasks)
             else:
-                img_resized = utils.normalise_image(img_resized)
-
-
-            ### DEBUGGING ############################################
-            # utils.create_and_save_nii(img_resized, 'debug.nii.gz')
-            # exit()
-            #########################################################
-
-            img_list[train_test].append(img_resized)
-
-            write_buffer += 1
-
-            if write_buffer >= MAX_WRITE_BUFFER:
-
-                counter_to = counter_from + write_buffer
-                _write_range_to_hdf5(data, train_test, img_list, counter_from, counter_to)
-                _release_tmp_memory(img_list, train_test)
-
-                # reset stuff for next iteration
-                counter_from = counter_to
-                write_buffer = 0
-
-
-
-        # after file loop: Write the remaining data
-
-        logging.info('Writing remaining data')
-        counter_to = counter_from + write_buffer
-
-        _write_range_to_hdf5(data, train_test, img_list, counter_from, counter_to)
-        _release_tmp_memory(img_list, train_test)
-
+                results = map(_process_indexed_image, tasks)
+
+            # every image is written as soon as it is ready
+            for ii, img in results:
+                data['images_%s' % train_test][ii, ...] = img
+
+            logging.info('Wrote %d images to images_%s' % (len(tasks), train_test))
+
+        if pool is not None:
+            pool.close()
+            pool.join()
+    except BaseException:
+        # do not wait for the queued images
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        hdf5_file.close()
+        os.remove(tmp_output_file)
+        raise
 
     # After test train loop:
     hdf5_file.close()
-
-
-def _write_range_to_hdf5(hdf5_data, train_test, img_list, counter_from, counter_to):
-    '''
-    Helper function to write a range of data to the hdf5 datasets
-    '''
-
-    logging.info('Writing data from %d to %d' % (counter_from, counter_to))
-    img_arr = np.asarray(img_list[train_test], dtype=np.float32)
-    hdf5_data['images_%s' % train_test][counter_from:counter_to, ...] = img_arr
-
-
-
-def _release_tmp_memory(img_list, train_test):
-    '''
-    Helper function to reset the tmp lists and free the memory
-    '''
-
-    img_list[train_test].clear()
-    gc.collect()
+    os.replace(tmp_output_file, output_file)
 
 
 def load_and_maybe_process_data(input_folder,
@@ -285,7 +273,9 @@ def load_and_maybe_process_data(input_folder,
                                 label_list,
                                 offset=None,
                                 rescale_to_one=False,
-                                force_overwrite=False):
+                                force_overwrite=False,
+                                n_workers=1,
+                                compression=None):
 
     '''
     This function is used to load and if necessary preprocesses the ACDC challenge data
@@ -295,6 +285,8 @@ def load_and_maybe_process_data(input_folder,
     :param size: Size of the output slices/volumes in pixels/voxels
     :param target_resolution: Resolution to which the data should resampled. Should have same shape as size
     :param force_overwrite: Set this to True if you want to overwrite already preprocessed data [default: False]
+    :param n_workers: Number of processes used for preprocessing [default: 1]
+    :param compression: Compression of the image datasets, e.g. 'lzf' or 'gzip' [default: None]
      
     :return: Returns an h5py.File handle to the dataset
     '''
@@ -322,7 +314,8 @@ def load_and_maybe_process_data(input_folder,
     if not os.path.exists(data_file_path) or force_overwrite:
         logging.info('This configuration of mode, size and target resolution has not yet been preprocessed')
         logging.info('Preprocessing now!')
-        prepare_data(input_folder, data_file_path, size, target_resolution, label_list, offset=offset, rescale_to_one=rescale_to_one)
+        prepare_data(input_folder, data_file_path, size, target_resolution, label_list, offset=offset,
+                     rescale_to_one=rescale_to_one, n_workers=n_workers, compression=compression)
     else:
         logging.info('Already preprocessed this configuration. Loading now!')
 
@@ -2,62 +2,143 @@
 # Christian F. Baumgartner (c.f.baumgartner@gmail.com)
 
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+
+def read_sorted(data, indices):
+    """
+    Reads data[indices, ...] for increasing indices. HDF5 datasets are read with one slice per run of
+    consecutive indices, which is much faster than a point selection.
+    """
+
+    if isinstance(data, np.ndarray) or len(indices) == 0:
+        return data[indices, ...]
+
+    breaks = np.nonzero(np.diff(indices) != 1)[0] + 1
+    starts = np.concatenate([[0], breaks])
+    ends = np.concatenate([breaks, [len(indices)]])
+
+    return np.concatenate([data[indices[s]:indices[e - 1] + 1, ...] for s, e in zip(starts, ends)], axis=0)
 
 
 class BatchProvider():
     """
     This is a helper class to conveniently access mini batches of training, testing and validation data
+
+    If block_size is set, the data is shuffled in blocks of block_size consecutive indices, such that batches
+    consist of few contiguous runs which are fast to read from HDF5. If prefetch is set, the next batch is read
+    on a background thread while the current one is used.
     """
 
-    def __init__(self, X, y, indices):  # indices don't always cover all of X and Y (e.g. in the case of val set)
+    def __init__(self, X, y, indices, block_size=None, prefetch=False):  # indices don't always cover all of X and Y (e.g. in the case of val set)
 
         self.X = X
         self.y = y
         self.indices = indices
-        self.unused_indices = indices.copy()
+        self.block_size = block_size
 
-    def next_batch(self, batch_size, add_dummy_dimension=True):
+        # indices not sampled yet are unused_indices[position:]
+        self.unused_indices = self.shuffled_indices()
+        self.position = 0
+
+        self.executor = None
+        self.prefetched = None
+        if prefetch:
+            self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def shuffled_indices(self):
         """
-        Get a single random batch. This implements sampling without replacement (not just on a batch level), this means 
-        all the data gets sampled eventually. 
+        Random order of all indices, at block granularity if block_size is set.
         """
 
-        if len(self.unused_indices) < batch_size:
-            self.unused_indices = self.indices
+        if self.block_size is None:
+            return np.random.permutation(self.indices)
+
+        sorted_indices = np.sort(self.indices)
+        # random block boundaries, such that blocks differ between epochs
+        first = np.random.randint(self.block_size)
+        bounds = list(range(first, len(sorted_indices), self.block_size))
+        blocks = np.split(sorted_indices, [b for b in bounds if b > 0])
 
-        batch_indices = np.random.choice(self.unused_indices, batch_size, replace=False)
-        self.unused_indices = np.setdiff1d(self.unused_indices, batch_indices)
+        return np.concatenate([blocks[i] for i in np.random.permutation(len(blocks))])
+
+    def draw_indices(self, batch_size):
+        """
+        Draws batch_size indices without replacement (not just on a batch level), this means
+        all the data gets sampled eventually. Returns the indices in increasing order.
+        """
+
+        if len(self.unused_indices) - self.position < batch_size:
+            self.unused_indices = self.shuffled_indices()
+            self.position = 0
+
+        batch_indices = self.unused_indices[self.position:self.position + batch_size]
+        self.position += batch_size
 
         # HDF5 requires indices to be in increasing order
-        batch_indices = np.sort(batch_indices)
+        return np.sort(batch_indices)
+
+    def read_batch(self, batch_indices):
+        return read_sorted(self.X, batch_indices), read_sorted(self.y, batch_indices)
+
+    def next_batch(self, batch_size, add_dummy_dimension=True):
+        """
+        Get a single random batch. This implements sampling without replacement (not just on a batch level), this means
+        all the data gets sampled eventually.
+        """
 
-        X_batch = self.X[batch_indices, ...]
-        y_batch = self.y[batch_indices, ...]
+        if self.executor is None:
+            X_batch, y_batch = self.read_batch(self.draw_indices(batch_size))
+        else:
+            X_batch, y_batch = self.next_prefetched_batch(batch_size)
 
         if add_dummy_dimension:
             X_batch = np.expand_dims(X_batch, axis=-1)
 
         return X_batch, y_batch
 
+    def next_prefetched_batch(self, batch_size):
+        """
+        Returns the prefetched batch and starts reading the next one, assuming the next call asks for the same
+        batch size.
+        """
+
+        if self.prefetched is not None and self.prefetched[0] == batch_size:
+            batch = self.prefetched[1].result()
+        else:
+            if self.prefetched is not None:
+                # prefetched with another batch size, its indices are only sampled again in the next epoch
+                self.prefetched[1].result()
+            batch = self.read_batch(self.draw_indices(batch_size))
+
+        self.prefetched = (batch_size, self.executor.submit(self.read_batch, self.draw_indices(batch_size)))
+
+        return batch
+
     def iterate_batches(self, batch_size, add_dummy_dimension=True):
         """
-        Get a range of batches. Use as argument of a for loop like you would normally use 
-        the range() function. 
+        Get a range of batches. Use as argument of a for loop like you would normally use
+        the range() function.
         """
 
-        np.random.shuffle(self.indices)
-        N = self.indices.shape[0]
+        shuffled_indices = self.shuffled_indices()
+        N = shuffled_indices.shape[0]
 
-        for b_i in range(0, N, batch_size):
+        # HDF5 requires indices to be in increasing order
+        all_batch_indices = [np.sort(shuffled_indices[b_i:b_i + batch_size]) for b_i in range(0, N, batch_size)]
 
-            # if b_i + batch_size > N:
-            #     continue
+        future = None
+        if self.executor is not None and len(all_batch_indices) > 0:
+            future = self.executor.submit(self.read_batch, all_batch_indices[0])
 
-            # HDF5 requires indices to be in increasing order
-            batch_indices = np.sort(self.indices[b_i:b_i + batch_size])
+        for ii, batch_indices in enumerate(all_batch_indices):
 
-            X_batch = self.X[batch_indices, ...]
-            y_batch = self.y[batch_indices, ...]
+            if future is None:
+                X_batch, y_batch = self.read_batch(batch_indices)
+            else:
+                X_batch, y_batch = future.result()
+                if ii + 1 < len(all_batch_indices):
+                    future = self.executor.submit(self.read_batch, all_batch_indices[ii + 1])
 
             if add_dummy_dimension:
                 X_batch = np.expand_dims(X_batch, axis=-1)
@@ -22,11 +22,13 @@
 
 
 import pandas as pd
+import numpy as np
 import os
 import glob
 import datetime
 import time
 import csv
+import json
 import shutil
 import utils
 from subprocess import Popen
@@ -158,6 +160,48 @@ def map_all_baseline_to_bl(list):
 def all_same(items):
     return all(x == items[0] for x in items)
 
+
+def get_stamp_path(out_file_path):
+    return out_file_path + '.steps.json'
+
+
+def write_stamp(out_file_path, steps):
+    '''
+    Records the preprocessing steps of an output in a sidecar file, written after the output.
+    '''
+    stamp_path = get_stamp_path(out_file_path)
+    tmp_stamp_path = stamp_path + '.%d.tmp' % os.getpid()
+    with open(tmp_stamp_path, 'w') as f:
+        json.dump(steps, f, sort_keys=True)
+    os.replace(tmp_stamp_path, stamp_path)
+
+
+def output_up_to_date(out_file_path, in_file_path, steps=None):
+    '''
+    An output is up to date if it is newer than its input and, if steps is given, was
+    produced with the same preprocessing steps according to its sidecar stamp.
+    '''
+    # outputs are written atomically, an existing output is complete
+    if not os.path.exists(out_file_path):
+        return False
+    if os.path.getmtime(out_file_path) < os.path.getmtime(in_file_path):
+        return False
+    if steps is None:
+        return True
+
+    stamp_path = get_stamp_path(out_file_path)
+    if not os.path.exists(stamp_path):
+        return False
+    with open(stamp_path, 'r') as f:
+        return json.load(f) == steps
+
+
+def copy_atomic(src, dst):
+    tmp_dst = dst + '.%d.tmp' % os.getpid()
+    shutil.copyfile(src, tmp_dst)
+    os.replace(tmp_dst, dst)
+
+
 def do_preprocessing(adnimerge_table_arg,
                      tmp_index,
                      processed_images_folder,
@@ -167,13 +211,31 @@ def do_preprocessing(adnimerge_table_arg,
                      do_bias_correction=False,
                      do_cropping=False,
                      do_skull_stripping=False,
-                     write_csv=True):
+                     write_csv=True,
+                     baseline_table=None):
+    '''
+    Processes the rows of adnimerge_table_arg. baseline_table is the table used to look up
+    the baseline exam dates, it has to be the full table if adnimerge_table_arg is a chunk of it.
+    Temporary files are written to a folder specific to tmp_index.
+    '''
+
+    if baseline_table is None:
+        baseline_table = adnimerge_table_arg
 
     if do_reorientation | do_registration | do_bias_correction | do_cropping | do_skull_stripping == False:
         do_postprocessing = False
     else:
         do_postprocessing = True
 
+    # outputs produced with other steps are not up to date
+    steps = {
+        'do_reorientation': do_reorientation,
+        'do_registration': do_registration,
+        'do_bias_correction': do_bias_correction,
+        'do_cropping': do_cropping,
+        'do_skull_stripping': do_skull_stripping,
+    }
+
     vitals_table = pd.read_csv(vitals_path)
 
     mri_3_0_meta_table = pd.read_csv(mri_3_0_meta_path)
@@ -182,7 +244,7 @@ def do_preprocessing(adnimerge_table_arg,
     diagnosis_table = pd.read_csv(diagnosis_path)
 
 
-    tmp_file_folder = os.path.join(processed_images_folder, 'tmp')
+    tmp_file_folder = os.path.join(processed_images_folder, 'tmp', 'chunk_%s' % str(tmp_index))
     if do_postprocessing:
         utils.makefolder(tmp_file_folder)
 
@@ -336,7 +398,7 @@ def do_preprocessing(adnimerge_table_arg,
 
                 # figure out age:
                 # get baseline examdate from adnimerge
-                baseline_row = find_by_conditions(adnimerge_table_arg,
+                baseline_row = find_by_conditions(baseline_table,
                                                   and_condition_dict={'RID': rid},
                                                   or_condition_dict={'VISCODE': ['sc', 'scmri', 'bl']})
 
@@ -404,59 +466,62 @@ def do_preprocessing(adnimerge_table_arg,
                                                                       gz_postfix)
 
                         out_folder = os.path.join(processed_images_folder, patient_folder)
-                        utils.makefolder(out_folder)
+                        # chunks processed concurrently can share a patient
+                        os.makedirs(out_folder, exist_ok=True)
 
                         out_file_path = os.path.join(out_folder, out_file_name)
 
-                        if os.path.exists(out_file_path):
-                            logging.info('!!! File already exists. Skipping')
-                            continue
+                        # existing outputs still get a row in the summary
+                        if output_up_to_date(out_file_path, nii_use_file, steps):
+                            logging.info('!!! File already exists and is up to date. Skipping')
                         else:
                             logging.info('--- Doing File: %s' % out_file_path)
 
-                        if not do_postprocessing:
-                            logging.info('Not doing any preprocessing...')
-                            shutil.copyfile(nii_use_file, out_file_path)
-                        else:
-                            tmp_file_path = os.path.join(tmp_file_folder, 'tmp_rid%s_%s.nii.gz' % (str(rid).zfill(4), str(tmp_index)))
-                            shutil.copyfile(nii_use_file, tmp_file_path)
+                            if not do_postprocessing:
+                                logging.info('Not doing any preprocessing...')
+                                copy_atomic(nii_use_file, out_file_path)
+                            else:
+                                tmp_file_path = os.path.join(tmp_file_folder, 'tmp_rid%s_%s.nii.gz' % (str(rid).zfill(4), str(tmp_index)))
+                                shutil.copyfile(nii_use_file, tmp_file_path)
 
-                            if do_reorientation:
-                            # fsl orientation enforcing:
-                                logging.info('Reorienting to MNI space...')
-                                Popen('fslreorient2std {0} {1}'.format(tmp_file_path, tmp_file_path), shell=True).communicate()
+                                if do_reorientation:
+                                # fsl orientation enforcing:
+                                    logging.info('Reorienting to MNI space...')
+                                    Popen('fslreorient2std {0} {1}'.format(tmp_file_path, tmp_file_path), shell=True).communicate()
 
-                            if do_cropping:
+                                if do_cropping:
 
-                                # field of view cropping
-                                logging.info('Cropping the field of view...')
-                                Popen('robustfov -i {0} -r {1}'.format(tmp_file_path, tmp_file_path), shell=True).communicate()
+                                    # field of view cropping
+                                    logging.info('Cropping the field of view...')
+                                    Popen('robustfov -i {0} -r {1}'.format(tmp_file_path, tmp_file_path), shell=True).communicate()
 
-                            if do_bias_correction:
-                                # bias correction with N4:
-                                logging.info('Bias correction...')
-                                Popen('{0} {1} {2}'.format(N4_executable, tmp_file_path, tmp_file_path),
-                                      shell=True).communicate()
+                                if do_bias_correction:
+                                    # bias correction with N4:
+                                    logging.info('Bias correction...')
+                                    Popen('{0} {1} {2}'.format(N4_executable, tmp_file_path, tmp_file_path),
+                                          shell=True).communicate()
 
-                            if do_registration:
+                                if do_registration:
 
-                                # registration with flirt to MNI 152:
-                                logging.info('Registering the structural image...')
-                                Popen(
-                                    'flirt -in {0} -ref {1} -out {2} -searchrx -45 45 -searchry -45 45 -searchrz -45 45 -dof 7'.format(
-                                        tmp_file_path, mni_template_t1, tmp_file_path), shell=True).communicate()
+                                    # registration with flirt to MNI 152:
+                                    logging.info('Registering the structural image...')
+                                    Popen(
+                                        'flirt -in {0} -ref {1} -out {2} -searchrx -45 45 -searchry -45 45 -searchrz -45 45 -dof 7'.format(
+                                            tmp_file_path, mni_template_t1, tmp_file_path), shell=True).communicate()
 
-                            if do_skull_stripping:
+                                if do_skull_stripping:
 
-                                # skull stripping with bet2
-                                logging.info('Skull stripping...')
-                                # Popen('bet {0} {1} -R -f 0.5 -g 0'.format(tmp_file_path, tmp_file_path), shell=True).communicate()  # bet was not robust enough
-                                Popen('{0} {1} {2} -R -f 0.5 -g 0'.format(robex_executable, tmp_file_path, tmp_file_path), shell=True).communicate()
-                                logging.info('Finished.')
+                                    # skull stripping with bet2
+                                    logging.info('Skull stripping...')
+                                    # Popen('bet {0} {1} -R -f 0.5 -g 0'.format(tmp_file_path, tmp_file_path), shell=True).communicate()  # bet was not robust enough
+                                    Popen('{0} {1} {2} -R -f 0.5 -g 0'.format(robex_executable, tmp_file_path, tmp_file_path), shell=True).communicate()
+                                    logging.info('Finished.')
 
 
-                            logging.info('Copying tmp file: %s, to output: %s' % (tmp_file_path, out_file_path))
-                            shutil.copyfile(tmp_file_path, out_file_path)
+                                logging.info('Copying tmp file: %s, to output: %s' % (tmp_file_path, out_file_path))
+                                copy_atomic(tmp_file_path, out_file_path)
+
+                            write_stamp(out_file_path, steps)
 
 
                     if write_csv:
@@ -477,8 +542,72 @@ def do_preprocessing(adnimerge_table_arg,
                                         education, ethnicity, race, apoe4, adas13, mmse, faq, 1])
 
 
-
-
+def split_table(table, n_chunks):
+    '''
+    Splits the table in at most n_chunks contiguous chunks, such that the concatenated
+    chunk results are in the same order as the table.
+    '''
+    chunk_size = max(1, int(np.ceil(len(table) / float(n_chunks))))
+    return [table.iloc[i:i + chunk_size] for i in range(0, len(table), chunk_size)]
+
+
+def merge_summary_csvs(chunk_csv_files, summary_csv_file):
+    '''
+    Concatenates the chunk summaries in chunk order, keeping the header of the first one.
+    '''
+    tmp_summary_csv_file = summary_csv_file + '.tmp'
+    with open(tmp_summary_csv_file, 'w') as out_file:
+        for chunk_index, chunk_csv_file in enumerate(chunk_csv_files):
+            with open(chunk_csv_file, 'r') as in_file:
+                for line_index, line in enumerate(in_file):
+                    if line_index == 0 and chunk_index > 0:
+                        continue
+                    out_file.write(line)
+    os.replace(tmp_summary_csv_file, summary_csv_file)
+
+    for chunk_csv_file in chunk_csv_files:
+        os.remove(chunk_csv_file)
+
+
+def do_preprocessing_parallel(adnimerge_table,
+                              processed_images_folder,
+                              summary_csv_file,
+                              n_workers,
+                              n_chunks=None,
+                              **kwargs):
+    '''
+    Runs do_preprocessing on chunks of the table in a pool of n_workers processes.
+    Every chunk writes its own summary and uses its own tmp folder, the summaries
+    are merged into summary_csv_file at the end.
+    '''
+    if n_chunks is None:
+        n_chunks = 4 * n_workers
+
+    chunks = split_table(adnimerge_table, n_chunks)
+    chunk_csv_files = ['%s.chunk%04d' % (summary_csv_file, tmp_index) for tmp_index in range(len(chunks))]
+
+    pool = multiprocessing.Pool(n_workers)
+    func_list = []
+    for tmp_index, df in enumerate(chunks):
+
+        kwds = dict(kwargs)
+        kwds['baseline_table'] = adnimerge_table
+        f = pool.apply_async(do_preprocessing,
+                             args=(df, tmp_index, processed_images_folder, chunk_csv_files[tmp_index]),
+                             kwds=kwds)
+
+        func_list.append(f)
+
+    pool.close()
+    for f in func_list:
+        f.get()
+    pool.join()
+
+    if kwargs.get('write_csv', True):
+        merge_summary_csvs(chunk_csv_files, summary_csv_file)
+    else:
+        for chunk_csv_file in chunk_csv_files:
+            os.remove(chunk_csv_file)
 
 
 if __name__ == '__main__':
@@ -511,38 +640,21 @@ if __name__ == '__main__':
     do_skull_stripping = False #True
 
     # adnimerge_table = pd.read_csv(adni_merge_path, nrows=2)
-    # adnimerge_table = pd.read_csv(adni_merge_path, chunksize=100)
 
-    pool = multiprocessing.Pool(1)
+    n_workers = multiprocessing.cpu_count()
 
     start_time = time.time()
 
-    # func_list = []
-    # for tmp_index, df in enumerate(adnimerge_table):
-    #
-    #     f = pool.apply_async(do_preprocessing, args=(df, tmp_index, processed_images_folder, summary_csv_file),
-    #                                            kwds={'do_reorientation': do_reorientation,
-    #                                                  'do_registration': do_registration,
-    #                                                  'do_bias_correction': do_bias_correction,
-    #                                                  'do_cropping': do_cropping,
-    #                                                  'do_skull_stripping': do_skull_stripping,
-    #                                                  'write_csv': True})
-    #
-    #     func_list.append(f)
-    #
-    #
-    # for f in func_list:
-    #     f.get()
-
     adnimerge_table = pd.read_csv(adni_merge_path)
-    do_preprocessing(adnimerge_table, 0,
-                     processed_images_folder,
-                     summary_csv_file,
-                     do_reorientation=do_reorientation,
-                     do_registration=do_registration,
-                     do_bias_correction=do_bias_correction,
-                     do_cropping=do_cropping,
-                     do_skull_stripping=do_skull_stripping,
-                     write_csv=True)
+    do_preprocessing_parallel(adnimerge_table,
+                              processed_images_folder,
+                              summary_csv_file,
+                              n_workers,
+                              do_reorientation=do_reorientation,
+                              do_registration=do_registration,
+                              do_bias_correction=do_bias_correction,
+                              do_cropping=do_cropping,
+                              do_skull_stripping=do_skull_stripping,
+                              write_csv=True)
 
     logging.info('Elapsed time %f secs' % (time.time()-start_time))
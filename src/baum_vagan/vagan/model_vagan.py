@@ -800,6 +800,73 @@ class vagan:
 
         return images, masks
 
+    def iterated_far_prediction_batch(self, imgs, n_steps,
+                                      only_negative=False, batch_size=None,
+                                      only_final=False):
+        """
+        Batched version of iterated_far_prediction. All images of a
+        batch are moved forward by one step with a single session call.
+        Args:
+            - imgs: list of images or array of shape (N, ...)
+            - n_steps: number of generator steps
+            - only_negative: only use negative difference maps
+            - batch_size: number of images per session call, all
+              images at once if None
+            - only_final: only keep the images and masks of the last
+              step
+        Return:
+            - images: array of shape (N, n_steps, ...) containing
+              the first channel after every step, (N, ...) if
+              only_final
+            - masks: array of shape (N, n_steps, ..., n_channels),
+              (N, ..., n_channels) if only_final
+        """
+        n_channels = self.exp_config.n_channels
+        if n_channels not in [2, 3]:
+            raise ValueError("Invalid number of channels")
+
+        X = np.array(imgs, dtype=np.float32)
+        if X.shape[-1] != 1:
+            X = X[..., np.newaxis]
+        if n_channels == 2:
+            X = np.concatenate((X, X), axis=-1)
+        else:
+            X = np.concatenate((X, X * 0 + 1.0, X), axis=-1)
+
+        n = X.shape[0]
+        if batch_size is None or batch_size <= 0:
+            batch_size = n
+
+        img_shape = X.shape[1:-1]
+        if only_final:
+            images = np.empty((n,) + img_shape, dtype=np.float32)
+            masks = np.zeros(X.shape, dtype=np.float32)
+        else:
+            images = np.empty((n, n_steps) + img_shape, dtype=np.float32)
+            masks = np.empty((n, n_steps) + X.shape[1:], dtype=np.float32)
+
+        for s in range(0, n, batch_size):
+            e = min(s + batch_size, n)
+            batch = X[s:e]
+            for step in range(n_steps):
+                M = self.predict_mask(batch)
+                if only_negative:
+                    M[M >= 0] = 0
+                batch += M
+                if n_channels == 3:
+                    batch[..., 1] = 1.0
+
+                if not only_final:
+                    images[s:e, step] = batch[..., 0]
+                    masks[s:e, step] = M
+
+            if only_final:
+                images[s:e] = batch[..., 0]
+                if n_steps > 0:
+                    masks[s:e] = M
+
+        return images, masks
+
     def predict_critic_input(self, input_image):
         res = self.sess.run(
             self.critic_real_inp,
@@ -1159,6 +1226,13 @@ class vagan:
         logging.info("[Step: %d], generator loss: %g, critic_loss: %g" % 
                      (step, g_loss_train, d_loss_train))
 
+        for name in ["trainAD", "trainCN"]:
+            provider = getattr(self.data, name)
+            if hasattr(provider, "get_prefetch_stats"):
+                stats = provider.get_prefetch_stats()
+                if stats is not None:
+                    logging.info("[Prefetch %s] %s" % (name, stats))
+
     def _do_validation_and_save_model(self, step):
 
         """
@@ -0,0 +1,218 @@
+import numpy as np
+
+
+SCORE_NAMES = ["accuracy", "recall", "precision", "specificity", "f1"]
+
+
+def _count_greater(idx, n_eps):
+    """
+    Args:
+        - idx: integer array of shape (m, C), number of thresholds
+          smaller than every probability
+        - n_eps: number of thresholds
+    Return:
+        - array of shape (C, n_eps), entry (c, j) counts the rows i
+          with idx[i, c] > j, i.e. the probabilities above threshold j
+    """
+    n_cols = idx.shape[1]
+    flat = idx.T + (n_eps + 1) * np.arange(n_cols)[:, np.newaxis]
+    hist = np.bincount(
+        flat.ravel(),
+        minlength=n_cols * (n_eps + 1)
+    ).reshape(n_cols, n_eps + 1)
+    # number of rows with idx >= b
+    cum = np.cumsum(hist[:, ::-1], axis=1)[:, ::-1]
+    return cum[:, 1:]
+
+
+def confusion_counts(labels, probs, all_eps):
+    """
+    Confusion counts of the predictions probs > eps for all
+    thresholds at once. Thresholds are sorted once, every
+    probability is located with a binary search and the counts
+    are obtained with cumulative sums.
+
+    Args:
+        - labels: binary labels of shape (n,)
+        - probs: array of shape (n,) or (n, C) containing C
+          candidate scores per sample
+        - all_eps: thresholds of shape (E,)
+    Return:
+        - TP, FP, TN, FN of shape (E,) or (C, E)
+    """
+    labels = np.asarray(labels) == 1
+    probs = np.asarray(probs, dtype=np.float64)
+    squeeze = probs.ndim == 1
+    if squeeze:
+        probs = probs[:, np.newaxis]
+
+    eps = np.asarray(all_eps, dtype=np.float64).reshape(-1)
+    order = np.argsort(eps, kind='mergesort')
+    sorted_eps = eps[order]
+
+    # comparisons with nan are always false, nan thresholds are
+    # sorted last and therefore never below a probability
+    idx = np.searchsorted(sorted_eps, probs, side='left')
+    idx[np.isnan(probs)] = 0
+
+    n_eps = len(eps)
+    tp = np.empty((probs.shape[1], n_eps), dtype=np.int64)
+    fp = np.empty((probs.shape[1], n_eps), dtype=np.int64)
+    tp[:, order] = _count_greater(idx[labels], n_eps)
+    fp[:, order] = _count_greater(idx[~labels], n_eps)
+
+    n_pos = np.sum(labels)
+    n_neg = len(labels) - n_pos
+    fn = n_pos - tp
+    tn = n_neg - fp
+
+    if squeeze:
+        return tp[0], fp[0], tn[0], fn[0]
+    return tp, fp, tn, fn
+
+
+def _safe_divide(num, denom):
+    # sklearn convention: scores with a zero denominator are 0
+    num = np.asarray(num, dtype=np.float64)
+    denom = np.asarray(denom, dtype=np.float64)
+    res = np.zeros(np.broadcast(num, denom).shape)
+    mask = denom > 0
+    res[mask] = num[mask] / denom[mask]
+    return res
+
+
+def threshold_scores(labels, probs, all_eps):
+    """
+    Vectorized version of compute_scores(labels, probs > eps)
+    for all thresholds.
+
+    Return:
+        - dictionary mapping score names to arrays of shape (E,)
+          or (C, E), rounded to 6 decimals
+    """
+    tp, fp, tn, fn = confusion_counts(labels, probs, all_eps)
+    scores = {
+        "accuracy": _safe_divide(tp + tn, tp + fp + tn + fn),
+        "recall": _safe_divide(tp, tp + fn),
+        "precision": _safe_divide(tp, tp + fp),
+        "specificity": _safe_divide(tn, tn + fp),
+        "f1": _safe_divide(2 * tp, 2 * tp + fp + fn)
+    }
+    return {k: np.round(v, 6) for k, v in scores.items()}
+
+
+def best_threshold(labels, probs, target_metric, all_eps):
+    """
+    Return:
+        - first threshold maximizing the target metric
+        - dictionary containing all scores for that threshold
+    """
+    scores = threshold_scores(labels, probs, all_eps)
+    i = np.argmax(scores[target_metric])
+    return all_eps[i], {k: v[i] for k, v in scores.items()}
+
+
+def weight_grid(weight_vals, n_probs):
+    """
+    All weight combinations in the order of
+    itertools.product(weight_vals, repeat=n_probs).
+    """
+    weight_vals = np.asarray(weight_vals, dtype=np.float64)
+    grids = np.meshgrid(*(n_probs * [weight_vals]), indexing='ij')
+    return np.stack([g.ravel() for g in grids], axis=1)
+
+
+def _best_combo(labels, combine_fn, combos, target_metric, all_eps,
+                batch_size):
+    """
+    Return:
+        - index of the first combination with the best score
+        - its score
+    """
+    best_i = -1
+    best_score = -1
+    for s in range(0, len(combos), batch_size):
+        batch = combos[s:s + batch_size]
+        scores = threshold_scores(labels, combine_fn(batch), all_eps)
+        combo_scores = np.max(scores[target_metric], axis=1)
+        i = np.argmax(combo_scores)
+        if combo_scores[i] > best_score:
+            best_score = combo_scores[i]
+            best_i = s + i
+
+    return best_i, best_score
+
+
+def _coordinate_search(labels, combine_fn, weight_vals, n_probs,
+                       target_metric, all_eps, max_rounds=10):
+    """
+    Optimize one weight at a time, keeping the others fixed, until
+    no single weight change improves the target metric.
+    """
+    weight_vals = np.asarray(weight_vals, dtype=np.float64)
+    best = np.full(n_probs, weight_vals[-1])
+    _, best_score = _best_combo(
+        labels, combine_fn, best[np.newaxis], target_metric, all_eps, 1
+    )
+
+    for _ in range(max_rounds):
+        improved = False
+        for j in range(n_probs):
+            candidates = np.tile(best, (len(weight_vals), 1))
+            candidates[:, j] = weight_vals
+            i, score = _best_combo(
+                labels, combine_fn, candidates, target_metric, all_eps,
+                len(candidates)
+            )
+            if score > best_score:
+                best_score = score
+                best = candidates[i]
+                improved = True
+
+        if not improved:
+            break
+
+    return best
+
+
+def search_weights(labels, combine_fn, weight_vals, n_probs, target_metric,
+                   all_eps, weights=None, weight_search="grid",
+                   batch_size=4096):
+    """
+    Find the weights and threshold maximizing the target metric.
+
+    Args:
+        - labels: binary labels of shape (n,)
+        - combine_fn: maps weights of shape (C, n_probs) to combined
+          probabilities of shape (n, C)
+        - weight_vals: values every weight can take
+        - n_probs: number of weights
+        - target_metric: one of SCORE_NAMES
+        - all_eps: thresholds
+        - weights: evaluate only these weights if not None
+        - weight_search: 'grid' evaluates all combinations in batches,
+          'coordinate' runs a coordinate search on the grid
+        - batch_size: number of combinations scored at once
+    Return:
+        - best threshold, best weights, scores of the best weights
+    """
+    if weights is not None:
+        best = np.array(weights, dtype=np.float64)
+    elif weight_search == "grid":
+        combos = weight_grid(weight_vals, n_probs)
+        i, _ = _best_combo(
+            labels, combine_fn, combos, target_metric, all_eps, batch_size
+        )
+        best = combos[i]
+    elif weight_search == "coordinate":
+        best = _coordinate_search(
+            labels, combine_fn, weight_vals, n_probs, target_metric, all_eps
+        )
+    else:
+        raise ValueError("Unknown weight search {}".format(weight_search))
+
+    probs = combine_fn(best[np.newaxis])[:, 0]
+    best_eps, best_scores = best_threshold(
+        labels, probs, target_metric, all_eps
+    )
+    return best_eps, np.copy(best), best_scores
@@ -14,6 +14,7 @@ from src.test_retest.mri.supervised_features import SliceClassification
 from src.data.streaming.base import Group
 from src.logging import MetricLogger
 from src.baum_vagan.utils import ncc
+from src.conversion.threshold_search import best_threshold, search_weights
 
 
 def predict_probabilities(est, input_fn):
@@ -25,6 +26,48 @@ def predict_probabilities(est, input_fn):
     return np.array(res)
 
 
+class ProbabilityStore(object):
+    """
+    Classifier probabilities keyed by checkpoint, preprocessing
+    variant and file ID. Shared by all threshold strategies and
+    splits, so that every image is only predicted once.
+    """
+    def __init__(self):
+        self.probs = {}
+
+    def get_probs(self, est, streamer, fids, variant, vagan_steps=None):
+        """
+        Args:
+            - est: estimator to predict with
+            - streamer: streamer providing get_input_fn_for_groups
+            - fids: list of file IDs
+            - variant: hashable description of the preprocessing
+              applied by the streamer, e.g. ("vagan", n_steps)
+            - vagan_steps: passed on to the streamer if not None
+        Return:
+            - array containing the probability of every file ID
+        """
+        key = (est.latest_checkpoint(), variant)
+        if key not in self.probs:
+            self.probs[key] = {}
+        fid_to_prob = self.probs[key]
+
+        missing = sorted(set(fids).difference(fid_to_prob.keys()))
+        if len(missing) > 0:
+            groups = [Group([fid]) for fid in missing]
+            if vagan_steps is None:
+                input_fn = streamer.get_input_fn_for_groups(groups)
+            else:
+                input_fn = streamer.get_input_fn_for_groups(
+                    groups,
+                    vagan_steps=vagan_steps
+                )
+            probs = predict_probabilities(est, input_fn)
+            fid_to_prob.update(zip(missing, probs))
+
+        return np.array([fid_to_prob[fid] for fid in fids])
+
+
 def specificity_score_deprecated(y_true, y_pred):
     """
     Compute true negative rate.
@@ -62,75 +105,53 @@ def compute_scores(y_true, y_pred):
 
 
 def threshold_probs(labels, probs, target_metric, all_eps):
-    target_scores = []
-    all_scores = []
-    for eps in all_eps:
-        preds = (probs > eps).astype(np.float32)
+    # same result as calling compute_scores for every eps
+    return best_threshold(labels, probs, target_metric, all_eps)
 
-        score_names, scores = compute_scores(labels, preds)
-        target_scores.append(scores[target_metric])
-        all_scores.append(scores)
 
-    i = np.argmax(target_scores)
-    return all_eps[i], all_scores[i]
-
-
-def threshold_harmonic_all_probs(labels, all_probs, target_metric, eps=None, weights=None):
+def threshold_harmonic_all_probs(labels, all_probs, target_metric, eps=None, weights=None,
+                                 weight_search="grid"):
     if eps is None:
         all_eps = np.linspace(0, 1, 100)
     else:
         all_eps = [eps]
 
-    best_score = -1
-    best_all_scores = None
-    best_eps = -1
-    best_weights = []
     expected = np.array(labels)
 
     n_probs = all_probs.shape[1]
     weight_vals = np.linspace(0.01, 1, 10)
 
-    mci_probs = 1 - all_probs
+    inv_mci_probs = 1 / (1 - all_probs)
 
-    if weights is None:
-        all_combos = itertools.product(weight_vals, repeat=n_probs)
-    else:
-        all_combos = [weights]
-
-    for combo in all_combos:
-        # compute harmonic mean
-        num = np.sum(combo)
-        denom = np.sum(combo * (1 / mci_probs), axis=1)
-        denom = denom + 0.000001
-        harmonic_means = num / denom
-
-        new_eps, all_scores = threshold_probs(
-            labels=expected,
-            probs=harmonic_means,
-            target_metric=target_metric,
-            all_eps=all_eps
+    def harmonic_means(combos):
+        # shape (n, n_combos)
+        num = np.sum(combos, axis=1)
+        denom = np.sum(
+            combos[np.newaxis, :, :] * inv_mci_probs[:, np.newaxis, :],
+            axis=2
         )
-        score = all_scores[target_metric]
-
-        if score > best_score:
-            best_score = score
-            best_all_scores = all_scores
-            best_eps = new_eps
-            best_weights = np.copy(combo)
+        denom = denom + 0.000001
+        return num / denom
 
-    return best_eps, best_weights, best_all_scores
+    return search_weights(
+        labels=expected,
+        combine_fn=harmonic_means,
+        weight_vals=weight_vals,
+        n_probs=n_probs,
+        target_metric=target_metric,
+        all_eps=all_eps,
+        weights=weights,
+        weight_search=weight_search
+    )
 
 
-def threshold_weighted_mean(labels, t0_probs, t1_probs, target_metric, eps=None, weights=None):
+def threshold_weighted_mean(labels, t0_probs, t1_probs, target_metric, eps=None, weights=None,
+                            weight_search="grid"):
     if eps is None:
         all_eps = np.linspace(0, 1, 100)
     else:
         all_eps = [eps]
 
-    best_score = -1
-    best_all_scores = None
-    best_eps = -1
-    best_weights = []
     expected = np.array(labels)
 
     all_probs = np.hstack((
@@ -140,30 +161,22 @@ def threshold_weighted_mean(labels, t0_probs, t1_probs, target_metric, eps=None,
     weight_vals = np.linspace(0.0, 1, 10)
     n_probs = all_probs.shape[1]
 
-    if weights is None:
-        all_combos = itertools.product(weight_vals, repeat=n_probs)
-    else:
-        all_combos = [weights]
-
-    for combo in all_combos:
-        # compute harmonic mean
-        weighted = np.sum(combo * all_probs, axis=1)
-
-        new_eps, all_scores = threshold_probs(
-            labels=expected,
-            probs=weighted,
-            target_metric=target_metric,
-            all_eps=all_eps
+    def weighted_means(combos):
+        return np.sum(
+            combos[np.newaxis, :, :] * all_probs[:, np.newaxis, :],
+            axis=2
         )
-        score = all_scores[target_metric]
-
-        if score > best_score:
-            best_score = score
-            best_all_scores = all_scores
-            best_eps = new_eps
-            best_weights = np.copy(combo)
 
-    return best_eps, best_weights, best_all_scores
+    return search_weights(
+        labels=expected,
+        combine_fn=weighted_means,
+        weight_vals=weight_vals,
+        n_probs=n_probs,
+        target_metric=target_metric,
+        all_eps=all_eps,
+        weights=weights,
+        weight_search=weight_search
+    )
 
 
 def threshold_diff(labels, t0_probs, vagan_probs, target_metric, eps=None):
@@ -258,13 +271,18 @@ def threshold_time_probs(labels, t1_probs, target_metric, eps=None):
 class TwoStepConversion(object):
     def __init__(self, vagan_label, clf_label, split_paths, conversion_delta,
                  vagan_rescale, target_metric, all_steps, n_iterations,
-                 harmonic=False):
+                 harmonic=False, far_prediction_cache_dir=None,
+                 weight_search="grid"):
         """
         Args:
             - vagan_label: sumatra label for VAGAN record
             - clf_label: sumatra label for classifier label
             - split_paths: list of paths to split folders containg
               train-val-test split
+            - far_prediction_cache_dir: optional folder to persist
+              VAGAN far predictions in, shared by all splits and runs
+            - weight_search: 'grid' or 'coordinate', search strategy
+              for the weights of the harmonic mean
         """
         self.vagan_label = vagan_label
         self.clf_label = clf_label
@@ -275,6 +293,8 @@ class TwoStepConversion(object):
         self.all_steps = all_steps
         self.n_iterations = n_iterations
         self.harmonic = harmonic
+        self.far_prediction_cache_dir = far_prediction_cache_dir
+        self.weight_search = weight_search
 
         self.load_models()
 
@@ -302,6 +322,7 @@ class TwoStepConversion(object):
             config = yaml.load(f)
 
         self.vagan_steps = self.conversion_delta
+        self.prob_store = ProbabilityStore()
         self.load_classifier(config)
         self.load_vagan(config)
 
@@ -345,6 +366,11 @@ class TwoStepConversion(object):
             ["health_mci", "health_ad"]
         clf_vagan_config["params"]["streamer"]["params"]["stream_config"]["vagan_rescale"] = \
             self.vagan_rescale
+        clf_vagan_config["params"]["streamer"]["params"]["stream_config"]["cache_far_predictions"] = \
+            True
+        if self.far_prediction_cache_dir is not None:
+            clf_vagan_config["params"]["streamer"]["params"]["stream_config"]["far_prediction_cache_dir"] = \
+                self.far_prediction_cache_dir
 
         self.clf_vagan_obj = SliceClassification(**clf_vagan_config["params"])
         self.clf_vagan_est = tf.estimator.Estimator(
@@ -463,62 +489,55 @@ class TwoStepConversion(object):
              for fid in t0_fids]
         )
 
-    def compute_probs(self, t0_ids, t1_ids):
-        t0_batches = [Group([fid]) for fid in t0_ids]
-        t1_batches = [Group([fid]) for fid in t1_ids]
-
-        t0_input_fn = self.clf_only_obj.streamer.get_input_fn_for_groups(
-            t0_batches
-        )
-        t1_input_fn = self.clf_only_obj.streamer.get_input_fn_for_groups(
-            t1_batches
+    def get_clf_probs(self, fids):
+        return self.prob_store.get_probs(
+            est=self.clf_only_est,
+            streamer=self.clf_only_obj.streamer,
+            fids=fids,
+            variant=("image",)
         )
-        vagan_input_fn = self.clf_vagan_obj.streamer.get_input_fn_for_groups(
-            t0_batches,
-            vagan_steps=self.n_iterations
+
+    def get_vagan_probs(self, fids, vagan_steps):
+        return self.prob_store.get_probs(
+            est=self.clf_vagan_est,
+            streamer=self.clf_vagan_obj.streamer,
+            fids=fids,
+            variant=("vagan", vagan_steps, self.vagan_rescale),
+            vagan_steps=vagan_steps
         )
 
+    def compute_probs(self, t0_ids, t1_ids):
+        t0_probs, t1_probs = self.compute_gt_probs(t0_ids, t1_ids)
+
         return [
-            predict_probabilities(self.clf_only_est, t0_input_fn),
-            predict_probabilities(self.clf_only_est, t1_input_fn),
-            predict_probabilities(self.clf_vagan_est, vagan_input_fn)
+            t0_probs,
+            t1_probs,
+            self.get_vagan_probs(t0_ids, self.n_iterations)
         ]
 
     def compute_gt_probs(self, t0_ids, t1_ids):
-        t0_batches = [Group([fid]) for fid in t0_ids]
-        t1_batches = [Group([fid]) for fid in t1_ids]
-
-        t0_input_fn = self.clf_only_obj.streamer.get_input_fn_for_groups(
-            t0_batches
-        )
-        t1_input_fn = self.clf_only_obj.streamer.get_input_fn_for_groups(
-            t1_batches
-        )
+        # single prediction pass for t0 and t1 images
+        probs = self.get_clf_probs(list(t0_ids) + list(t1_ids))
 
         return [
-            predict_probabilities(self.clf_only_est, t0_input_fn),
-            predict_probabilities(self.clf_only_est, t1_input_fn),
+            probs[:len(t0_ids)],
+            probs[len(t0_ids):],
         ]
 
     def compute_all_probs(self, t0_ids):
         n = len(t0_ids)
         probs = np.zeros((n, self.conversion_delta + 1))
-        t0_batches = [Group([fid]) for fid in t0_ids]
+
+        # Single iterated run, input_fns read every step from the cache
+        self.clf_vagan_obj.streamer.precompute_far_predictions(
+            t0_ids, self.conversion_delta
+        )
 
         for i in range(self.conversion_delta):
-            vagan_input_fn = self.clf_vagan_obj.streamer.get_input_fn_for_groups(
-                t0_batches,
-                vagan_steps=i + 1
-            )
-            probs_i = predict_probabilities(self.clf_vagan_est, vagan_input_fn)
-            probs[:, i + 1] = probs_i
+            probs[:, i + 1] = self.get_vagan_probs(t0_ids, i + 1)
 
         # t0 probs
-        t0_input_fn = self.clf_only_obj.streamer.get_input_fn_for_groups(
-            t0_batches
-        )
-        t0_probs = predict_probabilities(self.clf_only_est, t0_input_fn)
-        probs[:, 0] = t0_probs
+        probs[:, 0] = self.get_clf_probs(t0_ids)
 
         return probs
 
@@ -699,7 +718,7 @@ class TwoStepConversion(object):
             if self.harmonic:
                 best_eps, best_weights, train_scores = threshold_harmonic_all_probs(
                     train_labels, all_vagan_train_probs, self.target_metric,
-                    eps=None, weights=None
+                    eps=None, weights=None, weight_search=self.weight_search
                 )
                 print(">>>>>> harmonic weights")
                 print(best_weights)
@@ -760,7 +779,7 @@ class TwoStepConversion(object):
                 np.reshape(vagan_train_probs, (-1, 1)))
             ),
             self.target_metric,
-            eps=None, weights=None
+            eps=None, weights=None, weight_search=self.weight_search
         )
         print(">>>>>> harmonic t0 t1 weights")
         print(best_weights)
@@ -936,13 +955,15 @@ class TwoStepConversion(object):
 
 class ProbabilityConvergence(TwoStepConversion):
     def __init__(self, vagan_label, clf_label, split_path, time_delta,
-                 conversion_delta, vagan_rescale):
+                 conversion_delta, vagan_rescale,
+                 far_prediction_cache_dir=None):
         self.vagan_label = vagan_label
         self.clf_label = clf_label
         self.split_path = split_path
         self.time_delta = time_delta
         self.conversion_delta = conversion_delta
         self.vagan_rescale = vagan_rescale
+        self.far_prediction_cache_dir = far_prediction_cache_dir
 
         self.load_models()
 
@@ -952,22 +973,16 @@ class ProbabilityConvergence(TwoStepConversion):
     def compute_probs(self, t0_ids):
         n = len(t0_ids)
         probs = np.zeros((n, self.time_delta + 1))
-        t0_batches = [Group([fid]) for fid in t0_ids]
+
+        self.clf_vagan_obj.streamer.precompute_far_predictions(
+            t0_ids, self.time_delta
+        )
 
         for i in range(self.time_delta):
-            vagan_input_fn = self.clf_vagan_obj.streamer.get_input_fn_for_groups(
-                t0_batches,
-                vagan_steps=i + 1
-            )
-            probs_i = predict_probabilities(self.clf_vagan_est, vagan_input_fn)
-            probs[:, i + 1] = probs_i
+            probs[:, i + 1] = self.get_vagan_probs(t0_ids, i + 1)
 
         # t0 probs
-        t0_input_fn = self.clf_only_obj.streamer.get_input_fn_for_groups(
-            t0_batches
-        )
-        t0_probs = predict_probabilities(self.clf_only_est, t0_input_fn)
-        probs[:, 0] = t0_probs
+        probs[:, 0] = self.get_clf_probs(t0_ids)
 
         return probs
     
@@ -1043,12 +1058,14 @@ class ProbabilityConvergence(TwoStepConversion):
 
 
 class NCCComputation(TwoStepConversion):
-    def __init__(self, vagan_label, clf_label, split_path, conversion_delta, vagan_rescale):
+    def __init__(self, vagan_label, clf_label, split_path, conversion_delta, vagan_rescale,
+                 far_prediction_cache_dir=None):
         self.vagan_label = vagan_label
         self.clf_label = clf_label
         self.split_path = split_path
         self.conversion_delta = conversion_delta
         self.vagan_rescale = vagan_rescale
+        self.far_prediction_cache_dir = far_prediction_cache_dir
 
         self.load_models()
 
@@ -1063,16 +1080,22 @@ class NCCComputation(TwoStepConversion):
         return images
 
     def get_fake_t1_images(self, t0_fids):
-        vagan = self.clf_vagan_obj.streamer.wrapper.vagan
+        streamer = self.clf_vagan_obj.streamer
+        if streamer.far_predictions is not None:
+            fid_to_images = streamer.precompute_far_predictions(
+                t0_fids, self.conversion_delta)
+            return [np.array(fid_to_images[fid][self.conversion_delta - 1])
+                    for fid in t0_fids]
+
         t0_images = self.get_images(t0_fids)
-        gen = []
-        for t0_im in t0_images:
-            images, masks = vagan.iterated_far_prediction(
-                t0_im, self.conversion_delta
-            )
-            gen.append(images[-1])
+        images, masks = streamer.wrapper.vagan.iterated_far_prediction_batch(
+            t0_images,
+            self.conversion_delta,
+            batch_size=streamer.get_vagan_batch_size(),
+            only_final=True
+        )
 
-        return gen
+        return list(images)
 
     def print_scores(self, scores):
         print("Mean {}".format(np.mean(scores)))
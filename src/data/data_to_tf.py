@@ -15,6 +15,7 @@ import os
 import glob
 import re
 import datetime
+import multiprocessing
 import nibabel as nib
 import src.features as ft_def
 from src.data.features_store import FeaturesStore
@@ -40,7 +41,7 @@ def get_data_preprocessing_values(config):
         'config': config,
         'modules': {
             'tf_major_version': tf.__version__.split('.')[0],
-            'extractor_version': 1,
+            'extractor_version': 2,
         }
     }
 
@@ -70,16 +71,77 @@ def iter_slices(img_data, config):
         yield img_data
 
 
+TEST_WRITER = 'test'
+
+
+def get_num_workers(config):
+    if 'num_workers' in config:
+        return config['num_workers']
+    return 1
+
+
+def get_mri_encoding(config):
+    """
+    'raw': MRI stored as raw little-endian float32 bytes
+    'float_list': MRI stored as a FloatList
+    """
+    if 'mri_encoding' in config:
+        return config['mri_encoding']
+    return 'raw'
+
+
 class DataAggregatorToTFWriters(DataAggregator):
-    def __init__(self, config, converted_dir, r):
+    """
+    Writes images to the test set and to the train set shards.
+    With config['num_workers'] > 1, images are only assigned to
+    writers here and written by worker processes at the end, every
+    worker owning a disjoint set of shards.
+    """
+    def __init__(self, config, converted_dir, r, writer_keys=None):
+        """
+        Args:
+            - writer_keys: only create these writers, all if None
+        """
         DataAggregator.__init__(
             self,
             config,
             r,
         )
-        self.create_writers(converted_dir, **config['train_dataset_split'])
+        self.converted_dir = converted_dir
+        self.writer_files = self.get_writer_files(
+            **config['train_dataset_split']
+        )
+        self.num_shards = len(self.writer_files) - 1
+        self.parallel = writer_keys is None and get_num_workers(config) > 1
+        self.tasks = []
+        self.writers = {}
+        if not self.parallel:
+            self.create_writers(writer_keys)
+
+    def get_writer_files(self, split_features=[], num_shards=1):
+        """
+        Return:
+            - dictionary mapping TEST_WRITER to the test file and
+              every shard to a dictionary mapping split features
+              ('' for none) to files
+        """
+        writer_files = {TEST_WRITER: self.config['test_database_file']}
+        for shard in range(num_shards):
+            shard_files = {
+                '': self.config['train_database_file'].format(
+                    feature='', shard=shard,
+                )
+            }
+            shard_files.update({
+                ft: self.config['train_database_file'].format(
+                    feature=ft, shard=shard,
+                )
+                for ft in split_features
+            })
+            writer_files[shard] = shard_files
+        return writer_files
 
-    def create_writers(self, converted_dir, split_features=[], num_shards=1):
+    def create_writers(self, writer_keys=None):
         compression = getattr(
             tf.python_io.TFRecordCompressionType,
             self.config['dataset_compression'],
@@ -87,26 +149,52 @@ class DataAggregatorToTFWriters(DataAggregator):
 
         def create_writer(filename):
             return tf.python_io.TFRecordWriter(
-                os.path.join(converted_dir, filename),
+                os.path.join(self.converted_dir, filename),
                 tf.python_io.TFRecordOptions(compression),
             )
-        self.test_writer = create_writer(self.config['test_database_file'])
-        self.train_writers = []
-        for shard in range(num_shards):
-            shard_writers = {
-                '': create_writer(self.config['train_database_file'].format(
-                            feature='', shard=shard,
-                    ))
-            }
-            shard_writers.update({
-                ft: create_writer(self.config['train_database_file'].format(
-                            feature=ft, shard=shard,
-                    ))
-                for ft in split_features
-            })
-            self.train_writers.append(shard_writers)
+        if writer_keys is None:
+            writer_keys = self.writer_files.keys()
+        for key in writer_keys:
+            if key == TEST_WRITER:
+                self.writers[key] = create_writer(self.writer_files[key])
+            else:
+                self.writers[key] = {
+                    ft: create_writer(f)
+                    for ft, f in self.writer_files[key].items()
+                }
 
     def _add_image(self, image_path, features):
+        if self.parallel:
+            # The writer is only drawn for images with a valid shape,
+            # like in a single process. Loading the header is enough.
+            if not self.check_image_shape(
+                    image_path, nib.load(image_path).shape):
+                return False
+            # written and counted by the workers
+            self.tasks.append((
+                self.curr_study_name,
+                image_path,
+                features,
+                self.get_writer_key(features),
+            ))
+            return False
+        return self._write_image_file(image_path, features)
+
+    def check_image_shape(self, image_path, shape):
+        if list(shape) != list(self.config['image_shape']):
+            self.add_error(
+                image_path,
+                'Image has shape %s, expected %s' % (
+                    shape, self.config['image_shape'])
+            )
+            return False
+        return True
+
+    def _write_image_file(self, image_path, features, writer_key=None):
+        """
+        Args:
+            - writer_key: drawn after the shape check if None
+        """
         Feature = tf.train.Feature
         Int64List = tf.train.Int64List
 
@@ -131,15 +219,12 @@ class DataAggregatorToTFWriters(DataAggregator):
         })
 
         img_data = nib.load(image_path).get_data()
-        if list(img_data.shape) != list(self.config['image_shape']):
-            self.add_error(
-                image_path,
-                'Image has shape %s, expected %s' % (
-                    img_data.shape, self.config['image_shape'])
-            )
+        if not self.check_image_shape(image_path, img_data.shape):
             return False
 
-        writer = self.get_writer_for_image(features)
+        if writer_key is None:
+            writer_key = self.get_writer_key(features)
+        writer = self.get_writer(writer_key)
         if writer is None:
             self.add_error(image_path, 'Image has no writer')
             return False
@@ -160,27 +245,55 @@ class DataAggregatorToTFWriters(DataAggregator):
                 return False
         return True
 
-    def get_writer_for_image(self, features):
+    def get_writer_key(self, features):
+        """
+        Return:
+            - TEST_WRITER or (shard, split feature)
+        """
         train_or_test = self.get_sample_dataset(features)
         if train_or_test == 'test':
-            return self.test_writer
+            return TEST_WRITER
         # Train set is sharded + splitted by feature
-        shard_writers = self.r.choice(self.train_writers)
-        for k, v in shard_writers.items():
+        shard = self.r.choice(range(self.num_shards))
+        for k in self.writer_files[shard].keys():
             if k == '':
                 continue
             assert(k in features)
             if features[k]:
-                return v
-        return shard_writers['']
+                return (shard, k)
+        return (shard, '')
+
+    def get_writer(self, writer_key):
+        if writer_key == TEST_WRITER:
+            return self.writers[TEST_WRITER]
+        shard, ft = writer_key
+        return self.writers[shard][ft]
+
+    def get_writer_owner(self, shard, num_workers):
+        """
+        Args:
+            - shard: TEST_WRITER or shard index
+        Return:
+            - index of the worker writing this shard
+        """
+        if shard == TEST_WRITER:
+            return self.num_shards % num_workers
+        return shard % num_workers
 
     def _write_image(self, writer, img_data, img_features, image_path):
         image_data = self.process_image_data(img_data, image_path)
-        img_features[ft_def.MRI] = tf.train.Feature(
-            float_list=tf.train.FloatList(
-                value=img_data.reshape([-1])
-            ),
-        )
+        if get_mri_encoding(self.config) == 'raw':
+            img_features[ft_def.MRI] = tf.train.Feature(
+                bytes_list=tf.train.BytesList(value=[
+                    np.asarray(img_data, dtype='<f4').tobytes()
+                ]),
+            )
+        else:
+            img_features[ft_def.MRI] = tf.train.Feature(
+                float_list=tf.train.FloatList(
+                    value=img_data.reshape([-1])
+                ),
+            )
         assert(all([
             ft_name in img_features
             for ft_name, ft_info in ft_def.all_features.feature_info.items()
@@ -191,14 +304,89 @@ class DataAggregatorToTFWriters(DataAggregator):
         )
         writer.write(example.SerializeToString())
 
+    def write_tasks(self, tasks):
+        """
+        Writes the images of tasks assigned by a parent aggregator.
+
+        Return:
+            - stats of the written images by study
+        """
+        for study_name, image_path, features, writer_key in tasks:
+            if study_name not in self.stats:
+                self.stats[study_name] = {
+                    'success': 0,
+                    'errors': []
+                }
+            self.curr_study_name = study_name
+            if self._write_image_file(image_path, features, writer_key):
+                self.stats[study_name]['success'] += 1
+        self.close_writers()
+        return self.stats
+
+    def run_workers(self):
+        num_workers = min(
+            get_num_workers(self.config),
+            len(self.writer_files),
+        )
+        worker_keys = [[] for _ in range(num_workers)]
+        for key in self.writer_files.keys():
+            worker_keys[self.get_writer_owner(key, num_workers)].append(key)
+        worker_tasks = [[] for _ in range(num_workers)]
+        for task in self.tasks:
+            writer_key = task[3]
+            shard = writer_key if writer_key == TEST_WRITER else writer_key[0]
+            worker_tasks[self.get_writer_owner(shard, num_workers)].append(
+                task
+            )
+
+        UniqueLogger.log('[INFO] Writing %d images with %d workers' % (
+            len(self.tasks), num_workers))
+        # spawn, tensorflow is not fork safe
+        pool = multiprocessing.get_context('spawn').Pool(num_workers)
+        try:
+            all_stats = pool.starmap(write_shards, [
+                (self.config, self.converted_dir, worker_keys[w],
+                    worker_tasks[w])
+                for w in range(num_workers)
+            ])
+        finally:
+            pool.close()
+            pool.join()
+
+        for stats in all_stats:
+            for study_name, study_stats in stats.items():
+                self.stats[study_name]['success'] += study_stats['success']
+                self.stats[study_name]['errors'] += study_stats['errors']
+
+    def close_writers(self):
+        for key, writer in self.writers.items():
+            if key == TEST_WRITER:
+                writer.close()
+            else:
+                for w in writer.values():
+                    w.close()
+
     def finish(self):
-        self.test_writer.close()
-        for shard_writers in self.train_writers:
-            for w in shard_writers.values():
-                w.close()
+        if self.parallel:
+            self.run_workers()
+        else:
+            self.close_writers()
         DataAggregator.finish(self)
 
 
+def write_shards(config, converted_dir, writer_keys, tasks):
+    """
+    Worker process writing the given shards.
+    """
+    agg = DataAggregatorToTFWriters(
+        config,
+        converted_dir,
+        None,
+        writer_keys=writer_keys,
+    )
+    return agg.write_tasks(tasks)
+
+
 class DataSource(object):
     def __init__(
         self,
@@ -5,6 +5,11 @@ import subprocess
 import xml.etree.ElementTree as ET
 import json
 import pickle
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from shutil import copyfile
 import nibabel as nib
 from modules.models.utils import custom_print
@@ -50,6 +55,10 @@ class MriPreprocessingPipeline(object):
             '$path/01_brain_extracted/I{image_id}.nii.gz'
         2. Register brains to a template in
             '$path/02_registered/I{image_id}.nii.gz'
+
+    Every (image, step) pair is a task. With workers set, tasks run
+    concurrently in a pool and a step only starts once the step
+    writing its from_subfolder is done for the same image.
     """
 
     def __init__(
@@ -64,6 +73,7 @@ class MriPreprocessingPipeline(object):
         shard=None,
         steps=[],
         split_train_test=None,
+        workers=None,
     ):
         self.path = path
         self.steps = steps
@@ -78,10 +88,16 @@ class MriPreprocessingPipeline(object):
         self.set_all_single_class = None
         self.image_id_to_patient_id = {}
         self.image_id_counter = 0
+        self.num_workers = 1
+        self.journal_path = None
+        self.continue_on_failure = False
+        self.check_exit_codes = False
         if filter_xml is not None:
             self.filter_xml(**filter_xml)
         if shard is not None:
             self.shard(**shard)
+        if workers is not None:
+            self.setup_workers(**workers)
 
     def filter_xml(self, files, xml_image_id, filters, xml_class=None, xml_patient_id=None):
         self.image_id_enabled = set()
@@ -124,6 +140,31 @@ class MriPreprocessingPipeline(object):
             if (i % num_workers) == worker_index
         ]
 
+    def setup_workers(self, num_workers, journal=None, continue_on_failure=False,
+                      check_exit_codes=False):
+        """
+        Args:
+            - num_workers: number of tasks run concurrently
+            - journal: name of a file in $path recording finished
+              tasks. Finished tasks are not run again, even if their
+              step has overwrite set, unless their output is missing
+              or a task they depend on is run again. An existing
+              output without a finished entry (e.g. from an
+              interrupted run) is always redone.
+            - continue_on_failure: if True, a failed task is recorded
+              and the tasks depending on it are skipped, otherwise the
+              error is raised
+            - check_exit_codes: if True, a command exiting with a
+              non-zero code makes its task fail. By default the exit
+              code is only printed.
+        """
+        custom_print('WORKERS: %s' % num_workers)
+        self.num_workers = num_workers
+        self.continue_on_failure = continue_on_failure
+        self.check_exit_codes = check_exit_codes
+        if journal is not None:
+            self.journal_path = os.path.join(self.path, journal)
+
     def transform(self, X=None):
         steps_registered = {
             'no_operation': self.no_operation,
@@ -138,6 +179,7 @@ class MriPreprocessingPipeline(object):
             self._mkdir(step['subfolder'])
         custom_print('Applying MRI pipeline to %s files' % (len(self.files)))
         all_images_ids = []
+        tasks = []
         for i, mri_raw in enumerate(self.files):
             image_id, patient_id = self.extract_image_and_patient(mri_raw)
             custom_print('Image %s/%s [image_id = %s]' % (
@@ -147,37 +189,203 @@ class MriPreprocessingPipeline(object):
                     custom_print('... Skipped')
                     continue
 
-            for step_id, step in enumerate(self.steps):
-                if 'skip' in step:
-                    continue
-                if step['from_subfolder'] == 'raw':
-                    path_from = mri_raw
-                else:
-                    path_from = os.path.join(
-                        self.path,
-                        step['from_subfolder'],
-                        'I{image_id}.nii.gz'.format(image_id=image_id),
-                    )
-                path_to = os.path.join(
+            tasks += self.make_image_tasks(mri_raw, image_id, len(tasks))
+            all_images_ids.append(image_id)
+
+        self.run_tasks(tasks, steps_registered)
+
+        # Split train/test
+        if self.split_train_test is not None:
+            self.do_split_train_test(all_images_ids, **self.split_train_test)
+
+    def make_image_tasks(self, mri_raw, image_id, first_index):
+        """
+        Args:
+            - mri_raw: path of the raw image
+            - image_id: ID of the image
+            - first_index: index of the first returned task
+              in the list of all tasks
+        Return:
+            - list of tasks, 'deps' contains the indices of the tasks
+              that have to be done before the task can run
+        """
+        tasks = []
+        # index of the last task writing to a subfolder
+        subfolder_to_task = {}
+        for step_id, step in enumerate(self.steps):
+            if 'skip' in step:
+                continue
+            if step['from_subfolder'] == 'raw':
+                path_from = mri_raw
+            else:
+                path_from = os.path.join(
                     self.path,
-                    step['subfolder'],
+                    step['from_subfolder'],
                     'I{image_id}.nii.gz'.format(image_id=image_id),
                 )
-                if not os.path.exists(path_from):
-                    continue
-                if os.path.exists(path_to) and not step['overwrite']:
-                    continue
+            path_to = os.path.join(
+                self.path,
+                step['subfolder'],
+                'I{image_id}.nii.gz'.format(image_id=image_id),
+            )
+            deps = []
+            if step['from_subfolder'] in subfolder_to_task:
+                deps.append(subfolder_to_task[step['from_subfolder']])
+
+            subfolder_to_task[step['subfolder']] = first_index + len(tasks)
+            tasks.append({
+                'key': self._task_key(image_id, step),
+                'image_id': image_id,
+                'step_id': step_id,
+                'step': step,
+                'path_from': path_from,
+                'path_to': path_to,
+                'deps': deps,
+            })
+
+        return tasks
+
+    def run_tasks(self, tasks, steps_registered):
+        """
+        Run tasks in order if there is one worker, otherwise in a
+        thread pool (the steps mostly wait for external commands).
+        """
+        done_keys = self._load_journal()
+        timings = OrderedDict()
+        failed = []
+        skipped = []
+        # indices of the tasks whose input is recomputed in this run
+        stale = set()
+        lock = threading.Lock()
+
+        dependents = [[] for _ in tasks]
+        for i, task in enumerate(tasks):
+            for d in task['deps']:
+                dependents[d].append(i)
+
+        def _is_complete(i):
+            task = tasks[i]
+            if not os.path.exists(task['path_to']):
+                return False
+            with lock:
+                if i in stale:
+                    return False
+            if self.journal_path is not None:
+                return task['key'] in done_keys
+            return not task['step']['overwrite']
+
+        def _run(i):
+            """
+            Return:
+                - False if the task failed
+            """
+            task = tasks[i]
+            step = task['step']
+            if not os.path.exists(task['path_from']):
+                return True
+            if _is_complete(i):
+                return True
+
+            with lock:
+                # outputs of the dependents are outdated
+                stale.update(dependents[i])
+            t0 = time.time()
+            try:
                 steps_registered[step['type']](
-                    path_from,
-                    path_to,
-                    image_id,
+                    task['path_from'],
+                    task['path_to'],
+                    task['image_id'],
                     step,
                 )
-            all_images_ids.append(image_id)
-
-        # Split train/test
-        if self.split_train_test is not None:
-            self.do_split_train_test(all_images_ids, **self.split_train_test)
+                status = 'done'
+            except Exception as e:
+                custom_print('[Failed] I%s step %s: %s' % (
+                    task['image_id'], task['step_id'], e))
+                status = 'failed'
+                if not self.continue_on_failure:
+                    with lock:
+                        self._write_journal(task, status, time.time() - t0)
+                    raise
+            seconds = time.time() - t0
+
+            with lock:
+                if status == 'failed':
+                    failed.append(task)
+                if task['step_id'] not in timings:
+                    timings[task['step_id']] = []
+                timings[task['step_id']].append(seconds)
+                self._write_journal(task, status, seconds)
+            return status == 'done'
+
+        def _skip(task):
+            custom_print('[Skipped] I%s step %s: a previous step failed' % (
+                task['image_id'], task['step_id']))
+            with lock:
+                skipped.append(task)
+                self._write_journal(task, 'skipped', 0.)
+
+        if self.num_workers <= 1:
+            # indices of the tasks which failed or were skipped
+            blocked = set()
+            for i, task in enumerate(tasks):
+                if any(d in blocked for d in task['deps']):
+                    _skip(task)
+                    blocked.add(i)
+                elif not _run(i):
+                    blocked.add(i)
+        else:
+            n_deps = [len(task['deps']) for task in tasks]
+            with ThreadPoolExecutor(max_workers=self.num_workers) as pool:
+                future_to_task = {}
+                pending = set()
+                blocked = set()
+
+                def _release(i, succeeded):
+                    for j in dependents[i]:
+                        n_deps[j] -= 1
+                        if not succeeded:
+                            blocked.add(j)
+                        if n_deps[j] > 0:
+                            continue
+                        if j in blocked:
+                            _skip(tasks[j])
+                            _release(j, False)
+                        else:
+                            future = pool.submit(_run, j)
+                            future_to_task[future] = j
+                            pending.add(future)
+
+                for i in range(len(tasks)):
+                    if n_deps[i] == 0:
+                        future = pool.submit(_run, i)
+                        future_to_task[future] = i
+                        pending.add(future)
+                while len(pending) > 0:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for f in done:
+                        try:
+                            succeeded = f.result()
+                        except Exception:
+                            # do not wait for the queued tasks
+                            for p in pending:
+                                p.cancel()
+                            raise
+                        _release(future_to_task.pop(f), succeeded)
+
+        self.print_timings(timings)
+        if len(failed) > 0:
+            custom_print('%s tasks failed, %s skipped' % (
+                len(failed), len(skipped)))
+
+    def print_timings(self, timings):
+        for step_id, seconds in timings.items():
+            step = self.steps[step_id]
+            custom_print(
+                '[Timing] step %s (%s -> %s): %s tasks, total %.1fs, '
+                'mean %.1fs, max %.1fs' % (
+                    step_id, step['type'], step['subfolder'], len(seconds),
+                    sum(seconds), sum(seconds) / len(seconds), max(seconds),
+                ))
 
     def extract_image_and_patient(self, mri_raw):
         if self.regexp_image_id_group is not None:
@@ -392,11 +600,56 @@ class MriPreprocessingPipeline(object):
         self._exec(cmd)
 
     # ------------------------- Utils and wrappers
+    def _task_key(self, image_id, step):
+        step_hash = hashlib.sha1(
+            json.dumps(step, sort_keys=True).encode('utf-8')
+        ).hexdigest()
+        return 'I%s/%s' % (image_id, step_hash)
+
+    def _load_journal(self):
+        """
+        Return:
+            - set of keys of the tasks whose last entry in the
+              journal is done
+        """
+        done_keys = set()
+        if self.journal_path is None or not os.path.exists(self.journal_path):
+            return done_keys
+
+        with open(self.journal_path, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # partially written last line
+                    continue
+                if entry['status'] == 'done':
+                    done_keys.add(entry['task'])
+                else:
+                    done_keys.discard(entry['task'])
+        return done_keys
+
+    def _write_journal(self, task, status, seconds):
+        if self.journal_path is None:
+            return
+        with open(self.journal_path, 'a') as f:
+            f.write(json.dumps({
+                'task': task['key'],
+                'step': task['step_id'],
+                'status': status,
+                'seconds': round(seconds, 3),
+            }) + '\n')
+
     def _exec(self, cmd):
         custom_print('[Exec] ' + cmd)
         os.environ['FSLOUTPUTTYPE'] = 'NIFTI_GZ'
         os.environ['FSLDIR'] = '/local/fsl'
-        subprocess.call(cmd, shell=True)
+        returncode = subprocess.call(cmd, shell=True)
+        if returncode != 0:
+            custom_print('[Exec] exit code %s' % returncode)
+            # failed commands are not journaled as done
+            if self.check_exit_codes:
+                raise subprocess.CalledProcessError(returncode, cmd)
 
     def _get_bvecs_bvals(self, mri):
         return [
@@ -2,7 +2,8 @@ import os
 import numpy as np
 import tensorflow as tf
 import src.features as ft_def
-from src.data.data_to_tf import generate_tf_dataset, iter_slices
+from src.data.data_to_tf import generate_tf_dataset, iter_slices, \
+    get_mri_encoding
 
 
 # Functions for Data Provider interface
@@ -44,20 +45,28 @@ class DataProvider(object):
 # End of interface functions
 
 
-def parse_record(record):
+def parse_record(record, mri_encoding='float_list'):
     # MRI image shape should be set at this point (taken from generator config)
     assert(ft_def.all_features.feature_info[ft_def.MRI]['shape'] != [])
     keys_to_features = {
         name: tf.FixedLenFeature(shape=info['shape'], dtype=info['type'])
         for name, info in ft_def.all_features.feature_info.items()
     }
+    if mri_encoding == 'raw':
+        keys_to_features[ft_def.MRI] = tf.FixedLenFeature(
+            shape=[], dtype=tf.string,
+        )
 
     parsed = tf.parse_single_example(record, features=keys_to_features)
+    if mri_encoding == 'raw':
+        parsed[ft_def.MRI] = tf.decode_raw(
+            parsed[ft_def.MRI], tf.float32, little_endian=True,
+        )
     return parsed
 
 
-def parser(record):
-    parsed = parse_record(record)
+def parser(record, mri_encoding='float_list'):
+    parsed = parse_record(record, mri_encoding)
 
     def process_feature(ft, ft_info):
         return tf.reshape(ft, ft_info['shape'])
@@ -152,5 +161,9 @@ def input_iterator(
             dataset = get_dataset('train_s{shard}.tfrecord'.format(
                 shard=shard[0]
             )).shuffle(buffer_size=100, seed=shuffle_seed)
-    dataset = dataset.map(parser, num_parallel_calls=8)
+    mri_encoding = get_mri_encoding(config_data_generation)
+    dataset = dataset.map(
+        lambda r: parser(r, mri_encoding),
+        num_parallel_calls=8,
+    )
     return gen_dataset_iterator(config_data_streaming['dataset'], dataset)
@@ -13,6 +13,9 @@ from collections import OrderedDict
 import pandas as pd
 
 from . import features as _features
+from .meta_table import MetaTable, DIAGNOSES
+from .caching import config_hash, directory_signature, file_digest, \
+    get_streamer_state
 
 
 class FileStream(abc.ABC):
@@ -42,10 +45,6 @@ class FileStream(abc.ABC):
         if self.seed is not None:
             self.np_random = np.random.RandomState(seed=self.seed)
 
-        # Parse meta information
-        self.file_id_to_meta = self.parse_meta_csv()
-        csv_len = len(self.file_id_to_meta)
-
         self.name_to_data_source = OrderedDict()
         # Create datasources
         for ds in self.data_sources_list:
@@ -55,34 +54,21 @@ class FileStream(abc.ABC):
                 id_from_filename=ds["id_from_filename"]
             )
             self.name_to_data_source[ds["name"]] = d
-
-        # Match files with meta information, only data specified
-        # in csv file is used
-        self.all_file_paths = []
-        if self.debugging():
-            self.all_file_paths += list(self.file_id_to_meta.keys())
-        n_files_not_used = 0
-        for name in self.name_to_data_source:
-            ds = self.name_to_data_source[name]
-            new_paths = ds.get_file_paths()
             if not self.silent:
-                print("{} has {} files".format(name, len(new_paths)))
-            # Add path as meta information
-            for p in new_paths:
-                image_label = ds.get_file_image_label(p)
-                if image_label in self.file_id_to_meta:
-                    self.file_id_to_meta[p] = copy.deepcopy(
-                        self.file_id_to_meta[image_label]
-                    )
-                    self.file_id_to_meta[p]["file_path"] = p
-                    # store file name
-                    # extract filename without extensions
-                    file_name = os.path.split(p)[-1]
-                    file_name = file_name.split(".")[0]
-                    self.file_id_to_meta[p]["file_name"] = file_name
-                    self.all_file_paths.append(p)
-                else:
-                    n_files_not_used += 1
+                print("{} has {} files".format(
+                    ds["name"], len(d.get_file_paths())
+                ))
+
+        # Parse meta information and match files with it, the
+        # meta table is shared by streamers and must not be modified
+        self.file_id_to_meta, all_file_paths, n_files_not_used = \
+            get_streamer_state(
+                self.get_meta_state_key(),
+                self.get_meta_state_signature(),
+                self.match_files
+            )
+        self.all_file_paths = list(all_file_paths)
+        csv_len = len(self.file_id_to_meta.id_to_row)
 
         self.all_file_ids = set(self.all_file_paths)
 
@@ -108,41 +94,8 @@ class FileStream(abc.ABC):
         self.all_file_ids = sorted(list(set(self.select_file_ids(self.all_file_ids))))
         if not self.silent:
             print("Splitting {} images".format(len(self.all_file_ids)))
-        # Make train-test split
-        all_patient_groups = self.make_patient_groups(fids=self.all_file_ids)
-
         if not self.do_load_split():
-            train_ids, test_ids = self.make_train_test_split(
-                all_patient_groups
-            )
-            all_train_test_ids = set(train_ids + test_ids)
-            assert len(train_ids) + len(test_ids) == len(self.all_file_ids)
-            # all files are used
-            assert len(set(self.all_file_ids).difference(all_train_test_ids)) == 0
-            # Exchange train and test set
-            if "exchange_train_test" in self.config and self.config["exchange_train_test"]:
-                tmp = train_ids
-                train_ids = test_ids
-                test_ids = tmp
-
-            # build validation set
-            train_groups = self.make_patient_groups(fids=train_ids)
-            train_ids, validation_ids = self.make_train_test_split(
-                train_groups
-            )
-
-            train_ids, validation_ids, test_ids = self.rebalance_ids(
-                train_ids=train_ids,
-                validation_ids=validation_ids,
-                test_ids=test_ids
-            )
-
-            assert len(train_ids) + len(validation_ids) + len(test_ids) == \
-                len(self.all_file_ids)
-            train_set = set(train_ids)
-            val_set = set(validation_ids)
-            test_set = set(test_ids)
-            assert (train_set | val_set | test_set) == set(self.all_file_ids)
+            train_ids, validation_ids, test_ids = self.get_split()
         else:
             print(">>>>>>> Loading split")
             train_ids, validation_ids, test_ids = self.load_split()
@@ -177,6 +130,158 @@ class FileStream(abc.ABC):
             print(">>>>>>>> Test stats")
             self.print_stats(self.test_groups)
 
+    def get_split_config(self):
+        """
+        Config fields read by make_split. Fields selecting the images
+        (e.g. use_diagnoses) are covered by the selected file IDs.
+        """
+        keys = [
+            "seed",
+            "n_folds",
+            "test_fold",
+            "train_ratio",
+            "balanced_labels",
+            "categorical_split",
+            "numerical_split",
+            "exchange_train_test",
+        ]
+        return {k: self.config[k] for k in keys if k in self.config}
+
+    def get_split(self):
+        """
+        Train, validation and test IDs of the split, shared by the
+        streamers of the process with the same class, split config
+        and selected images (e.g. the streamers of a collection that
+        only differ in how they pair images).
+        The random state after splitting is restored as well, such that
+        streamers behave the same as if the split was computed again.
+        Without seed, every streamer draws its own split.
+        """
+        if self.seed is None:
+            return self.make_split()[:3]
+
+        try:
+            key = config_hash({
+                "state": "split",
+                "class": type(self).__module__ + "." + type(self).__name__,
+                "split_config": self.get_split_config(),
+                "file_ids": list(self.all_file_ids),
+                "meta": self.get_meta_state_key()
+            })
+        except TypeError:
+            # config is not json serializable
+            return self.make_split()[:3]
+
+        train_ids, validation_ids, test_ids, random_state = \
+            get_streamer_state(
+                key,
+                self.get_meta_state_signature(),
+                self.make_split
+            )
+        if random_state is not None:
+            self.np_random.set_state(random_state)
+
+        return list(train_ids), list(validation_ids), list(test_ids)
+
+    def get_random_state(self):
+        if self.seed is None:
+            return None
+        return self.np_random.get_state()
+
+    def make_split(self):
+        """
+        Return:
+            - train IDs, validation IDs, test IDs and the random
+              state after splitting
+        """
+        # Make train-test split
+        all_patient_groups = self.make_patient_groups(fids=self.all_file_ids)
+        train_ids, test_ids = self.make_train_test_split(
+            all_patient_groups
+        )
+        all_train_test_ids = set(train_ids + test_ids)
+        assert len(train_ids) + len(test_ids) == len(self.all_file_ids)
+        # all files are used
+        assert len(set(self.all_file_ids).difference(all_train_test_ids)) == 0
+        # Exchange train and test set
+        if "exchange_train_test" in self.config and self.config["exchange_train_test"]:
+            tmp = train_ids
+            train_ids = test_ids
+            test_ids = tmp
+
+        # build validation set
+        train_groups = self.make_patient_groups(fids=train_ids)
+        train_ids, validation_ids = self.make_train_test_split(
+            train_groups
+        )
+
+        train_ids, validation_ids, test_ids = self.rebalance_ids(
+            train_ids=train_ids,
+            validation_ids=validation_ids,
+            test_ids=test_ids
+        )
+
+        assert len(train_ids) + len(validation_ids) + len(test_ids) == \
+            len(self.all_file_ids)
+        train_set = set(train_ids)
+        val_set = set(validation_ids)
+        test_set = set(test_ids)
+        assert (train_set | val_set | test_set) == set(self.all_file_ids)
+
+        return train_ids, validation_ids, test_ids, self.get_random_state()
+
+    def get_meta_state_key(self):
+        feature_collection = None
+        if "feature_collection" in self.config:
+            feature_collection = self.config["feature_collection"]
+
+        return config_hash({
+            "state": "meta",
+            "meta_csv": os.path.abspath(self.meta_csv),
+            "meta_id_column": self.meta_id_column,
+            "feature_collection": feature_collection,
+            "debugging": self.debugging(),
+            "data_sources": self.data_sources_list
+        })
+
+    def get_meta_state_signature(self):
+        return (
+            file_digest(self.meta_csv),
+            tuple(ds.signature for ds in self.name_to_data_source.values())
+        )
+
+    def match_files(self):
+        """
+        Match files with meta information, only data specified
+        in csv file is used.
+
+        Return:
+            - MetaTable containing the csv rows and matched files
+            - list of matched file paths
+            - number of files not in the csv
+        """
+        meta_table = self.parse_meta_csv()
+
+        all_file_paths = []
+        if self.debugging():
+            all_file_paths += list(meta_table.keys())
+        n_files_not_used = 0
+        for ds in self.name_to_data_source.values():
+            # Add path as meta information
+            for p in ds.get_file_paths():
+                image_label = ds.get_file_image_label(p)
+                if image_label in meta_table:
+                    # store file name
+                    # extract filename without extensions
+                    file_name = os.path.split(p)[-1]
+                    file_name = file_name.split(".")[0]
+                    meta_table.add_file(p, image_label, file_name)
+                    all_file_paths.append(p)
+                else:
+                    n_files_not_used += 1
+
+        return meta_table, all_file_paths, n_files_not_used
+
     def get_number_train_batches(self):
         n_samples = len(self.train_groups)
         n_batches = int(n_samples / self.batch_size)
@@ -247,6 +352,9 @@ class FileStream(abc.ABC):
     def load_sample(self, file_path):
         pass
 
+    def load_sample_by_id(self, file_id):
+        return self.load_sample(self.get_file_path(file_id))
+
     def do_cache_images(self):
         return "cache_images" in self.config and self.config["cache_images"]
 
@@ -550,6 +658,8 @@ class FileStream(abc.ABC):
         """
         Parse the csv file containing the meta information about the
         data.
+        Return:
+            - MetaTable, rows are keyed by meta_id_column
         """
         meta_info = OrderedDict()
         with open(self.meta_csv) as csvfile:
@@ -567,7 +677,7 @@ class FileStream(abc.ABC):
 
                 meta_info[key] = row
 
-        return meta_info
+        return MetaTable(meta_info)
 
     def debugging(self):
         return "test_streamer" in self.config and self.config["test_streamer"]
@@ -581,8 +691,15 @@ class FileStream(abc.ABC):
     def select_file_ids(self, file_ids):
         # Only use specified diagnoses
         diagnoses = self.config["use_diagnoses"]
-        selected = [fid for fid in file_ids
-                    if self.get_diagnose(fid) in diagnoses]
+        file_ids = list(file_ids)
+        codes = self.file_id_to_meta.get_diagnosis_codes(file_ids)
+        missing = np.nonzero(codes < 0)[0]
+        if len(missing) > 0:
+            # like get_diagnose
+            raise ValueError("diagnosis not found for id {}".format(
+                file_ids[missing[0]]
+            ))
+        selected = self.file_id_to_meta.select(file_ids, diagnoses=diagnoses)
 
         # For debugging purposes
         if "select_max" in self.config:
@@ -696,39 +813,29 @@ class FileStream(abc.ABC):
         Return:
             - file path for the given id
         """
-        return self.file_id_to_meta[file_id]["file_path"]
+        return self.file_id_to_meta.get_value(file_id, "file_path")
 
     def get_diagnose(self, file_id):
-        record = self.file_id_to_meta[file_id]
-        if record["health_ad"] == 1:
-            return "health_ad"
-        if record["healthy"] == 1:
-            return "healthy"
-        if record["health_mci"] == 1:
-            return "health_mci"
+        code = self.file_id_to_meta.get_diagnosis_code(file_id)
+        if code >= 0:
+            return DIAGNOSES[code]
 
         raise ValueError("diagnosis not found for id {}".format(file_id))
 
     def get_patient_id(self, file_id):
-        record = self.file_id_to_meta[file_id]
-        return record["patient_label"]
+        return self.file_id_to_meta.get_value(file_id, "patient_label")
 
     def get_age(self, file_id):
-        record = self.file_id_to_meta[file_id]
-        return record["age"]
+        return self.file_id_to_meta.get_value(file_id, "age")
 
     def get_exact_age(self, file_id):
-        record = self.file_id_to_meta[file_id]
-        #print(record)
-        return record["age_exact"]
+        return self.file_id_to_meta.get_value(file_id, "age_exact")
 
     def get_gender(self, file_id):
-        record = self.file_id_to_meta[file_id]
-        return record["sex"]
+        return self.file_id_to_meta.get_value(file_id, "sex")
 
     def get_patient_label(self, file_id):
-        record = self.file_id_to_meta[file_id]
-        return record["patient_label"]
+        return self.file_id_to_meta.get_value(file_id, "patient_label")
 
     def get_sample_shape(self):
         assert len(self.groups) > 0
@@ -744,16 +851,13 @@ class FileStream(abc.ABC):
         return reduce(lambda x, y: x * y, shape)
 
     def get_image_label(self, file_id):
-        record = self.file_id_to_meta[file_id]
-        return record["image_label"]
+        return self.file_id_to_meta.get_value(file_id, "image_label")
 
     def get_file_name(self, file_id):
-        record = self.file_id_to_meta[file_id]
-        return record["file_name"]
+        return self.file_id_to_meta.get_value(file_id, "file_name")
 
     def get_meta_info_by_key(self, file_id, key):
-        record = self.file_id_to_meta[file_id]
-        return record[key]
+        return self.file_id_to_meta.get_value(file_id, key)
 
     def produce_groups(self, fids, group_size, train):
         if len(fids) == 0:
@@ -852,10 +956,11 @@ class FileStream(abc.ABC):
             file_ids = [fid.decode('utf-8') for fid in file_ids]
             ret = []
             for fid in file_ids:
-                path = self.get_file_path(fid)
-
                 file_features = self.file_id_to_meta[fid]
-                image = self.load_sample(path).astype(np.float32)
+                image = self.load_sample_by_id(fid).astype(
+                    np.float32,
+                    copy=False
+                )
 
                 ret += [image]
 
@@ -963,10 +1068,11 @@ class FileStream(abc.ABC):
             file_ids = [fid.decode('utf-8') for fid in file_ids]
             ret = []
             for fid in file_ids:
-                path = self.get_file_path(fid)
-
                 file_features = self.file_id_to_meta[fid]
-                image = self.load_sample(path).astype(np.float32)
+                image = self.load_sample_by_id(fid).astype(
+                    np.float32,
+                    copy=False
+                )
 
                 ret += [image]
 
@@ -1130,11 +1236,29 @@ class DataSource(object):
         """
         Map file IDs to corresponding file paths, and file paths
         to file IDs.
+        The listing is shared by all data sources of the process
+        with the same pattern and redone if a matched directory
+        was modified.
+        """
+        key = config_hash({
+            "state": "data_source",
+            "glob_pattern": self.glob_pattern,
+            "id_from_filename": self.id_from_filename
+        })
+        self.signature = directory_signature(self.glob_pattern)
+        self.file_paths, self.file_path_to_image_label = get_streamer_state(
+            key,
+            self.signature,
+            self.list_files
+        )
+
+    def list_files(self):
+        """
         Raises an error for encountered invalid file names.
         """
         paths = glob.glob(self.glob_pattern)
-        self.file_paths = []
-        self.file_path_to_image_label = OrderedDict()
+        file_paths = []
+        file_path_to_image_label = OrderedDict()
 
         regexp = re.compile(self.id_from_filename["regexp"])
         group_id = self.id_from_filename["regex_id_group"]
@@ -1148,13 +1272,15 @@ class DataSource(object):
             else:
                 # extract image_label
                 image_label = match.group(group_id)
-                self.file_paths.append(p)
-                self.file_path_to_image_label[p] = image_label
+                file_paths.append(p)
+                file_path_to_image_label[p] = image_label
 
         if discarded > 0:
             warnings.warn("!!! {} IDs WERE NOT EXTRACTED !!!"
                           .format(discarded))
 
+        return file_paths, file_path_to_image_label
+
     def get_file_paths(self):
         return self.file_paths
 
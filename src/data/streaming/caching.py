@@ -0,0 +1,411 @@
+import glob
+import hashlib
+import json
+import os
+import threading
+import numpy as np
+from collections import OrderedDict
+
+
+def config_hash(obj):
+    """
+    Stable hash of a json serializable object.
+    """
+    return hashlib.sha1(json.dumps(
+        obj,
+        ensure_ascii=False,
+        sort_keys=True,
+    ).encode('utf-8')).hexdigest()
+
+
+def save_npy_atomic(path, arr):
+    """
+    Write an array to a .npy file such that concurrent readers never
+    see a partially written file.
+    """
+    tmp_path = "{}.{}.tmp.npy".format(path, os.getpid())
+    np.save(tmp_path, arr)
+    os.replace(tmp_path, path)
+
+
+def file_stamp(file_path):
+    """
+    Path, modification time and size of a file, used in cache keys
+    so that modified files invalidate the cached data.
+    """
+    stat = os.stat(file_path)
+    return {
+        "file_path": os.path.abspath(file_path),
+        "mtime": stat.st_mtime,
+        "size": stat.st_size
+    }
+
+
+class VolumeCache(object):
+    """
+    On-disk cache of preprocessed volumes. Every volume is stored
+    as a separate .npy file and memory-mapped when read back in.
+    """
+    def __init__(self, cache_dir, preprocessing):
+        """
+        Args:
+            - cache_dir: folder containing the cached volumes
+            - preprocessing: json serializable description of the
+              preprocessing applied to the volumes, part of every key
+        """
+        self.cache_dir = cache_dir
+        self.preprocessing = preprocessing
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def get_cache_path(self, file_path):
+        key = file_stamp(file_path)
+        key["preprocessing"] = self.preprocessing
+        key = config_hash(key)
+        return os.path.join(self.cache_dir, key + ".npy")
+
+    def load(self, file_path, compute_fn):
+        """
+        Args:
+            - file_path: path of the original volume
+            - compute_fn: function mapping file_path to the
+              preprocessed volume, only called on cache misses
+        Return:
+            - read-only memory-mapped float32 volume
+        """
+        cache_path = self.get_cache_path(file_path)
+        if not os.path.exists(cache_path):
+            im = compute_fn(file_path).astype(np.float32)
+            save_npy_atomic(cache_path, im)
+
+        return np.load(cache_path, mmap_mode='r')
+
+
+class ImageStore(object):
+    """
+    Holds a set of volumes in one contiguous float32 array indexed
+    by file ID. Reads are zero-copy slices of that array.
+    If a store path is given, the array is backed by a .npy file
+    that is memory-mapped, so that processes sharing the store share
+    the same pages, and is reused across runs.
+    """
+    def __init__(self, file_ids, load_fn, store_path=None,
+                 sample_shape=None):
+        """
+        Args:
+            - file_ids: list of file IDs to preload
+            - load_fn: function mapping a file ID to its volume
+            - store_path: optional .npy file backing the store
+            - sample_shape: optional shape of the volumes, an existing
+              store file with volumes of another shape is rebuilt
+        """
+        self.file_ids = list(file_ids)
+        assert len(self.file_ids) > 0
+        self.fid_to_idx = OrderedDict(
+            (fid, i) for i, fid in enumerate(self.file_ids)
+        )
+
+        if store_path is not None and os.path.exists(store_path):
+            self.data = np.load(store_path, mmap_mode='r')
+            if len(self.data) == len(self.file_ids) and \
+                    (sample_shape is None or
+                     self.data.shape[1:] == tuple(sample_shape)):
+                return
+
+        first = load_fn(self.file_ids[0])
+        shape = tuple([len(self.file_ids)] + list(first.shape))
+        if store_path is None:
+            data = np.empty(shape, dtype=np.float32)
+        else:
+            tmp_path = "{}.{}.tmp.npy".format(store_path, os.getpid())
+            data = np.lib.format.open_memmap(
+                tmp_path,
+                mode='w+',
+                dtype=np.float32,
+                shape=shape
+            )
+
+        data[0] = first
+        for i in range(1, len(self.file_ids)):
+            data[i] = load_fn(self.file_ids[i])
+
+        if store_path is None:
+            data.flags.writeable = False
+            self.data = data
+        else:
+            data.flush()
+            del data
+            os.replace(tmp_path, store_path)
+            self.data = np.load(store_path, mmap_mode='r')
+
+    def __contains__(self, file_id):
+        return file_id in self.fid_to_idx
+
+    def __len__(self):
+        return len(self.file_ids)
+
+    def get_index(self, file_id):
+        return self.fid_to_idx[file_id]
+
+    def get(self, file_id):
+        return self.data[self.fid_to_idx[file_id]]
+
+
+class LRUCache(object):
+    """
+    Thread-safe cache holding at most max_size items. The least
+    recently used item is evicted first.
+    """
+    def __init__(self, max_size=None):
+        """
+        Args:
+            - max_size: maximum number of items, unbounded if None
+        """
+        self.max_size = max_size
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+        # counters
+        self.n_hits = 0
+        self.n_misses = 0
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.items
+
+    def __len__(self):
+        with self.lock:
+            return len(self.items)
+
+    def get(self, key):
+        """
+        Return:
+            - cached value, None on a miss
+        """
+        with self.lock:
+            if key not in self.items:
+                self.n_misses += 1
+                return None
+            self.n_hits += 1
+            self.items.move_to_end(key)
+            return self.items[key]
+
+    def put(self, key, value):
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            if self.max_size is not None:
+                while len(self.items) > self.max_size:
+                    self.items.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                "size": len(self.items),
+                "hits": self.n_hits,
+                "misses": self.n_misses
+            }
+
+
+# Maximum number of (cache key, file ID) entries of far predictions
+# held in memory by the process
+FAR_PREDICTION_CACHE_SIZE = 256
+# Far predictions shared by all streamers of the process, keyed by
+# (cache key, file ID)
+_FAR_PREDICTIONS = LRUCache(FAR_PREDICTION_CACHE_SIZE)
+
+
+class FarPredictionCache(object):
+    """
+    Images generated by iterating the VAGAN, indexed by file ID and
+    step. A single iterated run of n steps provides the images of
+    all steps 1, ..., n. If a folder is given, the images of every
+    file ID are persisted as one .npy file of shape (n_steps, ...).
+    In memory, the images of at most FAR_PREDICTION_CACHE_SIZE file IDs
+    are kept by the process, the least recently used are dropped.
+    Images of the working set passed to pin are kept in addition,
+    until another working set is pinned.
+    """
+    def __init__(self, key, folder=None):
+        """
+        Args:
+            - key: hash of everything that determines the generated
+              images, e.g. VAGAN label and preprocessing
+            - folder: optional folder to persist images in
+        """
+        self.key = key
+        # file ID -> images of the current working set
+        self.pinned = {}
+        self.folder = None
+        if folder is not None:
+            self.folder = os.path.join(folder, key)
+            os.makedirs(self.folder, exist_ok=True)
+
+    def get_path(self, file_id):
+        name = hashlib.sha1(file_id.encode('utf-8')).hexdigest()
+        return os.path.join(self.folder, name + ".npy")
+
+    def pin(self, fid_to_images):
+        """
+        Keep the images of a working set in memory, independently
+        of the process-wide LRU cache. Replaces the previous working
+        set.
+
+        Args:
+            - fid_to_images: dictionary mapping file IDs to arrays of
+              shape (n_steps, ...)
+        """
+        self.pinned = dict(fid_to_images)
+
+    def get_images(self, file_id):
+        if file_id in self.pinned:
+            return self.pinned[file_id]
+
+        images = _FAR_PREDICTIONS.get((self.key, file_id))
+        if images is not None:
+            return images
+
+        if self.folder is None:
+            return None
+
+        path = self.get_path(file_id)
+        if not os.path.exists(path):
+            return None
+
+        images = np.load(path, mmap_mode='r')
+        _FAR_PREDICTIONS.put((self.key, file_id), images)
+        return images
+
+    def get_n_steps(self, file_id):
+        """
+        Return:
+            - number of steps available for file_id
+        """
+        images = self.get_images(file_id)
+        if images is None:
+            return 0
+        return len(images)
+
+    def get(self, file_id, step):
+        """
+        Return:
+            - image after step iterations (step >= 1)
+        Raises:
+            - KeyError if the image is not available
+        """
+        images = self.get_images(file_id)
+        if images is None or step < 1 or step > len(images):
+            raise KeyError(
+                "no far prediction of {} after {} steps".format(
+                    file_id, step
+                )
+            )
+        return images[step - 1]
+
+    def put(self, file_id, images):
+        """
+        Args:
+            - file_id: file ID of the input image
+            - images: array of shape (n_steps, ...) containing the
+              image after every step
+        Return:
+            - cached images of file_id
+        """
+        if len(images) <= self.get_n_steps(file_id):
+            return self.get_images(file_id)
+
+        images = np.array(images, dtype=np.float32)
+        if self.folder is None:
+            images.flags.writeable = False
+        else:
+            path = self.get_path(file_id)
+            save_npy_atomic(path, images)
+            images = np.load(path, mmap_mode='r')
+        _FAR_PREDICTIONS.put((self.key, file_id), images)
+        if file_id in self.pinned:
+            self.pinned[file_id] = images
+        return images
+
+
+# State computed while constructing streamers (file listings, parsed
+# meta information, splits), shared by all streamers of the process
+_STREAMER_STATE = {}
+_STREAMER_STATE_LOCK = threading.Lock()
+
+
+def directory_signature(glob_pattern):
+    """
+    Modification times of the directories a glob pattern can match
+    files in. Adding, removing or renaming a matching file changes
+    the signature.
+
+    Args:
+        - glob_pattern: glob pattern of files
+    Return:
+        - tuple of (directory, mtime in ns)
+    """
+    folder = os.path.dirname(glob_pattern)
+    if glob.has_magic(folder):
+        # folder containing the first wildcard, catches new subfolders
+        parts = folder.split(os.sep)
+        n_static = 0
+        while not glob.has_magic(parts[n_static]):
+            n_static += 1
+        static = os.sep.join(parts[:n_static])
+        if static == "":
+            static = os.sep if os.path.isabs(folder) else os.curdir
+        folders = [static]
+        folders += sorted(glob.glob(folder))
+    else:
+        folders = [folder or os.curdir]
+
+    signature = []
+    for f in folders:
+        try:
+            signature.append((f, os.stat(f).st_mtime_ns))
+        except OSError:
+            signature.append((f, None))
+    return tuple(signature)
+
+
+def file_digest(path):
+    """
+    sha1 of the content of a file.
+    """
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def get_streamer_state(key, signature, compute_fn):
+    """
+    Process-wide memoization of streamer construction state.
+    The returned state is shared and must not be modified.
+
+    Args:
+        - key: identifies the state, e.g. a config_hash
+        - signature: state is recomputed if the signature differs
+          from the one it was computed with
+        - compute_fn: function without arguments computing the state
+    Return:
+        - state
+    """
+    with _STREAMER_STATE_LOCK:
+        if key in _STREAMER_STATE:
+            cached_signature, state = _STREAMER_STATE[key]
+            if cached_signature == signature:
+                return state
+
+    state = compute_fn()
+    with _STREAMER_STATE_LOCK:
+        _STREAMER_STATE[key] = (signature, state)
+    return state
+
+
+def clear_streamer_state():
+    with _STREAMER_STATE_LOCK:
+        _STREAMER_STATE.clear()
@@ -0,0 +1,228 @@
+import numpy as np
+from collections import OrderedDict
+
+
+# Checked in this order by get_diagnose
+DIAGNOSES = ["health_ad", "healthy", "health_mci"]
+
+FILE_COLUMNS = ["file_path", "file_name"]
+
+
+class MetaRow(object):
+    """
+    Read-only dictionary view of one row of a MetaTable.
+    """
+    def __init__(self, table, file_id):
+        self.table = table
+        self.file_id = file_id
+
+    def __getitem__(self, key):
+        return self.table.get_value(self.file_id, key)
+
+    def __contains__(self, key):
+        return self.table.has_value(self.file_id, key)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def keys(self):
+        return self.table.get_keys(self.file_id)
+
+    def values(self):
+        return [self[k] for k in self.keys()]
+
+    def items(self):
+        return [(k, self[k]) for k in self.keys()]
+
+
+class MetaTable(object):
+    """
+    Columnar storage of the meta information parsed from the meta csv.
+
+    Rows of the csv are keyed by their ID (image label). Image files
+    matched to a csv row are added with add_file and keyed by their
+    path. They share all columns with their csv row and only store
+    file path and file name, instead of a copy of the row.
+
+    Diagnoses, patients and exact ages are additionally stored as
+    arrays (categorical codes for diagnoses and patients) for the
+    vectorized selectors.
+    """
+    def __init__(self, rows):
+        """
+        Args:
+            - rows: OrderedDict mapping IDs to dictionaries
+              containing the values of the row
+        """
+        self.columns = []
+        if len(rows) > 0:
+            self.columns = list(next(iter(rows.values())).keys())
+        self.column_set = set(self.columns)
+        self.id_to_row = OrderedDict(
+            (key, i) for i, key in enumerate(rows.keys())
+        )
+
+        self.data = OrderedDict()
+        for c in self.columns:
+            col = np.empty(len(rows), dtype=object)
+            col[:] = [row[c] for row in rows.values()]
+            self.data[c] = col
+        # values of columns missing in the first row
+        self.extra = {}
+        for i, row in enumerate(rows.values()):
+            for k in row:
+                if k not in self.column_set:
+                    self.extra[(i, k)] = row[k]
+
+        # Matched files
+        self.file_to_row = OrderedDict()
+        self.file_to_name = {}
+
+        self.compute_codes()
+
+    def compute_codes(self):
+        n = len(self.id_to_row)
+        self.diagnosis_codes = np.full(n, -1, dtype=np.int8)
+        # reversed, such that the first matching diagnosis wins
+        for code in reversed(range(len(DIAGNOSES))):
+            d = DIAGNOSES[code]
+            if d in self.column_set:
+                is_d = np.array([v == 1 for v in self.data[d]], dtype=bool)
+                self.diagnosis_codes[is_d] = code
+
+        self.patients = []
+        self.patient_codes = np.full(n, -1, dtype=np.int32)
+        if "patient_label" in self.column_set:
+            patient_to_code = OrderedDict()
+            for i, p in enumerate(self.data["patient_label"]):
+                if p not in patient_to_code:
+                    patient_to_code[p] = len(patient_to_code)
+                self.patient_codes[i] = patient_to_code[p]
+            self.patients = list(patient_to_code.keys())
+
+        self.exact_ages = np.full(n, np.nan)
+        if "age_exact" in self.column_set:
+            for i, age in enumerate(self.data["age_exact"]):
+                try:
+                    self.exact_ages[i] = float(age)
+                except (TypeError, ValueError):
+                    pass
+
+    def add_file(self, file_path, image_label, file_name):
+        """
+        Add a file matched to the csv row image_label.
+        """
+        self.file_to_row[file_path] = self.id_to_row[image_label]
+        self.file_to_name[file_path] = file_name
+
+    def get_row(self, key):
+        if key in self.file_to_row:
+            return self.file_to_row[key]
+        return self.id_to_row[key]
+
+    def get_rows(self, keys):
+        return np.array([self.get_row(k) for k in keys], dtype=np.int64)
+
+    def is_file(self, key):
+        return key in self.file_to_row
+
+    def get_value(self, key, column):
+        if key in self.file_to_row:
+            if column == "file_path":
+                return key
+            if column == "file_name":
+                return self.file_to_name[key]
+            i = self.file_to_row[key]
+        else:
+            i = self.id_to_row[key]
+
+        if column in self.data:
+            return self.data[column][i]
+        # raises a KeyError for unknown columns
+        return self.extra[(i, column)]
+
+    def has_value(self, key, column):
+        if key in self.file_to_row and column in FILE_COLUMNS:
+            return True
+        i = self.get_row(key)
+        return column in self.data or (i, column) in self.extra
+
+    def get_keys(self, key):
+        i = self.get_row(key)
+        keys = list(self.columns)
+        keys += [k for (j, k) in self.extra.keys() if j == i]
+        if key in self.file_to_row:
+            keys += [k for k in FILE_COLUMNS if k not in keys]
+        return keys
+
+    def get_diagnosis_code(self, key):
+        return self.diagnosis_codes[self.get_row(key)]
+
+    def get_diagnosis_codes(self, keys):
+        return self.diagnosis_codes[self.get_rows(keys)]
+
+    def get_patient_codes(self, keys):
+        return self.patient_codes[self.get_rows(keys)]
+
+    def get_exact_ages(self, keys):
+        return self.exact_ages[self.get_rows(keys)]
+
+    def select(self, keys, diagnoses=None, age_min=None, age_max=None,
+               patients=None):
+        """
+        Vectorized selection of file IDs.
+
+        Args:
+            - keys: list of file IDs
+            - diagnoses: keep IDs having one of these diagnoses
+            - age_min, age_max: keep IDs with exact age in
+              [age_min, age_max]
+            - patients: keep IDs of these patients
+        Return:
+            - list of selected IDs, same order as keys
+        """
+        keys = list(keys)
+        rows = self.get_rows(keys)
+        mask = np.ones(len(keys), dtype=bool)
+
+        if diagnoses is not None:
+            codes = [DIAGNOSES.index(d) for d in diagnoses if d in DIAGNOSES]
+            mask &= np.isin(self.diagnosis_codes[rows], codes)
+        if age_min is not None:
+            mask &= self.exact_ages[rows] >= age_min
+        if age_max is not None:
+            mask &= self.exact_ages[rows] <= age_max
+        if patients is not None:
+            patients = set(patients)
+            codes = [c for c, p in enumerate(self.patients) if p in patients]
+            mask &= np.isin(self.patient_codes[rows], codes)
+
+        return [k for k, m in zip(keys, mask) if m]
+
+    def __getitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        return MetaRow(self, key)
+
+    def __contains__(self, key):
+        return key in self.file_to_row or key in self.id_to_row
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.id_to_row) + len(self.file_to_row)
+
+    def keys(self):
+        return list(self.id_to_row.keys()) + list(self.file_to_row.keys())
+
+    def items(self):
+        return [(k, self[k]) for k in self.keys()]
@@ -10,6 +10,15 @@ import pandas as pd
 
 from .base import FileStream
 from .base import Group
+from .caching import VolumeCache, file_stamp
+from .caching import ImageStore
+from .caching import config_hash
+from .normalization import compute_moments
+from .normalization import normalization_key
+from .normalization import load_voxel_stats
+from .normalization import save_voxel_stats
+from .normalization import normalize_batch
+from .normalization import partition_percentile
 from src.baum_vagan.utils import map_image_to_intensity_range
 
 
@@ -70,6 +79,15 @@ class MRISingleStream(FileStream, MRIImageLoader):
         self.rescale_to_one = self.config["rescale_to_one"]
         self.normalization_computed = False
         self.normalize_images = self.config["normalize_images"]
+        self.volume_cache = None
+        if self.do_cache_volumes():
+            self.volume_cache = VolumeCache(
+                cache_dir=self.config["volume_cache_dir"],
+                preprocessing=self.get_preprocessing_config()
+            )
+        self.image_store = None
+        if self.do_preload_images():
+            self.build_image_store()
         if self.normalize_images:
             self.compute_image_normalization()
 
@@ -92,7 +110,32 @@ class MRISingleStream(FileStream, MRIImageLoader):
         return "clip" in self.config and self.config["clip"]
 
     def clip_image(self, img):
-        return np.clip(img, np.min(img), np.percentile(img, 95))
+        upper = partition_percentile(np.reshape(img, (1, -1)), 95)[0]
+        return np.clip(img, np.min(img), upper)
+
+    def standardize_image(self, im):
+        if self.do_clip():
+            im = self.clip_image(im)
+        std = np.std(im)
+
+        if np.isclose(std, 0):
+            std = 1
+        return (im - np.mean(im)) / std
+
+    def get_normalization_key(self, file_ids):
+        """
+        The key contains the preprocessing config (including the
+        downsample config) and the volume shape, so that statistics
+        of downsampled debug runs are never used for real images.
+        """
+        preprocessing = self.get_preprocessing_config()
+        preprocessing["clip"] = self.do_clip()
+        if len(file_ids) > 0:
+            preprocessing["shape"] = list(self.get_volume_shape(file_ids[0]))
+        return normalization_key(
+            file_paths=[self.get_file_path(fid) for fid in file_ids],
+            preprocessing=preprocessing
+        )
 
     def compute_image_normalization(self):
         """
@@ -101,6 +144,9 @@ class MRISingleStream(FileStream, MRIImageLoader):
         3. Normalize every image again.
 
         Normalization should be computed on the train set only.
+        Voxel statistics are shared by all streamers of the process
+        that use the same train images and preprocessing, and are
+        persisted in 'normalization_dir' if specified.
         """
         # collect train file IDs
         test_ids = set(self.get_test_ids())
@@ -109,51 +155,33 @@ class MRISingleStream(FileStream, MRIImageLoader):
         # images should be used to compute the normalization
         file_ids = set(self.all_file_ids).difference(test_ids)
         file_ids = file_ids.difference(validation_ids)
-        n = len(file_ids)
+        file_ids = sorted(list(file_ids))
 
-        shape = self.get_sample_shape()
-        voxel_mean = np.zeros(shape)
-        voxel_mean_sq = np.zeros(shape)
+        folder = None
+        if "normalization_dir" in self.config:
+            folder = self.config["normalization_dir"]
+        n_workers = 1
+        if "normalization_workers" in self.config:
+            n_workers = self.config["normalization_workers"]
+
+        key = self.get_normalization_key(file_ids)
+        stats = load_voxel_stats(key, folder)
+
+        if stats is None:
+            moments = compute_moments(
+                items=file_ids,
+                load_fn=lambda fid: self.standardize_image(
+                    self.load_sample_by_id(fid)
+                ),
+                n_workers=n_workers
+            )
+            stats = (moments.get_mean(), moments.get_std())
+            save_voxel_stats(key, stats[0], stats[1], folder)
+        elif not self.silent:
+            print(">>>>> Loaded normalization {}".format(key))
 
-        lim = int(0.1 * n)
-        # Try to avoid overflows
-        cur_sums = np.zeros(shape)
-        cur_sums_sq = np.zeros(shape)
-        c = 0
-        file_ids = sorted(list(file_ids))
-        for fid in file_ids:
-            p = self.get_file_path(fid)
-            im = self.load_sample(p)
-            if self.do_clip():
-                im = self.clip_image(im)
-            std = np.std(im)
-
-            if np.isclose(std, 0):
-                std = 1
-            im = (im - np.mean(im)) / std
-
-            # Keep running average for every voxel intensity
-            cur_sums += im
-            cur_sums_sq += im ** 2
-            c += 1
-            if c >= lim:
-                c = 0
-                voxel_mean += cur_sums / n
-                voxel_mean_sq += cur_sums_sq / n
-                cur_sums = np.zeros(shape)
-                cur_sums_sq = np.zeros(shape)
-
-        if c != 0:
-            voxel_mean += cur_sums / n
-            voxel_mean_sq += cur_sums_sq / n
-
-        self.voxel_means = np.zeros(shape)
-        self.voxel_stds = np.zeros(shape)
-
-        # Compute mean and standard deviation
-        self.voxel_means = voxel_mean
-        voxel_var = voxel_mean_sq - self.voxel_means ** 2
-        self.voxel_stds = np.sqrt(voxel_var)
+        self.voxel_means = stats[0].astype(np.float32)
+        self.voxel_stds = stats[1].astype(np.float32)
 
         if not self.silent:
             print(">>>>> Normalization computed!!")
@@ -168,20 +196,20 @@ class MRISingleStream(FileStream, MRIImageLoader):
         return self.voxel_stds
 
     def normalize_image(self, im):
-        assert self.normalization_computed
-        if self.do_clip():
-            im = self.clip_image(im)
+        return self.normalize_image_batch(im[np.newaxis])[0]
 
-        std = np.std(im)
-        if np.isclose(0, std):
-            std = 1
-        im = (im - np.mean(im)) / std
-        im = (im - self.voxel_means) / self.voxel_stds
-        std = np.std(im)
-        if np.isclose(0, std):
-            std = 1
-        im = (im - np.mean(im)) / std
-        return im
+    def normalize_image_batch(self, images):
+        """
+        Normalize a batch of images of shape (N, X, Y, Z) at once,
+        see normalize_image.
+        """
+        assert self.normalization_computed
+        return normalize_batch(
+            images=images,
+            voxel_means=self.voxel_means,
+            voxel_stds=self.voxel_stds,
+            clip=self.do_clip()
+        )
 
     def dump_normalization(self, outdir):
         if self.normalization_computed and self.normalize_images:
@@ -201,8 +229,83 @@ class MRISingleStream(FileStream, MRIImageLoader):
 
         return im
 
+    def do_cache_volumes(self):
+        return "volume_cache_dir" in self.config
+
+    def get_preprocessing_config(self):
+        """
+        Config fields that determine the output of load_sample.
+        Clipping and normalization are applied on top of load_sample
+        and are therefore not part of the cached volumes.
+        """
+        slice_config = None
+        if self.load_only_slice():
+            slice_config = list(self.get_slice_info())
+
+        return {
+            "rescale_to_one": self.rescale_to_one,
+            "slice": slice_config,
+            # downsampled runs load random images
+            "downsample": self.config["downsample"]
+        }
+
+    def get_volume_shape(self, file_id):
+        """
+        Shape of the preprocessed volume of file_id. Unlike
+        get_sample_shape, the shape is known without loading
+        an image if downsampling is enabled.
+        """
+        if self.config["downsample"]["enabled"]:
+            return tuple(self.config["downsample"]["shape"])
+        return self.load_sample_by_id(file_id).shape
+
+    def do_preload_images(self):
+        return "preload_images" in self.config and \
+            self.config["preload_images"]
+
+    def build_image_store(self):
+        """
+        Load all train, validation and test images once into a
+        single contiguous array. If 'image_store_dir' is specified,
+        the array is memory-mapped from disk and reused by streamers
+        with the same images and preprocessing.
+        """
+        file_ids = set(self.all_file_ids)
+        file_ids = file_ids.union(self.get_train_ids())
+        file_ids = file_ids.union(self.get_validation_ids())
+        file_ids = file_ids.union(self.get_test_ids())
+        file_ids = sorted(list(file_ids))
+
+        store_path = None
+        sample_shape = None
+        if "image_store_dir" in self.config:
+            store_dir = self.config["image_store_dir"]
+            os.makedirs(store_dir, exist_ok=True)
+            key = config_hash({
+                "files": [
+                    file_stamp(self.get_file_path(fid)) for fid in file_ids
+                ],
+                "preprocessing": self.get_preprocessing_config()
+            })
+            store_path = os.path.join(store_dir, key + ".npy")
+            sample_shape = self.get_volume_shape(file_ids[0])
+
+        self.image_store = ImageStore(
+            file_ids=file_ids,
+            load_fn=lambda fid: self.load_sample(self.get_file_path(fid)),
+            store_path=store_path,
+            sample_shape=sample_shape
+        )
+        if not self.silent:
+            print(">>>>> Preloaded {} images".format(len(self.image_store)))
+
+    def load_sample_by_id(self, file_id):
+        if self.image_store is not None and file_id in self.image_store:
+            return self.image_store.get(file_id)
+
+        return self.load_sample(self.get_file_path(file_id))
+
     def load_sample(self, file_path):
-        im = self.load_image(file_path)
         if self.config["downsample"]["enabled"]:
             # im = im / np.max(im)
             shape = tuple(self.config["downsample"]["shape"])
@@ -210,6 +313,13 @@ class MRISingleStream(FileStream, MRIImageLoader):
             im = np.random.rand(*shape)
             return im
 
+        if self.volume_cache is not None:
+            return self.volume_cache.load(file_path, self.preprocess_sample)
+
+        return self.preprocess_sample(file_path)
+
+    def preprocess_sample(self, file_path):
+        im = self.load_image(file_path)
         if self.rescale_to_one:
             im = map_image_to_intensity_range(im, -1, 1, 5)
 
@@ -0,0 +1,201 @@
+import os
+import numpy as np
+from multiprocessing.pool import ThreadPool
+
+from .caching import config_hash, file_stamp
+
+
+# Voxel statistics shared by all streamers of the process,
+# keyed by normalization key
+_VOXEL_STATS = {}
+
+
+class RunningMoments(object):
+    """
+    Numerically stable running mean and variance of arrays
+    (Welford). Partial results can be merged (Chan et al.).
+    """
+    def __init__(self, shape=None):
+        self.n = 0
+        self.mean = None
+        self.m2 = None
+        if shape is not None:
+            self.mean = np.zeros(shape)
+            self.m2 = np.zeros(shape)
+
+    def update(self, x):
+        x = np.asarray(x, dtype=np.float64)
+        if self.mean is None:
+            self.mean = np.zeros(x.shape)
+            self.m2 = np.zeros(x.shape)
+
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (x - self.mean)
+
+    def merge(self, other):
+        if other.n == 0:
+            return self
+        if self.n == 0:
+            self.n = other.n
+            self.mean = np.copy(other.mean)
+            self.m2 = np.copy(other.m2)
+            return self
+
+        n = self.n + other.n
+        delta = other.mean - self.mean
+        self.mean += delta * (other.n / n)
+        self.m2 += other.m2 + delta ** 2 * (self.n * other.n / n)
+        self.n = n
+        return self
+
+    def get_mean(self):
+        return self.mean
+
+    def get_var(self):
+        return self.m2 / self.n
+
+    def get_std(self):
+        return np.sqrt(self.get_var())
+
+
+def compute_moments(items, load_fn, n_workers=1, chunk_size=16):
+    """
+    Args:
+        - items: list of items, e.g. file IDs
+        - load_fn: maps an item to an array
+        - n_workers: number of threads loading chunks of items
+          concurrently
+        - chunk_size: number of items accumulated per task
+    Return:
+        - RunningMoments over all loaded arrays
+    """
+    def _chunk_moments(chunk):
+        moments = RunningMoments()
+        for item in chunk:
+            moments.update(load_fn(item))
+        return moments
+
+    chunks = [items[i:i + chunk_size]
+              for i in range(0, len(items), chunk_size)]
+
+    if n_workers > 1:
+        pool = ThreadPool(n_workers)
+        try:
+            partial = pool.map(_chunk_moments, chunks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        partial = [_chunk_moments(chunk) for chunk in chunks]
+
+    moments = RunningMoments()
+    for m in partial:
+        moments.merge(m)
+
+    return moments
+
+
+def normalization_key(file_paths, preprocessing):
+    """
+    Existing files are identified by path, modification time and
+    size, so that images regenerated in place invalidate persisted
+    statistics.
+    """
+    files = []
+    for path in sorted(file_paths):
+        if os.path.exists(path):
+            files.append(file_stamp(path))
+        else:
+            files.append(path)
+    return config_hash({
+        "files": files,
+        "preprocessing": preprocessing
+    })
+
+
+def load_voxel_stats(key, folder=None):
+    """
+    Return:
+        - (voxel_means, voxel_stds) computed earlier in this process
+          or persisted in folder, None if not available
+    """
+    if key in _VOXEL_STATS:
+        return _VOXEL_STATS[key]
+
+    if folder is None:
+        return None
+
+    path = os.path.join(folder, key + ".npz")
+    if not os.path.exists(path):
+        return None
+
+    with np.load(path) as f:
+        stats = (f["mean"], f["std"])
+    _VOXEL_STATS[key] = stats
+    return stats
+
+
+def save_voxel_stats(key, voxel_means, voxel_stds, folder=None):
+    _VOXEL_STATS[key] = (voxel_means, voxel_stds)
+    if folder is None:
+        return
+
+    os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, key + ".npz")
+    tmp_path = "{}.{}.tmp.npz".format(path[:-len(".npz")], os.getpid())
+    np.savez(tmp_path, mean=voxel_means, std=voxel_stds)
+    os.replace(tmp_path, path)
+
+
+def partition_percentile(X, q):
+    """
+    Row-wise percentile of a 2D array, same as np.percentile(X, q, axis=1)
+    with linear interpolation. Uses np.partition instead of a full sort.
+    """
+    n = X.shape[1]
+    idx = q / 100.0 * (n - 1)
+    lo = int(np.floor(idx))
+    hi = min(lo + 1, n - 1)
+    part = np.partition(X, [lo, hi], axis=1)
+    frac = X.dtype.type(idx - lo)
+    return part[:, lo] + (part[:, hi] - part[:, lo]) * frac
+
+
+def _standardize_rows(X):
+    means = np.mean(X, axis=1, keepdims=True)
+    stds = np.std(X, axis=1, keepdims=True)
+    stds[np.isclose(stds, 0)] = 1
+    X -= means
+    X /= stds
+    return X
+
+
+def normalize_batch(images, voxel_means, voxel_stds, clip=False,
+                    clip_percentile=95):
+    """
+    Vectorized version of MRISingleStream.normalize_image.
+
+    Args:
+        - images: array of shape (N, X, Y, Z)
+        - voxel_means: array of shape (X, Y, Z)
+        - voxel_stds: array of shape (X, Y, Z)
+        - clip: clip every image to [min, percentile]
+    Return:
+        - float32 array of shape (N, X, Y, Z)
+    """
+    shape = images.shape
+    X = np.array(images, dtype=np.float32).reshape(shape[0], -1)
+
+    if clip:
+        mins = np.min(X, axis=1, keepdims=True)
+        maxs = partition_percentile(X, clip_percentile)[:, np.newaxis]
+        np.clip(X, mins, maxs, out=X)
+
+    X = _standardize_rows(X)
+    X -= np.asarray(voxel_means, dtype=np.float32).reshape(1, -1)
+    X /= np.asarray(voxel_stds, dtype=np.float32).reshape(1, -1)
+    X = _standardize_rows(X)
+
+    return X.reshape(shape)
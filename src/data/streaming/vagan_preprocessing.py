@@ -5,6 +5,7 @@ from collections import OrderedDict
 import tensorflow as tf
 
 from .mri_streaming import MRISingleStream
+from .caching import FarPredictionCache, config_hash
 from src.baum_vagan.vagan.model_wrapper import VAGanWrapper
 from src.baum_vagan.utils import map_image_to_intensity_range
 from . import features as _features
@@ -37,6 +38,16 @@ class VaganFarPredictions(MRISingleStream):
         if "target_age" in self.config and "vagan_steps" in self.config:
             raise ValueError("Specify target_age or vagan_steps")
 
+        self.far_predictions = None
+        if self.do_cache_far_predictions():
+            folder = None
+            if "far_prediction_cache_dir" in self.config:
+                folder = self.config["far_prediction_cache_dir"]
+            self.far_predictions = FarPredictionCache(
+                key=self.get_far_prediction_key(),
+                folder=folder
+            )
+
     def cache_preprocessing(self):
         return self.config["cache_preprocessing"]
 
@@ -63,31 +74,164 @@ class VaganFarPredictions(MRISingleStream):
             return False
         return self.config["negative_diff_maps"]
 
-    def preprocess_image(self, fid, im):
+    def get_vagan_batch_size(self):
+        """
+        Number of images moved forward by the VAGAN with a single
+        session call. If specified, all images of an input_fn are
+        preprocessed before streaming starts.
+        """
+        if "vagan_batch_size" in self.config:
+            return self.config["vagan_batch_size"]
+        return None
+
+    def do_cache_far_predictions(self):
+        return "cache_far_predictions" in self.config and \
+            self.config["cache_far_predictions"]
+
+    def get_far_prediction_key(self):
+        """
+        Rescaling is applied when reading from the cache, so
+        images are shared between rescaled and raw predictions.
+        """
+        return config_hash({
+            "vagan_label": self.config["vagan_label"],
+            "negative_diff_maps": self.negative_difference_maps(),
+            "preprocessing": self.get_preprocessing_config()
+        })
+
+    def postprocess_far_prediction(self, im):
+        im = np.squeeze(im)
+        if self.do_vagan_rescaling():
+            im = map_image_to_intensity_range(im, -1, 1, 5)
+        return im
+
+    def precompute_far_predictions(self, fids, n_steps):
+        """
+        Move all images forward by n_steps and store the images of
+        all intermediate steps. Images already cached for at least
+        n_steps are skipped. If images had to be computed, fids
+        become the pinned working set of the cache, so later reads
+        of any step do not depend on the size of the LRU cache.
+        Return:
+            - dictionary mapping file IDs to arrays of shape
+              (n, ...), n >= n_steps, containing the image after
+              every step
+        """
+        if self.far_predictions is None or n_steps < 1:
+            return {}
+
+        fid_to_images = {}
+        missing = []
+        for fid in fids:
+            images = self.far_predictions.get_images(fid)
+            if images is None or len(images) < n_steps:
+                missing.append(fid)
+            else:
+                fid_to_images[fid] = images
+        if len(missing) == 0:
+            return fid_to_images
+
+        images = [self.load_sample_by_id(fid).astype(np.float32)
+                  for fid in missing]
+        all_images, _ = self.wrapper.vagan.iterated_far_prediction_batch(
+            images,
+            n_steps,
+            only_negative=self.negative_difference_maps(),
+            batch_size=self.get_vagan_batch_size()
+        )
+        for fid, fid_images in zip(missing, all_images):
+            fid_to_images[fid] = self.far_predictions.put(fid, fid_images)
+        self.far_predictions.pin(fid_to_images)
+
+        return fid_to_images
+
+    def get_n_steps(self, fid):
         if "target_age" in self.config:
             gran = self.get_granularity()
             target_age = self.get_target_age()
             cur_age = self.get_exact_age(fid)
-            n_steps = int((target_age - cur_age) / gran)
-            if n_steps < 1:
-                return im
+            return int((target_age - cur_age) / gran)
         else:
-            n_steps = self.get_vagan_steps()
+            return self.get_vagan_steps()
+
+    def preprocess_image(self, fid, im):
+        n_steps = self.get_n_steps(fid)
+        if "target_age" in self.config and n_steps < 1:
+            return im
+
+        if self.far_predictions is not None:
+            images = self.precompute_far_predictions([fid], n_steps)[fid]
+            return self.postprocess_far_prediction(images[n_steps - 1])
+
         images, masks = self.wrapper.vagan.iterated_far_prediction(
             im, n_steps, self.negative_difference_maps()
         )
 
-        last_image = np.squeeze(images[-1])
-        if self.do_vagan_rescaling():
-            last_image = map_image_to_intensity_range(last_image, -1, 1, 5)
-
-        return last_image
+        return self.postprocess_far_prediction(images[-1])
+
+    def preprocess_images(self, fids):
+        """
+        Batched version of preprocess_image. Images with the same
+        number of steps are moved forward together.
+        Return:
+            - dictionary mapping file IDs to preprocessed images
+        """
+        steps_to_fids = OrderedDict()
+        for fid in fids:
+            n_steps = self.get_n_steps(fid)
+            if n_steps not in steps_to_fids:
+                steps_to_fids[n_steps] = []
+            steps_to_fids[n_steps].append(fid)
+
+        fid_to_image = {}
+        for n_steps, step_fids in steps_to_fids.items():
+            if self.far_predictions is not None and n_steps >= 1:
+                fid_to_images = self.precompute_far_predictions(
+                    step_fids, n_steps
+                )
+                for fid in step_fids:
+                    fid_to_image[fid] = self.postprocess_far_prediction(
+                        fid_to_images[fid][n_steps - 1]
+                    )
+                continue
+
+            images = [self.load_sample_by_id(fid).astype(np.float32)
+                      for fid in step_fids]
+            if "target_age" in self.config and n_steps < 1:
+                fid_to_image.update(zip(step_fids, images))
+                continue
+
+            last_images, _ = self.wrapper.vagan.iterated_far_prediction_batch(
+                images,
+                n_steps,
+                only_negative=self.negative_difference_maps(),
+                batch_size=self.get_vagan_batch_size(),
+                only_final=True
+            )
+            for fid, im in zip(step_fids, last_images):
+                fid_to_image[fid] = self.postprocess_far_prediction(im)
+
+        return fid_to_image
+
+    def precompute_groups(self, groups):
+        if self.get_vagan_batch_size() is None:
+            return {}
+
+        fids = set([fid for g in groups for fid in g.file_ids])
+        if self.cache_preprocessing():
+            fids = fids.difference(self.cached_computations.keys())
+
+        fid_to_image = self.preprocess_images(sorted(list(fids)))
+        if self.cache_preprocessing():
+            self.cached_computations.update(fid_to_image)
+        return fid_to_image
 
     def get_input_fn(self, mode):
         batches = self.get_batches(mode)
         groups = [group for batch in batches for group in batch]
         group_size = len(groups[0].file_ids)
         files = [group.file_ids for group in groups]
+        precomputed = self.precompute_groups(groups)
 
         # get feature names present in csv file (e.g. patient_label)
         # and added during preprocessing (e.g. file_name)
@@ -105,13 +249,13 @@ class VaganFarPredictions(MRISingleStream):
             file_ids = [fid.decode('utf-8') for fid in file_ids]
             ret = []
             for fid in file_ids:
-                path = self.get_file_path(fid)
-
                 file_features = self.file_id_to_meta[fid]
 
-                if (fid not in self.cached_computations) or \
+                if fid in precomputed:
+                    image = precomputed[fid]
+                elif (fid not in self.cached_computations) or \
                         not self.cache_preprocessing():
-                    image = self.load_sample(path).astype(np.float32)
+                    image = self.load_sample_by_id(fid).astype(np.float32)
                     image = self.preprocess_image(fid, image)
 
                     if self.cache_preprocessing():
@@ -211,6 +355,7 @@ class VaganFarPredictions(MRISingleStream):
 
         group_size = len(groups[0].file_ids)
         files = [group.file_ids for group in groups]
+        precomputed = self.precompute_groups(groups)
 
         # get feature names present in csv file (e.g. patient_label)
         # and added during preprocessing (e.g. file_name)
@@ -228,13 +373,13 @@ class VaganFarPredictions(MRISingleStream):
             file_ids = [fid.decode('utf-8') for fid in file_ids]
             ret = []
             for fid in file_ids:
-                path = self.get_file_path(fid)
-
                 file_features = self.file_id_to_meta[fid]
 
-                if (fid not in self.cached_computations) or \
+                if fid in precomputed:
+                    image = precomputed[fid]
+                elif (fid not in self.cached_computations) or \
                         not self.cache_preprocessing():
-                    image = self.load_sample(path).astype(np.float32)
+                    image = self.load_sample_by_id(fid).astype(np.float32)
                     image = self.preprocess_image(fid, image)
 
                     if self.cache_preprocessing():
@@ -4,11 +4,16 @@ import pydoc
 from collections import OrderedDict
 import itertools
 import sys
+import time
+import queue
+import threading
+from collections import deque
 import pandas as pd
 
 from src.data.streaming.mri_streaming import MRISingleStream
 from src.baum_vagan.utils import map_image_to_intensity_range
 from src.data.streaming.base import Group
+from src.data.streaming.caching import LRUCache
 
 
 ROUND_ROBIN = "round-robin"
@@ -16,14 +21,166 @@ PROPORTIONAL_SAMPLING = "proportional-sampling"
 PROPORTIONAL_DETERMINISTIC = "proportional-deterministic"
 
 
-class BatchProvider(object):
+class PrefetchError(object):
+    def __init__(self, error):
+        self.error = error
+
+
+class PrefetchQueue(object):
+    """
+    Bounded queue filled with loaded samples by a background thread.
+    Chunks are produced by a single thread, hence the sample order only
+    depends on the seed of the provider. The thread is started by the
+    first get and ended by stop.
+    """
+    def __init__(self, load_chunk, max_size):
+        """
+        Args:
+            - load_chunk: function returning a list of loaded samples
+            - max_size: maximum number of samples waiting in the queue
+        """
+        self.load_chunk = load_chunk
+        self.queue = queue.Queue(maxsize=max_size)
+        self.thread = None
+        self.stop_event = threading.Event()
+        # counters
+        self.n_gets = 0
+        self.n_waits = 0
+        self.wait_time = 0
+
+    def start(self):
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.fill, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """
+        End the background thread, samples still in the queue are
+        dropped.
+        """
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        while not self.queue.empty():
+            self.queue.get_nowait()
+
+    def fill(self):
+        try:
+            while not self.stop_event.is_set():
+                for el in self.load_chunk():
+                    if not self.put(el):
+                        return
+        except Exception as e:
+            self.put(PrefetchError(e))
+
+    def put(self, el):
+        """
+        Return:
+            - False if the queue was stopped while waiting for space
+        """
+        while not self.stop_event.is_set():
+            try:
+                self.queue.put(el, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def get(self):
+        if self.thread is None:
+            self.start()
+
+        if self.queue.empty():
+            self.n_waits += 1
+        t0 = time.time()
+        el = self.queue.get()
+        self.wait_time += time.time() - t0
+
+        if isinstance(el, PrefetchError):
+            raise el.error
+
+        self.n_gets += 1
+        return el
+
+    def get_queue_depth(self):
+        return self.queue.qsize()
+
+    def get_stats(self):
+        return {
+            "queue_depth": self.get_queue_depth(),
+            "n_gets": self.n_gets,
+            "n_waits": self.n_waits,
+            "wait_time": self.wait_time
+        }
+
+
+class PrefetchingProvider(object):
+    """
+    Base class for providers loading samples in chunks of size
+    'prefetch'. If 'background_prefetch' is set in the streamer config,
+    chunks are loaded by a background thread into a bounded queue
+    of size 'prefetch_queue_size' (defaults to prefetch).
+    """
+    def load_chunk(self):
+        """
+        Return:
+            - list of [image, label]
+        """
+        pass
+
+    def do_background_prefetch(self):
+        return "background_prefetch" in self.streamer.config and \
+            self.streamer.config["background_prefetch"]
+
+    def get_queue_size(self):
+        if "prefetch_queue_size" in self.streamer.config:
+            return self.streamer.config["prefetch_queue_size"]
+        return max(self.prefetch, 1)
+
+    def next_image(self):
+        if self.do_background_prefetch():
+            self.prefetch_queue = PrefetchQueue(
+                load_chunk=self.load_chunk,
+                max_size=self.get_queue_size()
+            )
+            while (1):
+                yield self.prefetch_queue.get()
+
+        loaded = deque()
+        while (1):
+            if len(loaded) == 0:
+                loaded.extend(self.load_chunk())
+            yield loaded.popleft()
+
+    def get_prefetch_stats(self):
+        if self.prefetch_queue is None:
+            return None
+        return self.prefetch_queue.get_stats()
+
+    def stop_prefetch(self):
+        if self.prefetch_queue is not None:
+            self.prefetch_queue.stop()
+
+    def next_batch(self, batch_size):
+        X_batch = []
+        y_batch = []
+        for i in range(batch_size):
+            x, y = next(self.img_gen)
+            X_batch.append(x)
+            y_batch.append(y)
+
+        return np.array(X_batch), np.array(y_batch)
+
+
+class BatchProvider(PrefetchingProvider):
     def __init__(self, streamer, file_ids, label_key, prefetch=1000, seed=11):
         self.file_ids = file_ids
         assert len(file_ids) > 0
         self.streamer = streamer
         self.label_key = label_key
         self.prefetch = prefetch
-        self.loaded = []
+        self.prefetch_queue = None
         self.np_random = np.random.RandomState(seed=seed)
         self.fid_gen = self.next_fid()
         self.img_gen = self.next_image()
@@ -39,40 +196,27 @@ class BatchProvider(object):
                 p = 0
                 self.np_random.shuffle(self.file_ids)
 
-    def next_image(self):
-        loaded = []
-
-        while (1):
-            if len(loaded) == 0:
-                # prefetch
-                for i in range(self.prefetch):
-                    fid = next(self.fid_gen)
-                    p = self.streamer.get_file_path(fid)
-                    im = self.streamer.load_sample(p)
-                    if self.streamer.normalize_images:
-                        im = self.streamer.normalize_image(im)
-                    label = self.streamer.get_meta_info_by_key(
-                        fid, self.label_key
-                    )
-                    im = np.reshape(im, tuple(list(im.shape) + [1]))
-                    loaded.append([im, label])
-            else:
-                el = loaded[0]
-                loaded.pop(0)
-                yield el
+    def load_chunk(self):
+        n = max(self.prefetch, 1)
+        fids = [next(self.fid_gen) for i in range(n)]
+        images = np.stack([
+            self.streamer.load_sample_by_id(fid) for fid in fids
+        ])
+        if self.streamer.normalize_images:
+            images = self.streamer.normalize_image_batch(images)
+        images = images[..., np.newaxis]
 
-    def next_batch(self, batch_size):
-        X_batch = []
-        y_batch = []
-        for i in range(batch_size):
-            x, y = next(self.img_gen)
-            X_batch.append(x)
-            y_batch.append(y)
+        loaded = []
+        for fid, im in zip(fids, images):
+            label = self.streamer.get_meta_info_by_key(
+                fid, self.label_key
+            )
+            loaded.append([im, label])
 
-        return np.array(X_batch), np.array(y_batch)
+        return loaded
 
 
-class FlexibleBatchProvider(object):
+class FlexibleBatchProvider(PrefetchingProvider):
     def __init__(self, streamer, samples, label_key, prefetch=100, seed=11):
         self.samples = samples
         self.indices = list(range(len(samples)))
@@ -80,7 +224,7 @@ class FlexibleBatchProvider(object):
         self.streamer = streamer
         self.label_key = label_key
         self.prefetch = prefetch
-        self.loaded = []
+        self.prefetch_queue = None
         self.np_random = np.random.RandomState(seed=seed)
         self.idx_gen = self.next_idx()
         self.img_gen = self.next_image()
@@ -96,43 +240,46 @@ class FlexibleBatchProvider(object):
                 p = 0
                 self.np_random.shuffle(self.indices)
 
-    def next_image(self):
-        loaded = []
+    def load_chunk(self):
+        n = max(self.prefetch, 1)
+        samples = [self.samples[next(self.idx_gen)] for i in range(n)]
 
-        while (1):
+        if self.streamer.image_cache is not None:
+            # Only load the images into the cache, pairs are
+            # assembled in next_batch
             if self.prefetch > 0:
-                if len(loaded) == 0:
-                    # prefetch
-                    for i in range(self.prefetch):
-                        idx = next(self.idx_gen)
-                        sample = self.samples[idx]
-                        # labels are not used by VAGAN, only needed
-                        # for compatibility
-                        label = (sample.fid1, sample.fid2)
-                        im = sample.load()
-                        loaded.append([im, label])
-                else:
-                    el = loaded[0]
-                    loaded.pop(0)
-                    yield el
-            else:
-                idx = next(self.idx_gen)
-                sample = self.samples[idx]
-                # labels are not used by VAGAN, only needed
-                # for compatibility
-                label = (sample.fid1, sample.fid2)
-                im = sample.load()
-                yield im, label
+                load_pair_images(self.streamer, samples)
+            return [[sample, (sample.fid1, sample.fid2)]
+                    for sample in samples]
+
+        if self.prefetch > 0:
+            images = load_pair_samples(self.streamer, samples)
+        else:
+            images = [sample.load() for sample in samples]
+
+        # labels are not used by VAGAN, only needed
+        # for compatibility
+        return [[im, (sample.fid1, sample.fid2)]
+                for sample, im in zip(samples, images)]
 
     def next_batch(self, batch_size):
-        X_batch = []
+        if self.streamer.image_cache is None:
+            return super(FlexibleBatchProvider, self).next_batch(batch_size)
+
+        # Assemble the pairs directly into the batch array
+        X_batch = None
         y_batch = []
         for i in range(batch_size):
-            x, y = next(self.img_gen)
-            X_batch.append(x)
+            sample, y = next(self.img_gen)
+            if X_batch is None:
+                x = sample.load()
+                X_batch = np.empty((batch_size,) + x.shape, dtype=x.dtype)
+                X_batch[0] = x
+            else:
+                sample.load(out=X_batch[i])
             y_batch.append(y)
 
-        return np.array(X_batch), np.array(y_batch)
+        return X_batch, np.array(y_batch)
 
 
 class SameDeltaBatchProvider(object):
@@ -228,6 +375,14 @@ class SameDeltaBatchProvider(object):
         self.deltas = sorted(self.delta_to_samples.keys())
         self.delta_gen = itertools.cycle(self.deltas)
 
+    def get_prefetch_stats(self):
+        stats = OrderedDict()
+        for delta, provider in self.delta_to_provider.items():
+            stats[delta] = provider.get_prefetch_stats()
+        if all(v is None for v in stats.values()):
+            return None
+        return stats
+
     def next_batch(self, batch_size):
         provider = next(self.provider_gen)
 
@@ -345,6 +500,8 @@ class MRIImagePair(MRISample):
             self.slice_axis, self.slice_idx = self.streamer.get_slice_info()
 
         self.cache_images = self.streamer.do_cache_images()
+        # normalized images shared by all pairs of the streamer
+        self.image_cache = self.streamer.image_cache
         self.raw_data = None
 
     def set_approx_delta(self, delta):
@@ -366,11 +523,7 @@ class MRIImagePair(MRISample):
         return self.streamer.get_patient_id(self.fid1) == \
             self.streamer.get_patient_id(self.fid2)
 
-    def load_image(self, fid):
-        p = self.streamer.get_file_path(fid)
-        im = self.streamer.load_raw_sample(p)
-        if self.streamer.normalize_images:
-            im = self.streamer.normalize_image(im)
+    def postprocess_image(self, im):
         if self.streamer.rescale_to_one:
             im = map_image_to_intensity_range(im, -1, 1, 5)
         if self.slice:
@@ -378,22 +531,58 @@ class MRIImagePair(MRISample):
         im = np.reshape(im, tuple(list(im.shape) + [1]))
         return im
 
-    def load(self):
-        if self.raw_data is None:
-            im1 = self.load_image(self.fid1)
-            im2 = self.load_image(self.fid2)
+    def load_image(self, fid):
+        if self.image_cache is not None:
+            im = self.image_cache.get(fid)
+            if im is not None:
+                return im
 
-            delta_im = im2 - im1
-            im = np.concatenate((im1, delta_im), axis=-1)
+        p = self.streamer.get_file_path(fid)
+        im = self.streamer.load_raw_sample(p)
+        if self.streamer.normalize_images:
+            im = self.streamer.normalize_image(im)
+        im = self.postprocess_image(im)
+
+        if self.image_cache is not None:
+            self.image_cache.put(fid, im)
+        return im
 
-            if self.slice or self.cache_images:
-                self.raw_data = im
+    def allocate(self, im1, im2, n_channels):
+        shape = tuple(list(im1.shape[:-1]) + [n_channels])
+        return np.empty(shape, dtype=np.result_type(im1, im2))
 
-        elif self.raw_data is not None:
-            im = self.raw_data
+    def combine_images(self, im1, im2, out=None):
+        if out is None:
+            out = self.allocate(im1, im2, 2)
+        out[..., :1] = im1
+        np.subtract(im2, im1, out=out[..., 1:])
+        return out
+
+    def set_images(self, im1, im2, out=None):
+        """
+        Build the sample from already loaded and postprocessed images.
+        If out is given, the sample is written into it.
+        """
+        im = self.combine_images(im1, im2, out)
+        # with an image cache, pairs are assembled on demand
+        if self.image_cache is None and (self.slice or self.cache_images):
+            self.raw_data = im
 
         return im
 
+    def load(self, out=None):
+        if self.raw_data is not None:
+            if out is None:
+                return self.raw_data
+            out[...] = self.raw_data
+            return out
+
+        return self.set_images(
+            self.load_image(self.fid1),
+            self.load_image(self.fid2),
+            out
+        )
+
 
 class MRIImagePairWithDelta(MRIImagePair):
     def __init__(self, *args, **kwargs):
@@ -411,22 +600,85 @@ class MRIImagePairWithDelta(MRIImagePair):
         assert approx_delta >= 0
         self.set_approx_delta(approx_delta)
 
-    def load(self):
-        if self.raw_data is None:
-            im1 = self.load_image(self.fid1)
-            im2 = self.load_image(self.fid2)
-            delta_im = im2 - im1
-            delta = self.get_approx_delta()
-            delta_channel = 0 * im1 + delta
-            im = np.concatenate((im1, delta_channel, delta_im), axis=-1)
+    def combine_images(self, im1, im2, out=None):
+        if out is None:
+            out = self.allocate(im1, im2, 3)
+        out[..., :1] = im1
+        out[..., 1] = self.get_approx_delta()
+        np.subtract(im2, im1, out=out[..., 2:])
+        return out
+
+
+def load_pair_images(streamer, samples):
+    """
+    Load the distinct images of a list of image pairs. Images
+    missing in the image cache of the streamer are normalized in
+    one batch and added to the cache.
+
+    Args:
+        - streamer: streamer the samples belong to
+        - samples: list of MRIImagePair
+    Return:
+        - dictionary mapping file IDs to postprocessed images
+    """
+    fid_to_image = {}
+    fid_to_sample = {}
+    for sample in samples:
+        if sample.raw_data is not None:
+            continue
+        for fid in [sample.fid1, sample.fid2]:
+            if fid in fid_to_image or fid in fid_to_sample:
+                continue
+            im = None
+            if streamer.image_cache is not None:
+                im = streamer.image_cache.get(fid)
+            if im is not None:
+                fid_to_image[fid] = im
+            else:
+                fid_to_sample[fid] = sample
 
-            if self.slice or self.cache_images:
-                self.raw_data = im
+    fids = sorted(list(fid_to_sample.keys()))
+    if len(fids) > 0:
+        images = np.stack([
+            streamer.load_raw_sample(streamer.get_file_path(fid))
+            for fid in fids
+        ])
+        if streamer.normalize_images:
+            images = streamer.normalize_image_batch(images)
 
-        elif self.raw_data is not None:
-            im = self.raw_data
+        for fid, im in zip(fids, images):
+            im = fid_to_sample[fid].postprocess_image(im)
+            if streamer.image_cache is not None:
+                streamer.image_cache.put(fid, im)
+            fid_to_image[fid] = im
+
+    return fid_to_image
 
-        return im
+
+def load_pair_samples(streamer, samples):
+    """
+    Load a list of image pairs. Every distinct image is loaded once
+    and all of them are normalized in one batch.
+
+    Args:
+        - streamer: streamer the samples belong to
+        - samples: list of MRIImagePair
+    Return:
+        - list of loaded samples
+    """
+    fid_to_image = load_pair_images(streamer, samples)
+
+    loaded = []
+    for sample in samples:
+        if sample.raw_data is not None:
+            loaded.append(sample.raw_data)
+        else:
+            loaded.append(sample.set_images(
+                fid_to_image[sample.fid1],
+                fid_to_image[sample.fid2]
+            ))
+
+    return loaded
 
 
 class AgeFixedDeltaStream(MRISingleStream):
@@ -450,103 +702,114 @@ class AgeFixedDeltaStream(MRISingleStream):
 
         self.provider = FlexibleBatchProvider
         self.image_type = MRIImagePair
+        # Built on first use, see get_patient_index
+        self.patient_index = None
+        self.pairs_cache = {}
         super(AgeFixedDeltaStream, self).__init__(
             stream_config=stream_config
         )
+        self.set_up_image_cache()
 
         self.load_test_pairs = "load_test_pairs" in self.config \
             and self.config["load_test_pairs"]
         self.prefetch = self.config["prefetch"]
         self.set_up_batches()
 
+    def set_up_image_cache(self):
+        """
+        Normalized images shared by all pairs, as a scan is part
+        of many pairs.
+        """
+        self.image_cache = None
+        if self.do_cache_images():
+            self.image_cache = LRUCache(self.get_image_cache_size())
+
+    def get_image_cache_size(self):
+        """
+        Maximum number of images held by the image cache, set by the
+        optional 'image_cache_size' config key. Without it, every image
+        stays in memory (cache_images: True). A cap should be larger
+        than the number of images of a prefetched chunk of pairs.
+        Return:
+            - maximum number of images, None if unbounded
+        """
+        if "image_cache_size" in self.config:
+            return self.config["image_cache_size"]
+        return None
+
     def is_valid_delta(self, delta):
         return delta >= self.delta_min and delta <= self.delta_max
 
+    def valid_delta_mask(self, deltas):
+        """
+        Vectorized version of is_valid_delta.
+        """
+        return (deltas >= self.delta_min) & (deltas <= self.delta_max)
+
+    def get_patient_index(self):
+        if self.patient_index is None:
+            fids = [fid for fid, meta in self.file_id_to_meta.items()
+                    if "file_path" in meta]
+            self.patient_index = PatientIndex(self, fids)
+        return self.patient_index
+
+    def get_valid_pairs(self, ages):
+        """
+        Args:
+            - ages: ascending ages of the images of a patient
+        Return:
+            - indices (i, j), i < j, of all image pairs having
+              a valid age difference, ordered by i and then j
+        """
+        deltas = ages[np.newaxis, :] - ages[:, np.newaxis]
+        mask = np.triu(self.valid_delta_mask(deltas), k=1)
+        return np.nonzero(mask)
+
     def select_file_ids(self, file_ids):
-        file_ids = sorted(file_ids)
-        patient_groups = self.make_patient_groups(file_ids)
         keep_fids = set()
-        for g in patient_groups:
-            # Analyze patient
-            # Determine if patient can be used
-            diagnoses = set([])
-            for fid in g.file_ids:
-                diag = self.get_diagnose(fid)
-                diagnoses.add(diag)
+        for fids, ages, diagnoses in self.get_patient_index().select(file_ids):
             # multiple diagnoses
-            if len(diagnoses) > 1 and not self.use_converting:
+            if len(set(diagnoses)) > 1 and not self.use_converting:
                 continue
 
-            # Determine which images can be used
-            # Sort by ascending age
-            age_ascending = sorted(
-                g.file_ids,
-                key=lambda x: self.get_exact_age(x)
-            )
-
             # Filter out same age images
-            n = len(age_ascending)
             if not self.use_retest:
-                to_remove = []
-                for i in range(1, n):
-                    prev_age = self.get_exact_age(age_ascending[i - 1])
-                    cur_age = self.get_exact_age(age_ascending[i])
-                    if prev_age == cur_age:
-                        to_remove.append(i)
-                to_remove.reverse()
-                for i in to_remove:
-                    del age_ascending[i]
-
-            n = len(age_ascending)
-            # Consider all possible pairs of images
-            for i in range(n):
-                i_fid = age_ascending[i]
-                age_i = self.get_exact_age(i_fid)
-                for j in range(i + 1, n):
-                    j_fid = age_ascending[j]
-                    age_j = self.get_exact_age(j_fid)
-                    delta = age_j - age_i
-                    if not self.is_valid_delta(delta):
-                        continue
-
-                    diag_i = self.get_diagnose(i_fid)
-                    diag_j = self.get_diagnose(j_fid)
-
-                    if diag_i in self.use_diagnoses and \
-                            diag_j in self.use_diagnoses:
-                        keep_fids.add(i_fid)
-                        keep_fids.add(j_fid)
+                keep = np.ones(len(ages), dtype=bool)
+                keep[1:] = ages[1:] != ages[:-1]
+                fids = fids[keep]
+                ages = ages[keep]
+                diagnoses = diagnoses[keep]
+
+            used = np.array([d in self.use_diagnoses for d in diagnoses],
+                            dtype=bool)
+            i, j = self.get_valid_pairs(ages)
+            both = used[i] & used[j]
+            keep_fids.update(fids[i[both]])
+            keep_fids.update(fids[j[both]])
 
         return sorted(list(keep_fids))
 
     def build_pairs(self, fids):
-        pairs = []
+        """
+        Pairs are only built once for a given set of selected
+        file IDs and then reused.
+        """
         fids = self.select_file_ids(fids)
-        patient_groups = self.make_patient_groups(fids)
-        for g in patient_groups:
-            g_ids = g.file_ids
-            age_ascending = sorted(
-                g_ids,
-                key=lambda x: self.get_exact_age(x)
-            )
-
-            n = len(age_ascending)
-            for i in range(n):
-                age_i = self.get_exact_age(age_ascending[i])
-                for j in range(i + 1, n):
-                    age_j = self.get_exact_age(age_ascending[j])
-                    delta = age_j - age_i
+        key = tuple(fids)
+        if key in self.pairs_cache:
+            return list(self.pairs_cache[key])
 
-                    if not self.is_valid_delta(delta):
-                        continue
-
-                    pairs.append(self.image_type(
-                        streamer=self,
-                        fid1=age_ascending[i],
-                        fid2=age_ascending[j]
-                    ))
+        pairs = []
+        for p_fids, ages, _ in self.get_patient_index().select(fids):
+            for i, j in zip(*self.get_valid_pairs(ages)):
+                pairs.append(self.image_type(
+                    streamer=self,
+                    fid1=p_fids[i],
+                    fid2=p_fids[j]
+                ))
 
-        return pairs
+        self.pairs_cache[key] = pairs
+        return list(pairs)
 
     def check_pairs(self, pairs):
         # Some checks
@@ -645,6 +908,72 @@ class AgeFixedDeltaStream(MRISingleStream):
         return self.train_pairs + self.val_pairs + self.test_pairs
 
 
+class PatientIndex(object):
+    """
+    File IDs of every patient sorted by ascending age (ties
+    by file ID), with ages stored as arrays. Diagnoses are only
+    looked up for selected file IDs, so a missing diagnosis
+    raises as soon as its file ID is used.
+    """
+    def __init__(self, streamer, fids):
+        self.streamer = streamer
+        self.fid_to_diagnose = {}
+        patient_to_fids = OrderedDict()
+        for fid in sorted(fids):
+            patient = streamer.get_patient_id(fid)
+            if patient not in patient_to_fids:
+                patient_to_fids[patient] = []
+            patient_to_fids[patient].append(fid)
+
+        self.fid_to_patient = {}
+        self.patient_to_arrays = OrderedDict()
+        for patient, p_fids in patient_to_fids.items():
+            ages = [streamer.get_exact_age(fid) for fid in p_fids]
+            order = np.argsort(ages, kind='mergesort')
+            p_fids = np.array(p_fids, dtype=object)[order]
+            self.patient_to_arrays[patient] = (
+                p_fids,
+                np.array(ages, dtype=np.float64)[order]
+            )
+            for fid in p_fids:
+                self.fid_to_patient[fid] = patient
+
+    def select(self, fids):
+        """
+        Args:
+            - fids: subset of the indexed file IDs
+        Return:
+            - list of (fids, ages, diagnoses) per patient, restricted
+              to the given file IDs. Patients are ordered as in
+              make_patient_groups(sorted(fids)).
+        """
+        fids = set(fids)
+        patients = OrderedDict()
+        for fid in sorted(fids):
+            if fid in self.fid_to_patient:
+                patients[self.fid_to_patient[fid]] = None
+
+        res = []
+        for patient in patients:
+            p_fids, ages = self.patient_to_arrays[patient]
+            mask = np.array([fid in fids for fid in p_fids], dtype=bool)
+            p_fids = p_fids[mask]
+            diagnoses = np.empty(len(p_fids), dtype=object)
+            diagnoses[:] = [self.get_diagnose(fid) for fid in p_fids]
+            res.append((p_fids, ages[mask], diagnoses))
+
+        return res
+
+    def get_diagnose(self, fid):
+        """
+        Raises ValueError like streamer.get_diagnose if
+        the diagnosis is missing.
+        """
+        if fid not in self.fid_to_diagnose:
+            self.fid_to_diagnose[fid] = self.streamer.get_diagnose(fid)
+        return self.fid_to_diagnose[fid]
+
+
 class Patient(object):
     def __init__(self, patient_id, delta_to_pairs):
         self.patient_id = patient_id
@@ -761,6 +1090,8 @@ class AgeVariableDeltaStream(AgeFixedDeltaStream):
         # Batch provider class
         self.provider = pydoc.locate(config["batch_provider"])
         self.image_type = MRIImagePairWithDelta
+        self.patient_index = None
+        self.pairs_cache = {}
 
         # Different patient order for real and fake samples
         self.shuffle_real_fake = config["shuffle_real_fake"]
@@ -768,6 +1099,7 @@ class AgeVariableDeltaStream(AgeFixedDeltaStream):
         super(AgeFixedDeltaStream, self).__init__(
             stream_config=stream_config
         )
+        self.set_up_image_cache()
 
         self.load_test_pairs = "load_test_pairs" in self.config \
             and self.config["load_test_pairs"]
@@ -932,3 +1264,10 @@ class AgeVariableDeltaStream(AgeFixedDeltaStream):
                 return True
 
         return False
+
+    def valid_delta_mask(self, deltas):
+        mask = np.zeros(deltas.shape, dtype=bool)
+        for delta_range in self.delta_ranges.values():
+            mask |= (delta_range[0] <= deltas) & (deltas <= delta_range[1])
+
+        return mask
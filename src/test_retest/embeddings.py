@@ -0,0 +1,120 @@
+import glob
+import json
+import os
+import numpy as np
+from collections import OrderedDict
+
+from src.data.streaming.caching import save_npy_atomic, \
+    directory_signature, LRUCache
+
+
+# Subfolder of a feature folder containing the consolidated matrices
+EMBEDDINGS_FOLDER = "embeddings"
+PART_PREFIX = "part_"
+
+# Maximum number of feature folders whose stores (and memory maps) are
+# kept open by the process. Feature folders are per epoch and split,
+# so stores of previous epochs are dropped first.
+MAX_EMBEDDING_STORES = 8
+_STORES = LRUCache(MAX_EMBEDDING_STORES)
+
+
+def save_embeddings(folder, names, matrix):
+    """
+    Write a consolidated embedding matrix to the feature folder.
+    Every call adds a new part, parts written later take precedence
+    for names contained in several parts.
+
+    Args:
+        - folder: feature folder
+        - names: file names of the rows of matrix (the names of the
+          per-image .npy files)
+        - matrix: array of shape (n_images, ...)
+    """
+    assert len(names) == len(matrix)
+    out_dir = os.path.join(folder, EMBEDDINGS_FOLDER)
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    i = len(glob.glob(os.path.join(out_dir, PART_PREFIX + "*.npy")))
+    path = os.path.join(out_dir, "{}{:04d}".format(PART_PREFIX, i))
+    # index first, a part is only read once its matrix exists
+    with open(path + ".json", 'w') as f:
+        json.dump(list(names), f)
+    save_npy_atomic(path + ".npy", matrix)
+
+
+class EmbeddingStore(object):
+    """
+    Read access to the embeddings of a feature folder. Consolidated
+    matrices are memory-mapped if the folder contains any, otherwise
+    the per-image .npy files are read.
+    """
+    def __init__(self, folder):
+        self.folder = folder
+        self.matrices = []
+        # maps file names to (part, row), or None for per-image files
+        self.name_to_row = OrderedDict()
+
+        parts = sorted(glob.glob(os.path.join(
+            folder, EMBEDDINGS_FOLDER, PART_PREFIX + "*.npy"
+        )))
+        for p in parts:
+            with open(p[:-len(".npy")] + ".json", 'r') as f:
+                names = json.load(f)
+            for i, name in enumerate(names):
+                self.name_to_row[name] = (len(self.matrices), i)
+            self.matrices.append(np.load(p, mmap_mode='r'))
+
+        self.consolidated = len(parts) > 0
+        if not self.consolidated:
+            for f in sorted(os.listdir(folder)):
+                if f.endswith(".npy"):
+                    self.name_to_row[f[:-len(".npy")]] = None
+
+    def get_names(self):
+        return list(self.name_to_row.keys())
+
+    def __contains__(self, name):
+        return name in self.name_to_row
+
+    def __len__(self):
+        return len(self.name_to_row)
+
+    def get(self, name):
+        """
+        Return:
+            - embedding of the image with the given file name
+        """
+        if not self.consolidated:
+            return np.load(os.path.join(self.folder, name + ".npy"))
+        part, i = self.name_to_row[name]
+        return np.array(self.matrices[part][i])
+
+    def get_matrix(self, names):
+        """
+        Return:
+            - array of shape (len(names), ...) containing the
+              embeddings of the given file names
+        """
+        return np.array([self.get(name) for name in names])
+
+
+def load_embeddings(folder):
+    """
+    Process-wide memoization of EmbeddingStore, such that hooks
+    evaluating the same feature folder share the loaded index and
+    memory maps. Adding files to the folder invalidates the store.
+    At most MAX_EMBEDDING_STORES stores are kept, the least recently
+    used is dropped first.
+    """
+    signature = directory_signature(os.path.join(folder, "*.npy")) + \
+        directory_signature(os.path.join(folder, EMBEDDINGS_FOLDER, "*.npy"))
+    key = os.path.abspath(folder)
+    cached = _STORES.get(key)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+
+    store = EmbeddingStore(folder)
+    _STORES.put(key, (signature, store))
+    return store
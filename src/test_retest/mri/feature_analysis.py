@@ -10,6 +10,8 @@ from collections import OrderedDict
 
 
 from modules.models.data_transform import DataTransformer
+from src.test_retest import numpy_utils
+from src.test_retest.embeddings import load_embeddings
 
 JSON_TYPE = '.json'
 NUMPY_TYPE = '.npy'
@@ -38,11 +40,24 @@ class RobustnessMeasureComputation(DataTransformer):
         self.file_name_key = file_name_key
         self.output_dir = output_dir
         self.robustness_folder = robustness_folder
+        self.embeddings = None
+
+    def get_embeddings(self):
+        """
+        Return:
+            - EmbeddingStore of the features path, shared by all
+              streamers and with other hooks reading the same folder
+        """
+        if self.embeddings is None:
+            self.embeddings = load_embeddings(self.features_path)
+        return self.embeddings
 
     def construct_file_path(self, file_name):
         return os.path.join(self.features_path, file_name + self.file_type)
 
     def features_exist(self, file_name):
+        if self.file_type == NUMPY_TYPE:
+            return file_name in self.get_embeddings()
         p = self.construct_file_path(file_name)
         return os.path.isfile(p)
 
@@ -53,16 +68,16 @@ class RobustnessMeasureComputation(DataTransformer):
               to their value
         """
         assert self.file_type in FILE_TYPES
+        if self.file_type == NUMPY_TYPE:
+            features_vec = self.get_embeddings().get(file_name)
+            return {
+                str(i): val
+                for i, val in enumerate(features_vec)
+            }
+
         p = self.construct_file_path(file_name)
         with open(p) as f:
-            if self.file_type == JSON_TYPE:
-                features_dic = json.load(f)
-            elif self.file_type == NUMPY_TYPE:
-                features_vec = np.load(p)
-                features_dic = {
-                    str(i): val
-                    for i, val in enumerate(features_vec)
-                }
+            features_dic = json.load(f)
 
         return features_dic
 
@@ -90,22 +105,24 @@ class RobustnessMeasureComputation(DataTransformer):
                       .format(file_name_1, file_name_2))
 
         # Compute robustness measure using different features
-        feature_names = features[0][0].keys()
-        computation_dic = {}
+        feature_names = list(features[0][0].keys())
+        # shape (n_pairs, 2, n_features)
+        Y = np.array([
+            [[f1[name] for name in feature_names],
+             [f2[name] for name in feature_names]]
+            for f1, f2 in features
+        ])
+        all_values = numpy_utils.per_feature_measures(
+            Y, self.robustness_funcs
+        )
 
-        for name in feature_names:
-            Y = []
+        computation_dic = {}
+        for i, name in enumerate(feature_names):
             feature_dic = {}
             computation_dic[name] = feature_dic
-            for f in features:
-                Y.append([f[0][name], f[1][name]])
-
-            feature_dic["n_samples"] = len(Y)
-            Y = np.array(Y)
-            for func in self.robustness_funcs:
-                r = func(Y)
-                r = float(r)
-                feature_dic[func.__name__] = r
+            feature_dic["n_samples"] = len(features)
+            for func, values in zip(self.robustness_funcs, all_values):
+                feature_dic[func.__name__] = float(values[i])
 
         return computation_dic
 
@@ -425,3 +442,4 @@ class RobustnessMeasureComputation(DataTransformer):
         # Make pickable
         self.streamers = None
         self.streamer_collection = None
+        self.embeddings = None
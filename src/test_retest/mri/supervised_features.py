@@ -65,7 +65,8 @@ class PairClassification(EvaluateEpochsBaseTF):
             logger=self.metric_logger,
             out_dir=self.data_params["dump_out_dir"],
             model_save_path=self.save_path,
-            epoch=self.current_epoch
+            epoch=self.current_epoch,
+            consolidate_embeddings=self.consolidate_embeddings()
         )
 
         if "embeddings" in train_hook_names and not validation:
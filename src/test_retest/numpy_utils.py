@@ -1,5 +1,6 @@
 import numpy as np
 from scipy.stats import pearsonr as sp_pearson
+from scipy.special import betainc
 import math
 
 
@@ -103,6 +104,10 @@ def ICC_A1(Y):
 
 
 def per_feature_ICC(test, retest, icc_func):
+    if icc_func in BATCHED_MEASURES:
+        Y = np.stack((test, retest), axis=1)
+        return BATCHED_MEASURES[icc_func](Y)
+
     n_features = test.shape[1]
 
     iccs = []
@@ -221,4 +226,167 @@ def equal_and_correct_pairs(Y, true_labels):
     corr_0 = Y[:, 0] == true_labels
     corr_1 = Y[:, 1] == true_labels
     corr = corr_0.astype(float) * corr_1.astype(float)
-    return np.mean(eq * corr)
\ No newline at end of file
+    return np.mean(eq * corr)
+
+
+# Batched versions of the measures above. They compute the measure
+# of every feature at once given an array Y of shape
+# (n_subjects, 2, n_features) and return an array of shape (n_features,).
+def _equal_columns(Y):
+    # same as np.array_equal(Y[:, 0], Y[:, 1]) for every feature
+    return np.all(Y[:, 0] == Y[:, 1], axis=0)
+
+
+def _batch_mean_squares(Y):
+    """
+    Return:
+        - MS_R, MS_E and MS_C of every feature
+    """
+    n, k, _ = Y.shape
+    mu = np.mean(Y, axis=(0, 1))
+    row_means = np.mean(Y, axis=1)
+    col_means = np.mean(Y, axis=0)
+
+    ss_r = k * np.sum((row_means - mu)**2, axis=0)
+    ss_e = np.sum(
+        (Y - col_means[np.newaxis] - row_means[:, np.newaxis] + mu)**2,
+        axis=(0, 1)
+    )
+    ss_c = n * np.sum((col_means - mu)**2, axis=0)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        MSR = ss_r / np.float64(n - 1)
+        MSE = ss_e / np.float64((n - 1) * (k - 1))
+        MSC = ss_c / np.float64(k - 1)
+
+    return MSR, MSE, MSC
+
+
+def _batch_ratio(num, denom):
+    """
+    num / denom, 0 if denom is 0 or the result is nan.
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        r = num / denom
+    r[denom == 0] = 0
+    r[np.isnan(r)] = 0
+    return r
+
+
+def batch_ICC_C1(Y):
+    Y = np.asarray(Y, dtype=np.float64)
+    k = Y.shape[1]
+    MSR, MSE, _ = _batch_mean_squares(Y)
+
+    r = _batch_ratio(MSR - MSE, MSR + (k - 1) * MSE)
+    r[(MSR == 0) & (MSE == 0)] = 1
+    r[_equal_columns(Y)] = 1
+    return r
+
+
+def batch_ICC_A1(Y):
+    Y = np.asarray(Y, dtype=np.float64)
+    n, k, _ = Y.shape
+    MSR, MSE, MSC = _batch_mean_squares(Y)
+
+    r = _batch_ratio(
+        MSR - MSE,
+        MSR + (k - 1) * MSE + k / n * (MSC - MSE)
+    )
+    r[_equal_columns(Y)] = 1
+    return r
+
+
+def batch_linccc(Y):
+    Y = np.asarray(Y, dtype=np.float64)
+    mu_Y_1 = np.mean(Y[:, 0], axis=0)
+    mu_Y_2 = np.mean(Y[:, 1], axis=0)
+    S_1_sq = np.mean((Y[:, 0] - mu_Y_1) ** 2, axis=0)
+    S_2_sq = np.mean((Y[:, 1] - mu_Y_2) ** 2, axis=0)
+    S_12 = np.mean((Y[:, 0] - mu_Y_1) * (Y[:, 1] - mu_Y_2), axis=0)
+
+    num = 2 * S_12
+    denom = (S_1_sq + S_2_sq + (mu_Y_1 - mu_Y_2)**2)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ccc_est = num / denom
+    ccc_est[np.isnan(ccc_est)] = 0
+    ccc_est[(num == 0) & (denom == 0)] = 1
+    ccc_est[_equal_columns(Y)] = 1
+    return ccc_est
+
+
+def _batch_pearsonr(Y):
+    """
+    Return:
+        - correlation coefficients and two-sided p-values as computed
+          by scipy.stats.pearsonr, nan for constant features
+    """
+    n = Y.shape[0]
+    if n < 2:
+        raise ValueError("x and y must have length at least 2.")
+
+    xm = Y[:, 0] - np.mean(Y[:, 0], axis=0)
+    ym = Y[:, 1] - np.mean(Y[:, 1], axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        xm = xm / np.linalg.norm(xm, axis=0)
+        ym = ym / np.linalg.norm(ym, axis=0)
+        r = np.clip(np.sum(xm * ym, axis=0), -1, 1)
+
+    if n == 2:
+        p = np.ones(r.shape)
+    else:
+        # the t-test p-value written in terms of r
+        df = n - 2
+        p = betainc(0.5 * df, 0.5, np.clip(1 - r**2, 0, 1))
+    p[np.isnan(r)] = np.nan
+
+    return r, p
+
+
+def batch_pearsonr(Y):
+    Y = np.asarray(Y, dtype=np.float64)
+    r, _ = _batch_pearsonr(Y)
+    r[np.isnan(r)] = 0
+    r[_equal_columns(Y)] = 1
+    return r
+
+
+def batch_pearsonr_pvalue(Y):
+    Y = np.asarray(Y, dtype=np.float64)
+    _, p = _batch_pearsonr(Y)
+    p[np.isnan(p)] = 0
+    p[_equal_columns(Y)] = 0
+    return p
+
+
+# Maps measures to their batched version
+BATCHED_MEASURES = {
+    ICC_C1: batch_ICC_C1,
+    ICC_A1: batch_ICC_A1,
+    linccc: batch_linccc,
+    pearsonr: batch_pearsonr,
+    pearsonr_pvalue: batch_pearsonr_pvalue,
+}
+
+
+def per_feature_measures(Y, funcs):
+    """
+    Args:
+        - Y: array of shape (n_subjects, 2, n_features)
+        - funcs: list of measures taking an array of shape
+          (n_subjects, 2)
+    Return:
+        - list containing an array of shape (n_features,) for every
+          measure. Batched versions are used when available.
+    """
+    res = []
+    for func in funcs:
+        if func in BATCHED_MEASURES:
+            res.append(BATCHED_MEASURES[func](Y))
+        else:
+            res.append(np.array(
+                [func(Y[:, :, i]) for i in range(Y.shape[2])]
+            ))
+
+    return res
@@ -530,6 +530,10 @@ class EvaluateEpochsBaseTF(BaseTF):
 
         return hooks
 
+    def consolidate_embeddings(self):
+        return "consolidate_embeddings" in self.data_params and \
+            self.data_params["consolidate_embeddings"]
+
     def get_batch_dump_hook(self, tensor_val, tensor_name):
         train_hook = BatchDumpHook(
             tensor_batch=tensor_val,
@@ -537,7 +541,8 @@ class EvaluateEpochsBaseTF(BaseTF):
             model_save_path=self.save_path,
             out_dir=self.data_params["dump_out_dir"],
             epoch=self.current_epoch,
-            train=True
+            train=True,
+            consolidate=self.consolidate_embeddings()
         )
         test_hook = BatchDumpHook(
             tensor_batch=tensor_val,
@@ -545,7 +550,8 @@ class EvaluateEpochsBaseTF(BaseTF):
             model_save_path=self.save_path,
             out_dir=self.data_params["dump_out_dir"],
             epoch=self.current_epoch,
-            train=False
+            train=False,
+            consolidate=self.consolidate_embeddings()
         )
         return train_hook, test_hook
 
@@ -582,7 +588,8 @@ class EvaluateEpochsBaseTF(BaseTF):
             logger=self.metric_logger,
             out_dir=self.data_params["dump_out_dir"],
             model_save_path=self.save_path,
-            epoch=self.current_epoch
+            epoch=self.current_epoch,
+            consolidate_embeddings=self.consolidate_embeddings()
         )
 
         if "embeddings" in train_hook_names and not validation:
@@ -19,6 +19,7 @@ import shutil
 from src.test_retest import numpy_utils
 from src.test_retest.metrics import specificity_score
 from src.test_retest.mri.feature_analysis import RobustnessMeasureComputation
+from src.test_retest.embeddings import save_embeddings, load_embeddings
 
 
 class HookFactory(object):
@@ -32,7 +33,8 @@ class HookFactory(object):
                  logger,
                  out_dir,
                  model_save_path,
-                 epoch):
+                 epoch,
+                 consolidate_embeddings=False):
         """
         Args:
             - streamer: streamer used to stream input data
@@ -44,12 +46,15 @@ class HookFactory(object):
             - model_save_path: output data folder that is tracked
               by sumatra (e.g. 'data/20181212-102120')
             - epoch: i-th epoch of training
+            - consolidate_embeddings: True iff batch dump hooks
+              should also write consolidated embedding matrices
         """
         self.streamer = streamer
         self.logger = logger
         self.out_dir = out_dir
         self.model_save_path = model_save_path
         self.epoch = epoch
+        self.consolidate_embeddings = consolidate_embeddings
 
     def get_batch_dump_hook(self, tensor_val, tensor_name):
         train_hook = BatchDumpHook(
@@ -59,6 +64,7 @@ class HookFactory(object):
             out_dir=self.out_dir,
             epoch=self.epoch,
             train=True,
+            consolidate=self.consolidate_embeddings,
         )
         test_hook = BatchDumpHook(
             tensor_batch=tensor_val,
@@ -66,7 +72,8 @@ class HookFactory(object):
             model_save_path=self.model_save_path,
             out_dir=self.out_dir,
             epoch=self.epoch,
-            train=False
+            train=False,
+            consolidate=self.consolidate_embeddings,
         )
         return train_hook, test_hook
 
@@ -360,16 +367,22 @@ class BatchDumpHook(tf.train.SessionRunHook):
     Dump tensor as numpy array to a file.
     """
     def __init__(self, tensor_batch, batch_names, model_save_path,
-                 out_dir, epoch, train=True):
+                 out_dir, epoch, train=True, consolidate=False):
         """
         Args:
             - tensor_batch: tensor containing values that are dumped
             - batch_names: contains the names that are used as output
               file names
+            - consolidate: if True, all dumped values are additionally
+              written to one memory-mappable matrix at the end of the
+              session (see src.test_retest.embeddings)
         """
         self.tensor_batch = tensor_batch
         self.batch_names = batch_names
         self.epoch = epoch
+        self.consolidate = consolidate
+        self.dumped_names = []
+        self.dumped_values = []
         # Extract smt label
         label = os.path.split(model_save_path)[-1]
         if train:
@@ -404,9 +417,25 @@ class BatchDumpHook(tf.train.SessionRunHook):
                 self.out_dir,
                 s_name + ".npy"
             )
+            # per-image files are also the data source of the
+            # robustness streamers
             with open(out_file, 'wb') as f:
                 np.save(f, val)
 
+            if self.consolidate:
+                self.dumped_names.append(s_name)
+                self.dumped_values.append(val)
+
+    def end(self, session):
+        if self.consolidate and len(self.dumped_names) > 0:
+            save_embeddings(
+                self.out_dir,
+                self.dumped_names,
+                np.array(self.dumped_values)
+            )
+        self.dumped_names = []
+        self.dumped_values = []
+
 
 class RobustnessComputationHook(tf.train.SessionRunHook):
     """
@@ -576,22 +605,20 @@ class PredictionHook(tf.train.SessionRunHook):
         self.logger = logger
 
     def load_data(self, folder):
-        vecs = []
+        store = load_embeddings(folder)
+        names = store.get_names()
         labels = []
         image_labels = []
-        for f in os.listdir(folder):
-            p = os.path.join(folder, f)
-            x = np.load(p)
-            vecs.append(x)
+        for name in names:
             # Retrieve label
-            file_name = f.split("_")[0]
+            file_name = name.split("_")[0]
             label = self.streamer.get_meta_info_by_key(
                 file_name, self.target_label
             )
             labels.append(int(label))
             image_labels.append(file_name)
 
-        return np.array(vecs), np.array(labels), image_labels
+        return store.get_matrix(names), np.array(labels), image_labels
 
     def dump_predictions(self, image_labels, predictions, pred_id, train):
         """
@@ -0,0 +1,91 @@
+import os
+import shutil
+import tempfile
+import unittest
+import h5py
+import numpy as np
+
+from src.baum_vagan.data.batch_provider import BatchProvider, read_sorted
+
+
+N = 40
+
+
+def make_data():
+    # X[i] only contains the value i, such that rows can be matched to y
+    X = np.repeat(np.arange(N, dtype=np.float32), 4).reshape(N, 2, 2)
+    y = np.arange(N)
+    return X, y
+
+
+class TestReadSorted(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.X, _ = make_data()
+        self.path = os.path.join(self.tmp_dir, "data.hdf5")
+        with h5py.File(self.path, 'w') as f:
+            f.create_dataset("X", data=self.X)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_same_as_fancy_indexing(self):
+        cases = [
+            np.array([], dtype=np.int64),
+            np.array([5]),
+            np.array([0, 1, 2, 3]),
+            np.array([1, 3, 4, 5, 9, 10, 39]),
+        ]
+        with h5py.File(self.path, 'r') as f:
+            for indices in cases:
+                res = read_sorted(f["X"], indices)
+                self.assertEqual(res.shape, (len(indices), 2, 2))
+                self.assertTrue(np.array_equal(res, self.X[indices]))
+                self.assertTrue(np.array_equal(
+                    read_sorted(self.X, indices), self.X[indices]
+                ))
+
+
+class TestBatchProvider(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(3)
+        self.X, self.y = make_data()
+        # indices do not cover all of X and y, like the validation set
+        self.indices = np.arange(2, N - 2)
+
+    def iter_providers(self):
+        for block_size in [None, 3]:
+            for prefetch in [False, True]:
+                yield BatchProvider(self.X, self.y, self.indices,
+                                    block_size=block_size, prefetch=prefetch)
+
+    def check_batch(self, X_batch, y_batch):
+        self.assertTrue(np.all(X_batch[:, :, :, 0] ==
+                               y_batch[:, np.newaxis, np.newaxis]))
+        self.assertTrue(np.all(np.diff(y_batch) > 0))
+
+    def test_next_batch_without_replacement(self):
+        batch_size = 4
+        n_batches = len(self.indices) // batch_size
+        for provider in self.iter_providers():
+            for epoch in range(2):
+                seen = []
+                for i in range(n_batches):
+                    X_batch, y_batch = provider.next_batch(batch_size)
+                    self.assertEqual(X_batch.shape, (batch_size, 2, 2, 1))
+                    self.check_batch(X_batch, y_batch)
+                    seen += list(y_batch)
+                self.assertEqual(sorted(seen), list(self.indices))
+
+    def test_iterate_batches(self):
+        for provider in self.iter_providers():
+            seen = []
+            for X_batch, y_batch in provider.iterate_batches(7):
+                self.assertLessEqual(len(y_batch), 7)
+                self.check_batch(X_batch, y_batch)
+                seen += list(y_batch)
+            self.assertEqual(sorted(seen), list(self.indices))
+
+
+if __name__ == '__main__':
+    unittest.main()
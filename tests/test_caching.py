@@ -0,0 +1,251 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+from src.data.streaming.caching import VolumeCache, ImageStore, \
+    FarPredictionCache, LRUCache, directory_signature, file_digest, \
+    get_streamer_state, clear_streamer_state
+
+
+class TestVolumeCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmp_dir, "image.npy")
+        np.save(self.src, np.arange(24, dtype=np.float64).reshape(2, 3, 4))
+        self.n_calls = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def compute(self, path):
+        self.n_calls += 1
+        return np.load(path) * 2
+
+    def test_hit_after_miss(self):
+        cache = VolumeCache(os.path.join(self.tmp_dir, "cache"), {"a": 1})
+        im1 = cache.load(self.src, self.compute)
+        im2 = cache.load(self.src, self.compute)
+
+        self.assertEqual(self.n_calls, 1)
+        self.assertEqual(im2.dtype, np.float32)
+        self.assertTrue(isinstance(im2, np.memmap))
+        self.assertTrue(np.array_equal(im1, im2))
+        self.assertTrue(np.array_equal(im2, 2 * np.load(self.src)))
+
+    def test_preprocessing_is_part_of_key(self):
+        cache_dir = os.path.join(self.tmp_dir, "cache")
+        VolumeCache(cache_dir, {"a": 1}).load(self.src, self.compute)
+        VolumeCache(cache_dir, {"a": 2}).load(self.src, self.compute)
+
+        self.assertEqual(self.n_calls, 2)
+
+    def test_modified_file_is_recomputed(self):
+        cache = VolumeCache(os.path.join(self.tmp_dir, "cache"), {"a": 1})
+        cache.load(self.src, self.compute)
+        st = os.stat(self.src)
+        os.utime(self.src, (st.st_atime, st.st_mtime + 10))
+        cache.load(self.src, self.compute)
+
+        self.assertEqual(self.n_calls, 2)
+
+
+class TestImageStore(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.images = {
+            "a": np.ones((2, 3)),
+            "b": 2 * np.ones((2, 3)),
+            "c": 3 * np.ones((2, 3))
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_in_memory(self):
+        store = ImageStore(["c", "a", "b"], lambda fid: self.images[fid])
+
+        self.assertEqual(len(store), 3)
+        self.assertTrue("a" in store)
+        self.assertFalse("d" in store)
+        self.assertEqual(store.data.shape, (3, 2, 3))
+        self.assertEqual(store.data.dtype, np.float32)
+        for fid, im in self.images.items():
+            self.assertTrue(np.array_equal(store.get(fid), im))
+            # zero-copy
+            self.assertTrue(np.shares_memory(store.get(fid), store.data))
+
+    def test_reuse_from_disk(self):
+        path = os.path.join(self.tmp_dir, "store.npy")
+        ImageStore(["a", "b"], lambda fid: self.images[fid], path)
+
+        def fail(fid):
+            raise AssertionError("should not be called")
+
+        store = ImageStore(["a", "b"], fail, path)
+        self.assertTrue(np.array_equal(store.get("b"), self.images["b"]))
+
+    def test_stale_shape_is_rebuilt(self):
+        path = os.path.join(self.tmp_dir, "store.npy")
+        ImageStore(["a", "b"], lambda fid: self.images[fid], path)
+
+        images = {fid: np.ones((4, 4)) for fid in ["a", "b"]}
+        store = ImageStore(["a", "b"], lambda fid: images[fid], path,
+                           sample_shape=(4, 4))
+        self.assertEqual(store.data.shape, (2, 4, 4))
+
+
+class TestFarPredictionCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.images = np.arange(3 * 4, dtype=np.float32).reshape(3, 2, 2)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_steps(self):
+        cache = FarPredictionCache("test_steps")
+        self.assertEqual(cache.get_n_steps("a"), 0)
+        with self.assertRaises(KeyError):
+            cache.get("a", 1)
+
+        cache.put("a", self.images)
+        self.assertEqual(cache.get_n_steps("a"), 3)
+        for step in range(1, 4):
+            self.assertTrue(np.array_equal(
+                cache.get("a", step), self.images[step - 1]
+            ))
+        for step in [0, 4]:
+            with self.assertRaises(KeyError):
+                cache.get("a", step)
+
+        # shorter runs do not replace longer ones
+        cache.put("a", self.images[:1] + 1)
+        self.assertEqual(cache.get_n_steps("a"), 3)
+        self.assertTrue(np.array_equal(cache.get("a", 1), self.images[0]))
+
+    def test_shared_in_process(self):
+        FarPredictionCache("test_shared").put("a", self.images)
+        cache = FarPredictionCache("test_shared")
+        self.assertEqual(cache.get_n_steps("a"), 3)
+        self.assertEqual(FarPredictionCache("other").get_n_steps("a"), 0)
+
+    def test_bounded(self):
+        from src.data.streaming import caching
+        cache = FarPredictionCache("test_bounded")
+        n = caching.FAR_PREDICTION_CACHE_SIZE
+        for i in range(n + 5):
+            cache.put(str(i), self.images)
+        self.assertLessEqual(len(caching._FAR_PREDICTIONS), n)
+        # least recently used file IDs are dropped first
+        self.assertEqual(cache.get_n_steps("0"), 0)
+        self.assertEqual(cache.get_n_steps(str(n + 4)), 3)
+
+    def test_pinned_working_set(self):
+        from src.data.streaming import caching
+        cache = FarPredictionCache("test_pinned")
+        n = caching.FAR_PREDICTION_CACHE_SIZE
+        fid_to_images = {}
+        for i in range(n + 5):
+            fid_to_images[str(i)] = cache.put(str(i), self.images)
+        cache.pin(fid_to_images)
+        # evicted from the LRU cache, but pinned
+        self.assertEqual(cache.get_n_steps("0"), 3)
+        self.assertTrue(np.array_equal(cache.get("0", 2), self.images[1]))
+
+        cache.pin({})
+        self.assertEqual(cache.get_n_steps("0"), 0)
+
+    def test_persisted(self):
+        FarPredictionCache("test_persisted", self.tmp_dir).put(
+            "data/a.nii.gz", self.images
+        )
+        # simulate new process
+        from src.data.streaming import caching
+        caching._FAR_PREDICTIONS.clear()
+
+        cache = FarPredictionCache("test_persisted", self.tmp_dir)
+        self.assertEqual(cache.get_n_steps("data/a.nii.gz"), 3)
+        self.assertTrue(np.array_equal(
+            cache.get("data/a.nii.gz", 2), self.images[1]
+        ))
+
+
+class TestLRUCache(unittest.TestCase):
+    def test_eviction(self):
+        cache = LRUCache(max_size=2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        # "a" becomes most recently used
+        self.assertEqual(cache.get("a"), 1)
+        cache.put("c", 3)
+
+        self.assertEqual(len(cache), 2)
+        self.assertTrue("a" in cache)
+        self.assertFalse("b" in cache)
+        self.assertTrue(cache.get("b") is None)
+        self.assertEqual(cache.get_stats()["hits"], 1)
+        self.assertEqual(cache.get_stats()["misses"], 1)
+
+    def test_unbounded(self):
+        cache = LRUCache()
+        for i in range(100):
+            cache.put(i, i)
+        self.assertEqual(len(cache), 100)
+
+
+class TestStreamerState(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.tmp_dir, "a"))
+        self.n_calls = 0
+        clear_streamer_state()
+
+    def tearDown(self):
+        clear_streamer_state()
+        shutil.rmtree(self.tmp_dir)
+
+    def compute(self):
+        self.n_calls += 1
+        return self.n_calls
+
+    def test_directory_signature(self):
+        pattern = os.path.join(self.tmp_dir, "*", "*.nii.gz")
+        sig = directory_signature(pattern)
+        self.assertEqual(sig[0][0], self.tmp_dir)
+        self.assertEqual(sig, directory_signature(pattern))
+
+        # new subfolder changes the mtime of the static folder
+        os.utime(self.tmp_dir, ns=(0, 0))
+        sig = directory_signature(pattern)
+        os.makedirs(os.path.join(self.tmp_dir, "b"))
+        self.assertNotEqual(sig, directory_signature(pattern))
+
+        folder = os.path.join(self.tmp_dir, "a")
+        pattern = os.path.join(folder, "*.nii.gz")
+        os.utime(folder, ns=(0, 0))
+        sig = directory_signature(pattern)
+        self.assertEqual(sig, ((folder, 0),))
+        open(os.path.join(folder, "1.nii.gz"), 'w').close()
+        self.assertNotEqual(sig, directory_signature(pattern))
+
+    def test_invalidation(self):
+        path = os.path.join(self.tmp_dir, "meta.csv")
+        with open(path, 'w') as f:
+            f.write("a,b\n")
+        sig = file_digest(path)
+
+        self.assertEqual(get_streamer_state("k", sig, self.compute), 1)
+        self.assertEqual(get_streamer_state("k", sig, self.compute), 1)
+        self.assertEqual(get_streamer_state("l", sig, self.compute), 2)
+
+        with open(path, 'a') as f:
+            f.write("1,2\n")
+        sig = file_digest(path)
+        self.assertEqual(get_streamer_state("k", sig, self.compute), 3)
+        self.assertEqual(get_streamer_state("k", sig, self.compute), 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
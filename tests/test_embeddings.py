@@ -0,0 +1,70 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+from src.test_retest.embeddings import save_embeddings, load_embeddings, \
+    EmbeddingStore
+
+
+class TestEmbeddingStore(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        np.random.seed(11)
+        self.names = ["I{}_x".format(i) for i in range(6)]
+        self.vecs = np.random.rand(6, 4).astype(np.float32)
+        for name, v in zip(self.names, self.vecs):
+            np.save(os.path.join(self.folder, name + ".npy"), v)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_per_image_files(self):
+        store = EmbeddingStore(self.folder)
+        self.assertFalse(store.consolidated)
+        self.assertEqual(store.get_names(), self.names)
+        self.assertTrue(np.array_equal(
+            store.get_matrix(self.names[::-1]), self.vecs[::-1]
+        ))
+
+    def test_consolidated(self):
+        save_embeddings(self.folder, self.names[:4], self.vecs[:4])
+        # later parts take precedence
+        new_vecs = self.vecs[3:] + 1
+        save_embeddings(self.folder, self.names[3:], new_vecs)
+
+        store = EmbeddingStore(self.folder)
+        self.assertTrue(store.consolidated)
+        self.assertEqual(len(store), 6)
+        self.assertFalse("embeddings" in store)
+        expected = np.concatenate([self.vecs[:3], new_vecs])
+        self.assertTrue(np.array_equal(
+            store.get_matrix(self.names), expected
+        ))
+        self.assertTrue(np.array_equal(store.get("I4_x"), new_vecs[1]))
+
+    def test_load_embeddings(self):
+        store = load_embeddings(self.folder)
+        self.assertTrue(load_embeddings(self.folder) is store)
+
+        save_embeddings(self.folder, self.names, self.vecs)
+        store = load_embeddings(self.folder)
+        self.assertTrue(store.consolidated)
+        self.assertTrue(np.array_equal(
+            store.get_matrix(self.names), self.vecs
+        ))
+
+    def test_bounded_stores(self):
+        from src.test_retest import embeddings
+        n = embeddings.MAX_EMBEDDING_STORES
+        # one feature folder per epoch
+        folders = [tempfile.mkdtemp(dir=self.folder) for i in range(n + 2)]
+        stores = [load_embeddings(f) for f in folders]
+        self.assertLessEqual(len(embeddings._STORES), n)
+        self.assertTrue(load_embeddings(folders[-1]) is stores[-1])
+        self.assertFalse(load_embeddings(folders[0]) is stores[0])
+
+
+if __name__ == "__main__":
+    unittest.main()
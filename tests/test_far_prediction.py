@@ -0,0 +1,128 @@
+import unittest
+import numpy as np
+
+from src.baum_vagan.vagan.model_vagan import vagan
+from src.data.streaming import caching
+from src.data.streaming.caching import FarPredictionCache
+from src.data.streaming.vagan_preprocessing import VaganFarPredictions
+
+
+class ExpConfig(object):
+    def __init__(self, n_channels):
+        self.n_channels = n_channels
+
+
+def stub_generator(x):
+    """
+    Difference map of every image only depends on the image itself
+    and has positive and negative values.
+    """
+    M = 0.1 * np.sin(3 * x.sum(axis=-1, keepdims=True)) - 0.05 * x[..., :1]
+    return M.astype(np.float32) * np.ones(x.shape, dtype=np.float32)
+
+
+class TestIteratedFarPredictionBatch(unittest.TestCase):
+    def make_model(self, n_channels):
+        model = vagan.__new__(vagan)
+        model.exp_config = ExpConfig(n_channels)
+        model.predict_mask = stub_generator
+        return model
+
+    def check_model(self, model, only_negative):
+        rs = np.random.RandomState(0)
+        imgs = rs.uniform(-1, 1, size=(5, 4, 3)).astype(np.float32)
+        n_steps = 3
+
+        images, masks = model.iterated_far_prediction_batch(
+            imgs, n_steps, only_negative=only_negative, batch_size=2
+        )
+        final_images, final_masks = model.iterated_far_prediction_batch(
+            imgs, n_steps, only_negative=only_negative, only_final=True
+        )
+        self.assertEqual(images.shape, (5, n_steps, 4, 3))
+        self.assertEqual(
+            masks.shape, (5, n_steps, 4, 3, model.exp_config.n_channels)
+        )
+
+        for i, img in enumerate(imgs):
+            ref_images, ref_masks = model.iterated_far_prediction(
+                np.copy(img), n_steps, only_negative=only_negative
+            )
+            for step in range(n_steps):
+                self.assertTrue(np.allclose(images[i, step], ref_images[step]))
+                self.assertTrue(np.allclose(masks[i, step], ref_masks[step]))
+            self.assertTrue(np.allclose(final_images[i], ref_images[-1]))
+            self.assertTrue(np.allclose(final_masks[i], ref_masks[-1]))
+
+    def test_2_channels(self):
+        for only_negative in [False, True]:
+            self.check_model(self.make_model(2), only_negative)
+
+    def test_3_channels(self):
+        for only_negative in [False, True]:
+            self.check_model(self.make_model(3), only_negative)
+
+    def test_invalid_channels(self):
+        with self.assertRaises(ValueError):
+            self.make_model(4).iterated_far_prediction_batch(
+                np.zeros((1, 4, 3)), 1
+            )
+
+
+
+class Wrapper(object):
+    def __init__(self, model):
+        self.vagan = model
+
+
+class TestPrecomputeFarPredictions(unittest.TestCase):
+    def setUp(self):
+        self.n_calls = 0
+        model = vagan.__new__(vagan)
+        model.exp_config = ExpConfig(2)
+        model.predict_mask = self.predict_mask
+        self.model = model
+
+        streamer = VaganFarPredictions.__new__(VaganFarPredictions)
+        streamer.config = {"vagan_steps": 2}
+        streamer.wrapper = Wrapper(model)
+        streamer.far_predictions = FarPredictionCache("test_precompute")
+        streamer.load_sample_by_id = self.load_sample_by_id
+        self.streamer = streamer
+
+    def predict_mask(self, x):
+        self.n_calls += 1
+        return stub_generator(x)
+
+    def load_sample_by_id(self, fid):
+        return np.full((4, 3), int(fid) / 100.0, dtype=np.float32)
+
+    def test_working_set_larger_than_cache(self):
+        fids = [str(i) for i in range(caching.FAR_PREDICTION_CACHE_SIZE + 44)]
+        fid_to_images = self.streamer.precompute_far_predictions(fids, 2)
+        self.assertEqual(sorted(fid_to_images.keys()), sorted(fids))
+        n_calls = self.n_calls
+
+        step_to_images = {}
+        for n_steps in [1, 2]:
+            self.streamer.set_vagan_steps(n_steps)
+            step_to_images[n_steps] = self.streamer.preprocess_images(fids)
+        # every image was read from the cache
+        self.assertEqual(self.n_calls, n_calls)
+
+        for fid in fids[::50]:
+            ref_images, _ = self.model.iterated_far_prediction(
+                self.load_sample_by_id(fid), 2
+            )
+            for n_steps in [1, 2]:
+                self.assertTrue(np.allclose(
+                    step_to_images[n_steps][fid], ref_images[n_steps - 1]
+                ))
+
+        with self.assertRaises(KeyError):
+            self.streamer.far_predictions.get(fids[0], 3)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
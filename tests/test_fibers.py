@@ -0,0 +1,63 @@
+import unittest
+import numpy as np
+
+from modules.models.fibers import FiberState, split_fibers
+
+
+class TestFiberState(unittest.TestCase):
+    """Compare FiberState with fibers stored as lists of points."""
+
+    def test_tracking(self):
+        np.random.seed(5)
+        n_fibers = 20
+        seeds = np.random.rand(n_fibers, 3)
+        state = FiberState(seeds, max_len=12, initial_capacity=2)
+
+        fibers = [[s] for s in seeds]
+        ongoing = list(range(n_fibers))
+        completed = []
+        for step in range(11):
+            indices = state.get_active_indices()
+            self.assertEqual(list(indices), ongoing)
+
+            last = state.get_last_points(indices, 3)
+            for j, f in zip(indices, last):
+                tail = fibers[j][-1:-4:-1]
+                self.assertTrue(np.array_equal(f[:len(tail)], tail))
+                self.assertTrue(np.all(f[len(tail):] == 0))
+
+            done = np.random.rand(len(indices)) < 0.2
+            new_points = np.random.rand(len(indices), 3)
+            state.complete(indices[done])
+            state.append(indices[~done], new_points[~done])
+
+            completed += [fibers[j] for j in indices[done]]
+            for j, p in zip(indices[~done], new_points[~done]):
+                fibers[j].append(p)
+            ongoing = list(indices[~done])
+        state.complete(state.get_active_indices())
+        completed += [fibers[j] for j in ongoing]
+
+        self.assertEqual(state.n_active(), 0)
+        self.assertEqual(state.n_completed(), n_fibers)
+        points, lengths = state.get_completed()
+        result = split_fibers(points, lengths)
+        self.assertEqual(len(result), len(completed))
+        for f, expected in zip(result, completed):
+            self.assertTrue(np.array_equal(f, np.array(expected)))
+
+    def test_max_len(self):
+        state = FiberState(np.zeros((2, 3)), max_len=2)
+        state.append(np.arange(2), np.ones((2, 3)))
+        with self.assertRaises(ValueError):
+            state.append(np.arange(2), np.ones((2, 3)))
+
+    def test_empty(self):
+        state = FiberState(np.zeros((0, 3)), max_len=5)
+        points, lengths = state.get_completed()
+        self.assertEqual(points.shape, (0, 3))
+        self.assertEqual(split_fibers(points, lengths), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+import unittest
+import numpy as np
+from collections import OrderedDict
+
+from src.data.streaming.meta_table import MetaTable
+
+
+def make_rows():
+    rows = OrderedDict()
+    specs = [
+        ("I1", "p1", 70.5, 1, 0, 0),
+        ("I2", "p1", 72.0, 0, 0, 1),
+        ("I3", "p2", 65.1, 0, 1, 0),
+        ("I4", "p3", 80.2, 0, 0, 0),
+        ("I5", "p2", 66.3, 0, 1, 1),
+    ]
+    for label, patient, age, ad, healthy, mci in specs:
+        rows[label] = OrderedDict([
+            ("image_label", label),
+            ("patient_label", patient),
+            ("age_exact", age),
+            ("health_ad", ad),
+            ("healthy", healthy),
+            ("health_mci", mci),
+        ])
+    return rows
+
+
+class TestMetaTable(unittest.TestCase):
+    def setUp(self):
+        self.rows = make_rows()
+        self.table = MetaTable(self.rows)
+        for label in ["I1", "I2", "I3", "I5"]:
+            self.table.add_file(
+                "/data/" + label + ".nii.gz", label, label
+            )
+
+    def test_rows_match_dict(self):
+        for label, row in self.rows.items():
+            self.assertEqual(dict(self.table[label].items()), dict(row))
+
+        path = "/data/I3.nii.gz"
+        expected = dict(self.rows["I3"])
+        expected["file_path"] = path
+        expected["file_name"] = "I3"
+        self.assertEqual(dict(self.table[path].items()), expected)
+        self.assertTrue("file_path" in self.table[path])
+        self.assertFalse("file_path" in self.table["I3"])
+        self.assertEqual(len(self.table), 9)
+
+    def test_missing(self):
+        self.assertFalse("/data/I4.nii.gz" in self.table)
+        with self.assertRaises(KeyError):
+            self.table["/data/I4.nii.gz"]
+        with self.assertRaises(KeyError):
+            self.table.get_value("I1", "sex")
+
+    def test_diagnosis_codes(self):
+        codes = self.table.get_diagnosis_codes(["I1", "I2", "I3", "I4", "I5"])
+        # health_ad, health_mci, healthy, none, healthy (first match)
+        self.assertTrue(np.array_equal(codes, [0, 2, 1, -1, 1]))
+
+    def test_select(self):
+        fids = list(self.table.file_to_row.keys())
+        self.assertEqual(
+            self.table.select(fids, diagnoses=["healthy"]),
+            ["/data/I3.nii.gz", "/data/I5.nii.gz"]
+        )
+        self.assertEqual(
+            self.table.select(fids, age_min=66, age_max=72),
+            ["/data/I1.nii.gz", "/data/I2.nii.gz", "/data/I5.nii.gz"]
+        )
+        self.assertEqual(
+            self.table.select(fids, patients=["p1"],
+                              diagnoses=["health_mci"]),
+            ["/data/I2.nii.gz"]
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
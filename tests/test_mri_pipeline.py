@@ -0,0 +1,188 @@
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import unittest
+
+from src.data.mri_pipeline import MriPreprocessingPipeline
+
+
+def make_step(from_subfolder, subfolder, overwrite=False, **kwargs):
+    step = {
+        'type': 'copy',
+        'from_subfolder': from_subfolder,
+        'subfolder': subfolder,
+        'overwrite': overwrite,
+    }
+    step.update(kwargs)
+    return step
+
+
+class TestMriPipelineTasks(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.tmp_dir, 'raw'))
+        for image_id in [1, 2]:
+            with open(self.raw_path(image_id), 'w') as f:
+                f.write('raw%s' % image_id)
+        self.calls = []
+        self.fail_on = set()
+        # steps of the other images wait for it if set
+        self.block = None
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def raw_path(self, image_id):
+        return os.path.join(self.tmp_dir, 'raw', 'I%s.nii.gz' % image_id)
+
+    def copy(self, path_from, path_to, image_id, step):
+        self.calls.append((image_id, step['subfolder']))
+        if (image_id, step['subfolder']) in self.fail_on:
+            raise RuntimeError('step failed')
+        if self.block is not None:
+            self.block.wait(1.)
+        shutil.copyfile(path_from, path_to)
+
+    def make_pipeline(self, steps, workers=None):
+        pipeline = MriPreprocessingPipeline(
+            path=self.tmp_dir,
+            files_glob=os.path.join(self.tmp_dir, 'raw', '*.nii.gz'),
+            extract_image_id_regexp=r'.*I(\d+)\.nii\.gz',
+            regexp_image_id_group=1,
+            steps=steps,
+            workers=workers,
+        )
+        for step in steps:
+            pipeline._mkdir(step['subfolder'])
+        return pipeline
+
+    def run_pipeline(self, pipeline, image_ids=(1, 2)):
+        tasks = []
+        for image_id in image_ids:
+            tasks += pipeline.make_image_tasks(
+                self.raw_path(image_id), image_id, len(tasks))
+        pipeline.run_tasks(tasks, {'copy': self.copy})
+
+    def read_journal(self, pipeline):
+        with open(pipeline.journal_path, 'r') as f:
+            return [json.loads(line) for line in f]
+
+    def test_make_image_tasks(self):
+        pipeline = self.make_pipeline([
+            make_step('raw', 'a'),
+            make_step('a', 'b'),
+            make_step('b', 'skipped', skip=True),
+            make_step('raw', 'c'),
+            make_step('b', 'd'),
+        ])
+        tasks = pipeline.make_image_tasks(self.raw_path(1), 1, 5)
+        self.assertEqual([t['step_id'] for t in tasks], [0, 1, 3, 4])
+        self.assertEqual([t['deps'] for t in tasks], [[], [5], [], [6]])
+        self.assertEqual(tasks[0]['path_from'], self.raw_path(1))
+        self.assertEqual(
+            tasks[3]['path_from'],
+            os.path.join(self.tmp_dir, 'b', 'I1.nii.gz'),
+        )
+        self.assertNotEqual(tasks[0]['key'], tasks[2]['key'])
+
+    def test_journal_resume(self):
+        steps = [make_step('raw', 'a'), make_step('a', 'b')]
+        workers = {'num_workers': 2, 'journal': 'journal.txt'}
+        pipeline = self.make_pipeline(steps, workers)
+        self.run_pipeline(pipeline)
+        self.assertEqual(len(self.calls), 4)
+        self.assertEqual(len(pipeline._load_journal()), 4)
+
+        # Everything is journaled as done
+        self.calls = []
+        self.run_pipeline(self.make_pipeline(steps, workers))
+        self.assertEqual(self.calls, [])
+
+        # Interrupted run: the journal was cut in the middle of a line and
+        # an output exists without done entry
+        entries = self.read_journal(pipeline)
+        redone = [e['task'] for e in entries if e['step'] == 1][0]
+        with open(pipeline.journal_path, 'w') as f:
+            for e in entries:
+                if e['task'] != redone:
+                    f.write(json.dumps(e) + '\n')
+            f.write('{"task": "I1')
+        self.assertEqual(len(pipeline._load_journal()), 3)
+
+        self.run_pipeline(self.make_pipeline(steps, workers))
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(self.calls[0][1], 'b')
+
+    def test_rerun_invalidates_dependents(self):
+        steps = [make_step('raw', 'a'), make_step('a', 'b')]
+        for num_workers in [1, 2]:
+            workers = {
+                'num_workers': num_workers,
+                'journal': 'journal%s.txt' % num_workers,
+            }
+            self.run_pipeline(self.make_pipeline(steps, workers))
+
+            # output of the first step is lost, the journaled output of
+            # the second step is outdated
+            os.remove(os.path.join(self.tmp_dir, 'a', 'I1.nii.gz'))
+            self.calls = []
+            self.run_pipeline(self.make_pipeline(steps, workers))
+            self.assertEqual(self.calls, [(1, 'a'), (1, 'b')])
+            shutil.rmtree(os.path.join(self.tmp_dir, 'a'))
+            shutil.rmtree(os.path.join(self.tmp_dir, 'b'))
+            self.calls = []
+
+    def test_failure_skips_dependents(self):
+        steps = [make_step('raw', 'a'), make_step('a', 'b')]
+        self.fail_on = {(2, 'a')}
+        for num_workers in [1, 2]:
+            self.calls = []
+            pipeline = self.make_pipeline(steps, {
+                'num_workers': num_workers,
+                'journal': 'journal%s.txt' % num_workers,
+                'continue_on_failure': True,
+            })
+            self.run_pipeline(pipeline)
+            self.assertEqual(
+                sorted(self.calls), [(1, 'a'), (1, 'b'), (2, 'a')])
+            status = [e['status'] for e in self.read_journal(pipeline)]
+            self.assertEqual(sorted(status), ['done', 'done', 'failed', 'skipped'])
+            shutil.rmtree(os.path.join(self.tmp_dir, 'a'))
+            shutil.rmtree(os.path.join(self.tmp_dir, 'b'))
+
+    def test_failure_raises(self):
+        steps = [make_step('raw', 'a'), make_step('a', 'b')]
+        self.fail_on = {(1, 'a')}
+        for workers in [None, {'num_workers': 2}]:
+            with self.assertRaises(RuntimeError):
+                self.run_pipeline(self.make_pipeline(steps, workers))
+
+    def test_failure_cancels_queued_tasks(self):
+        image_ids = list(range(1, 9))
+        for image_id in image_ids:
+            with open(self.raw_path(image_id), 'w') as f:
+                f.write('raw%s' % image_id)
+        self.fail_on = {(1, 'a')}
+        self.block = threading.Event()
+        pipeline = self.make_pipeline([make_step('raw', 'a')],
+                                      {'num_workers': 2})
+        with self.assertRaises(RuntimeError):
+            self.run_pipeline(pipeline, image_ids)
+        # the failed task and the ones already running
+        self.assertLessEqual(len(self.calls), 3)
+
+    def test_exec_failure(self):
+        pipeline = self.make_pipeline([])
+        # exit codes are only printed by default
+        pipeline._exec('exit 3')
+
+        pipeline.setup_workers(1, check_exit_codes=True)
+        with self.assertRaises(subprocess.CalledProcessError):
+            pipeline._exec('exit 3')
+
+
+if __name__ == '__main__':
+    unittest.main()
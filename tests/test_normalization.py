@@ -0,0 +1,124 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+from src.data.streaming import normalization
+
+
+class TestRunningMoments(unittest.TestCase):
+    def setUp(self):
+        r = np.random.RandomState(40)
+        self.images = [r.rand(3, 4, 5) * 10 + 100 for _ in range(37)]
+
+    def test_sequential(self):
+        moments = normalization.RunningMoments()
+        for im in self.images:
+            moments.update(im)
+
+        stack = np.array(self.images)
+        self.assertTrue(np.allclose(moments.get_mean(), stack.mean(axis=0)))
+        self.assertTrue(np.allclose(moments.get_std(), stack.std(axis=0)))
+
+    def test_parallel_matches_sequential(self):
+        stack = np.array(self.images)
+        for n_workers in [1, 4]:
+            moments = normalization.compute_moments(
+                items=list(range(len(self.images))),
+                load_fn=lambda i: self.images[i],
+                n_workers=n_workers,
+                chunk_size=5
+            )
+            self.assertEqual(moments.n, len(self.images))
+            self.assertTrue(np.allclose(
+                moments.get_mean(), stack.mean(axis=0)
+            ))
+            self.assertTrue(np.allclose(
+                moments.get_std(), stack.std(axis=0)
+            ))
+
+
+class TestVoxelStats(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+        normalization._VOXEL_STATS.clear()
+
+    def test_modified_file_changes_key(self):
+        path = os.path.join(self.tmp_dir, "a.nii.gz")
+        open(path, 'w').close()
+        key = normalization.normalization_key([path], {"clip": True})
+        self.assertEqual(
+            key, normalization.normalization_key([path], {"clip": True})
+        )
+
+        st = os.stat(path)
+        os.utime(path, (st.st_atime, st.st_mtime + 10))
+        self.assertNotEqual(
+            key, normalization.normalization_key([path], {"clip": True})
+        )
+
+    def test_persisted(self):
+        key = normalization.normalization_key(["b", "a"], {"clip": True})
+        self.assertEqual(
+            key,
+            normalization.normalization_key(["a", "b"], {"clip": True})
+        )
+        self.assertTrue(normalization.load_voxel_stats(key) is None)
+
+        mean = np.ones((2, 2))
+        std = 2 * np.ones((2, 2))
+        normalization.save_voxel_stats(key, mean, std, self.tmp_dir)
+        normalization._VOXEL_STATS.clear()
+
+        m, s = normalization.load_voxel_stats(key, self.tmp_dir)
+        self.assertTrue(np.array_equal(m, mean))
+        self.assertTrue(np.array_equal(s, std))
+
+
+def normalize_image_reference(im, voxel_means, voxel_stds, clip):
+    if clip:
+        im = np.clip(im, np.min(im), np.percentile(im, 95))
+
+    im = (im - np.mean(im)) / np.std(im)
+    im = (im - voxel_means) / voxel_stds
+    return (im - np.mean(im)) / np.std(im)
+
+
+class TestNormalizeBatch(unittest.TestCase):
+    def setUp(self):
+        r = np.random.RandomState(3)
+        self.images = r.rand(6, 4, 5, 6).astype(np.float32) * 50
+        self.voxel_means = r.rand(4, 5, 6)
+        self.voxel_stds = r.rand(4, 5, 6) + 0.5
+
+    def test_partition_percentile(self):
+        X = self.images.reshape(6, -1)
+        for q in [0, 5, 50, 95, 100]:
+            self.assertTrue(np.allclose(
+                normalization.partition_percentile(X, q),
+                np.percentile(X, q, axis=1)
+            ))
+
+    def test_matches_per_image_normalization(self):
+        for clip in [False, True]:
+            batch = normalization.normalize_batch(
+                self.images, self.voxel_means, self.voxel_stds, clip
+            )
+            self.assertEqual(batch.dtype, np.float32)
+            self.assertEqual(batch.shape, self.images.shape)
+            for im, normalized in zip(self.images, batch):
+                ref = normalize_image_reference(
+                    im.astype(np.float64),
+                    self.voxel_means,
+                    self.voxel_stds,
+                    clip
+                )
+                self.assertTrue(np.allclose(normalized, ref, atol=1e-4))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -51,5 +51,56 @@ class TestPredictionRobustness(unittest.TestCase):
         self.assertEqual(r, 0.25)
 
 
+class TestBatchedMeasures(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(11)
+        n = 20
+        test = np.random.rand(n, 8)
+        retest = test + 0.3 * np.random.rand(n, 8)
+        # degenerate features
+        retest[:, 0] = test[:, 0]  # identical columns
+        test[:, 1] = 2.0  # constant
+        retest[:, 2] = 3.0
+        test[:, 3] = 1.0
+        retest[:, 3] = 1.5  # both constant
+        test[4, 4] = np.nan
+        retest[:, 5] = -test[:, 5]
+        test[:, 6] = np.round(test[:, 6])
+        retest[:, 6] = np.round(retest[:, 6])
+        self.test = test
+        self.retest = retest
+        self.Y = np.stack((test, retest), axis=1)
+
+    def check(self, func, Y):
+        batched = np_utils.BATCHED_MEASURES[func](Y)
+        for i in range(Y.shape[2]):
+            expected = func(Y[:, :, i])
+            self.assertTrue(
+                np.isclose(batched[i], expected),
+                "{} feature {}: {} != {}".format(
+                    func.__name__, i, batched[i], expected
+                )
+            )
+
+    def test_match_scalar(self):
+        for func in np_utils.BATCHED_MEASURES:
+            self.check(func, self.Y)
+            # two subjects only
+            self.check(func, self.Y[:2])
+
+    def test_per_feature(self):
+        funcs = [np_utils.ICC_A1, np_utils.equal_pairs]
+        icc, eq = np_utils.per_feature_measures(self.Y, funcs)
+        self.assertEqual(icc.shape, (8,))
+        self.assertEqual(eq[0], 1.0)
+
+        iccs = np_utils.per_feature_ICC(
+            self.test, self.retest, np_utils.ICC_C1
+        )
+        self.assertTrue(np.allclose(
+            iccs, np_utils.batch_ICC_C1(self.Y)
+        ))
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -1,5 +1,6 @@
 import unittest
-from modules.models.example_loader import PointExamples
+import numpy as np
+from modules.models.example_loader import PointExamples, PointLabels
 
 class TestPointExamples(unittest.TestCase):
     """Test some functionalities of the example loader."""
@@ -28,5 +29,129 @@ class TestPointExamples(unittest.TestCase):
         self.assertEqual(num_eval_labels, 0)
 
 
+class TestBatchedDatablocks(unittest.TestCase):
+    """Compare the batched block extraction with build_datablock."""
+
+    def setUp(self):
+        np.random.seed(3)
+        self.data = np.random.rand(6, 7, 5, 2).astype(np.float32)
+        self.affine = np.diag([2.0, -1.5, 1.0, 1.0])
+        self.affine[:3, :3] = self.affine[:3, :3].dot(np.array([
+            [0, 1, 0],
+            [1, 0, 0],
+            [0, 0, 1]
+        ]))
+
+    def test_build_datablocks(self):
+        block_size = 3
+        centers = np.array([
+            [2.2, 3.1, 2.0],  # inside
+            [0.1, 0.4, 4.2],  # padded at the border
+            [5.4, 6.3, 0.0],
+            [6.6, 1.0, 1.0],  # out of bounds
+            [-0.7, 1.0, 1.0],
+        ])
+        padded = PointExamples.pad_data(self.data, block_size)
+        blocks = PointExamples.build_datablocks(padded, block_size, centers)
+        self.assertEqual(blocks.shape, (5, 3, 3, 3, 2))
+        for center, block in zip(centers, blocks):
+            expected = PointExamples.build_datablock(
+                self.data, block_size, center, np.zeros((1, 3)),
+                np.zeros(3), "point", self.affine
+            )["data_block"]
+            self.assertTrue(np.array_equal(block, expected))
+
+    def test_build_incoming(self):
+        n_incoming = 3
+        fibers = [
+            [np.array([1.0, 2.0, 3.0])],
+            [np.array([1.0, 2.0, 3.0]), np.array([1.5, 2.5, 3.0])],
+            [np.random.rand(3) + 1 for _ in range(6)],
+        ]
+        points = np.zeros((len(fibers), n_incoming + 1, 3))
+        for j, fiber in enumerate(fibers):
+            tail = fiber[-1:-n_incoming - 2:-1]
+            points[j, :len(tail)] = tail
+
+        incoming = PointExamples.build_incoming(points, self.affine)
+        for j, fiber in enumerate(fibers):
+            incoming_point = np.zeros((n_incoming, 3))
+            for i in range(min(n_incoming, len(fiber) - 1)):
+                incoming_point[i] = fiber[-i - 2]
+            expected = PointExamples.build_datablock(
+                self.data, 3, fiber[-1], incoming_point, np.zeros(3),
+                "point", self.affine
+            )["incoming"]
+            self.assertTrue(np.allclose(incoming[j], expected))
+
+
+def reference_labels(fibers, last_incoming, ignore_start_point, ignore_stop_point,
+                     augment_reverse_fibers):
+    labels = []
+    for fiber in fibers:
+        for j in range(ignore_start_point, len(fiber) - ignore_stop_point):
+            label = {"center": fiber[j]}
+            incoming = fiber[max(j - last_incoming, 0):j][::-1]
+            label["incoming"] = np.append(
+                incoming, np.zeros((last_incoming - len(incoming), 3)), 0)
+            if j == len(fiber) - 1:
+                label["outgoing"] = np.zeros(3)
+            else:
+                label["outgoing"] = fiber[j + 1]
+            labels.append(label)
+            if augment_reverse_fibers:
+                incoming = fiber[min(j + 1, len(fiber)):min(j + 1 + last_incoming, len(fiber))]
+                incoming = np.append(
+                    incoming, np.zeros((last_incoming - len(incoming), 3)), 0)
+                labels.append({"center": fiber[j], "incoming": incoming,
+                               "outgoing": label["incoming"][0]})
+    return labels
+
+
+class TestPointLabels(unittest.TestCase):
+    """Compare PointLabels with labels stored as dictionaries."""
+
+    def setUp(self):
+        np.random.seed(6)
+        self.fibers = [np.random.rand(n, 3) + 1 for n in [1, 2, 5, 9]]
+
+    def test_from_fibers(self):
+        for last_incoming in [1, 3]:
+            for ignore_start_point in [False, True]:
+                for ignore_stop_point in [False, True]:
+                    for augment_reverse_fibers in [False, True]:
+                        options = (last_incoming, ignore_start_point,
+                                   ignore_stop_point, augment_reverse_fibers)
+                        labels, n_labels = PointLabels.from_fibers(self.fibers, *options)
+                        expected = reference_labels(self.fibers, *options)
+
+                        self.assertEqual(len(labels), len(expected))
+                        self.assertEqual(n_labels.sum(), len(expected))
+                        for label, expected_label in zip(labels, expected):
+                            for key in ["center", "incoming", "outgoing"]:
+                                self.assertTrue(np.array_equal(
+                                    label[key], expected_label[key]))
+
+    def test_indexing(self):
+        labels, _ = PointLabels.from_fibers(self.fibers, 2)
+        self.assertEqual(labels[3]["incoming"].shape, (2, 3))
+        subset = labels[np.array([4, 0])]
+        self.assertTrue(isinstance(subset, PointLabels))
+        self.assertTrue(np.array_equal(subset.center[1], labels.center[0]))
+        self.assertEqual(len(labels[2:5]), 3)
+
+        empty, n_labels = PointLabels.from_fibers([], 2)
+        self.assertEqual(len(empty), 0)
+        self.assertEqual(empty.incoming.shape, (0, 2, 3))
+
+    def test_points_to_one_hot_batch(self):
+        center = np.array([[2.2, 3.1, 2.0], [2.2, 3.1, 2.0], [1.0, 1.0, 1.0]])
+        point = np.array([[3.0, 2.6, 1.4], [0.0, 0.0, 0.0], [1.2, 1.6, 0.9]])
+        one_hot = PointExamples.points_to_one_hot_batch(center, point)
+        for i in range(len(center)):
+            self.assertTrue(np.array_equal(
+                one_hot[i], PointExamples.points_to_one_hot(center[i], point[i])))
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,94 @@
+import threading
+import unittest
+import numpy as np
+
+from src.data.streaming.vagan_streaming import PrefetchQueue, BatchProvider
+
+
+class FakeStreamer(object):
+    def __init__(self, config):
+        self.config = config
+        self.normalize_images = False
+
+    def load_sample_by_id(self, fid):
+        return np.full((2, 2), fid, dtype=np.float32)
+
+    def get_meta_info_by_key(self, fid, key):
+        return fid % 2
+
+
+class TestPrefetchQueue(unittest.TestCase):
+    def setUp(self):
+        self.n_loaded = 0
+
+    def load_chunk(self):
+        chunk = list(range(self.n_loaded, self.n_loaded + 3))
+        self.n_loaded += 3
+        return chunk
+
+    def test_order(self):
+        q = PrefetchQueue(self.load_chunk, max_size=4)
+        self.assertEqual([q.get() for i in range(10)], list(range(10)))
+        q.stop()
+
+    def test_bound_and_stop(self):
+        q = PrefetchQueue(self.load_chunk, max_size=4)
+        # signalled as soon as the filling thread made the queue full
+        full = threading.Event()
+        put = q.queue.put
+
+        def put_and_signal(el, block=True, timeout=None):
+            put(el, block, timeout)
+            if q.queue.full():
+                full.set()
+
+        q.queue.put = put_and_signal
+        q.start()
+        self.assertTrue(full.wait(10))
+        # samples 0-3 are queued, sample 4 waits for space, hence no
+        # further chunk is loaded
+        self.assertEqual(q.get_queue_depth(), 4)
+        self.assertEqual(self.n_loaded, 6)
+        self.assertEqual(q.get(), 0)
+
+        thread = q.thread
+        q.stop()
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(q.get_queue_depth(), 0)
+        self.assertEqual(self.n_loaded, 6)
+
+    def test_error(self):
+        def fail():
+            raise RuntimeError("loading failed")
+
+        q = PrefetchQueue(fail, max_size=2)
+        with self.assertRaises(RuntimeError):
+            q.get()
+        q.stop()
+
+
+class TestPrefetchingProvider(unittest.TestCase):
+    def make_provider(self, background, prefetch):
+        streamer = FakeStreamer({"background_prefetch": background})
+        return BatchProvider(
+            streamer, list(range(7)), "label", prefetch=prefetch, seed=3
+        )
+
+    def test_same_batches_as_foreground(self):
+        for prefetch in [0, 1, 4]:
+            foreground = self.make_provider(False, prefetch)
+            background = self.make_provider(True, prefetch)
+            for i in range(6):
+                x1, y1 = foreground.next_batch(5)
+                x2, y2 = background.next_batch(5)
+                self.assertEqual(x1.shape, (5, 2, 2, 1))
+                self.assertTrue(np.array_equal(x1, x2))
+                self.assertTrue(np.array_equal(y1, y2))
+
+            self.assertEqual(background.get_prefetch_stats()["n_gets"], 30)
+            background.stop_prefetch()
+            self.assertIsNone(background.prefetch_queue.thread)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import pandas as pd
+
+# the script imports its sibling utils module
+sys.path.insert(0, os.path.join("src", "baum_vagan"))
+from src.baum_vagan.preprocess_adni_all import split_table, \
+    merge_summary_csvs, output_up_to_date, write_stamp
+
+
+class TestSplitTable(unittest.TestCase):
+    def test_chunks(self):
+        table = pd.DataFrame({"RID": list(range(10))})
+        for n_chunks in [1, 3, 4, 10, 20]:
+            chunks = split_table(table, n_chunks)
+            self.assertLessEqual(len(chunks), n_chunks)
+            self.assertTrue(all(len(c) > 0 for c in chunks))
+            self.assertTrue(pd.concat(chunks).equals(table))
+
+        self.assertEqual(split_table(table.iloc[:0], 4), [])
+
+
+class TestPreprocessingFiles(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def path(self, name):
+        return os.path.join(self.tmp_dir, name)
+
+    def test_merge_summary_csvs(self):
+        chunk_files = []
+        for i in range(3):
+            chunk_files.append(self.path("summary.csv.chunk%04d" % i))
+            with open(chunk_files[-1], 'w') as f:
+                f.write("rid,phase\n")
+                for j in range(i):
+                    f.write("%s%s,ADNI1\n" % (i, j))
+
+        merge_summary_csvs(chunk_files, self.path("summary.csv"))
+        with open(self.path("summary.csv"), 'r') as f:
+            self.assertEqual(
+                f.read(), "rid,phase\n10,ADNI1\n20,ADNI1\n21,ADNI1\n"
+            )
+        self.assertEqual(os.listdir(self.tmp_dir), ["summary.csv"])
+
+    def test_output_up_to_date(self):
+        src, out = self.path("in.nii"), self.path("out.nii")
+        steps = {"do_cropping": True, "do_skull_stripping": False}
+        open(src, 'w').close()
+        self.assertFalse(output_up_to_date(out, src, steps))
+
+        open(out, 'w').close()
+        os.utime(src, (0, 0))
+        self.assertTrue(output_up_to_date(out, src))
+        # no stamp
+        self.assertFalse(output_up_to_date(out, src, steps))
+
+        write_stamp(out, steps)
+        self.assertTrue(output_up_to_date(out, src, steps))
+        self.assertFalse(output_up_to_date(
+            out, src, dict(steps, do_skull_stripping=True)
+        ))
+
+        # newer input
+        os.utime(src, (0, os.path.getmtime(out) + 10))
+        self.assertFalse(output_up_to_date(out, src, steps))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+from modules.models import seeding
+
+
+def reference_borders(mask, order):
+    dim = mask.shape
+    borders = []
+    for x in range(order, dim[0] - order):
+        for y in range(order, dim[1] - order):
+            for z in range(order, dim[2] - order):
+                if mask[x, y, z] == 1:
+                    window = mask[x - order:x + 1 + order,
+                                  y - order:y + 1 + order,
+                                  z - order:z + 1 + order]
+                    if not np.all(window):
+                        borders.append(np.array([x, y, z]))
+    return np.array(borders)
+
+
+class TestSeeding(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(2)
+        self.mask = np.zeros((12, 10, 9))
+        self.mask[2:10, 1:9, 2:9] = 1
+        # holes and values other than 1
+        self.mask[np.random.rand(12, 10, 9) < 0.1] = 0
+        self.mask[5, 5, 5] = 0.5
+
+    def test_compute_borders(self):
+        for order in [1, 2]:
+            borders = seeding.compute_borders(self.mask, order)
+            self.assertTrue(np.array_equal(
+                borders, reference_borders(self.mask, order)
+            ))
+
+    def test_find_borders_cache(self):
+        cache_dir = tempfile.mkdtemp()
+        try:
+            borders = seeding.find_borders(self.mask, 1, cache_dir)
+            self.assertTrue(seeding.find_borders(self.mask, 1) is borders)
+            # reloaded from the cache dir
+            seeding._BORDERS.clear()
+            cached = seeding.find_borders(self.mask, 1, cache_dir)
+            self.assertTrue(np.array_equal(cached, borders))
+        finally:
+            shutil.rmtree(cache_dir)
+
+        other = np.copy(self.mask)
+        other[2, 2, 2] = 0
+        self.assertFalse(np.array_equal(
+            seeding.find_borders(other, 1), borders
+        ))
+
+    def test_sample_seeds(self):
+        borders = seeding.compute_borders(self.mask, 1)
+
+        np.random.seed(7)
+        new_idxs = np.random.choice(len(borders), 50, replace=True)
+        expected = [borders[i] + np.clip(np.random.normal(0, 0.25, 3), -0.5, 0.5)
+                    for i in new_idxs]
+        np.random.seed(7)
+        seeds = seeding.sample_seeds(borders, 50)
+        self.assertTrue(np.array_equal(seeds, np.array(expected)))
+
+        s1 = seeding.sample_seeds(borders, 20, np.random.RandomState(3))
+        s2 = seeding.sample_seeds(borders, 20, np.random.RandomState(3))
+        self.assertTrue(np.array_equal(s1, s2))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -11,6 +11,11 @@ from src.data.streaming.vagan_streaming import \
 import subprocess
 import numpy as np
 
+from src.data.streaming.caching import clear_streamer_state
+from src.data.streaming.base import Group
+from src.data.streaming.meta_table import MetaTable
+from tests.test_meta_table import make_rows
+
 N_RUNS = 10
 
 
@@ -287,6 +292,230 @@ class TestImageNormalization(unittest.TestCase):
         )
 
 
+class TestNormalizationKey(unittest.TestCase):
+    def make_streamer(self, downsample):
+        streamer = MRISingleStream.__new__(MRISingleStream)
+        streamer.config = {"downsample": downsample}
+        streamer.rescale_to_one = False
+        streamer.image_store = None
+        streamer.get_file_path = lambda fid: "I{}.nii.gz".format(fid)
+        streamer.load_sample = lambda path: np.zeros((4, 5, 6))
+        return streamer
+
+    def test_downsample_is_part_of_key(self):
+        real = self.make_streamer({"enabled": False})
+        debug = self.make_streamer({"enabled": True, "shape": [2, 2, 2]})
+        self.assertEqual(real.get_volume_shape(1), (4, 5, 6))
+        self.assertEqual(debug.get_volume_shape(1), (2, 2, 2))
+        self.assertNotEqual(
+            real.get_normalization_key([1, 2]),
+            debug.get_normalization_key([1, 2])
+        )
+
+    def test_sample_shape_of_base_class(self):
+        streamer = self.make_streamer({"enabled": False})
+        streamer.groups = [Group([1])]
+        self.assertEqual(streamer.get_sample_shape(), (4, 5, 6))
+        self.assertEqual(streamer.get_sample_1d_dim(), 120)
+
+
+class TestSharedSplit(unittest.TestCase):
+    def setUp(self):
+        clear_streamer_state()
+        self.n_splits = 0
+
+    def tearDown(self):
+        clear_streamer_state()
+
+    def make_streamer(self, **config):
+        streamer = MRIDiagnosePairStream.__new__(MRIDiagnosePairStream)
+        streamer.config = dict({"seed": 11, "train_ratio": 0.5}, **config)
+        streamer.seed = 11
+        streamer.np_random = np.random.RandomState(11)
+        streamer.meta_csv = "tests/test_streamers.py"
+        streamer.meta_id_column = "image_label"
+        streamer.data_sources_list = []
+        streamer.name_to_data_source = {}
+        streamer.all_file_ids = ["a", "b", "c"]
+
+        def make_split():
+            self.n_splits += 1
+            return ["a"], ["b"], ["c"], streamer.get_random_state()
+
+        streamer.make_split = make_split
+        return streamer
+
+    def test_collection_shares_split(self):
+        # like the streamers of MRIDiagnosePairStreamCollection
+        s1 = self.make_streamer(diagnoses=["health", "AD"], same_patient=True)
+        s2 = self.make_streamer(diagnoses=["MCI", "AD"], same_patient=False)
+        self.assertEqual(s1.get_split(), (["a"], ["b"], ["c"]))
+        self.assertEqual(s2.get_split(), (["a"], ["b"], ["c"]))
+        self.assertEqual(self.n_splits, 1)
+
+        self.make_streamer(train_ratio=0.7).get_split()
+        self.assertEqual(self.n_splits, 2)
+
+    def test_no_seed_is_not_shared(self):
+        for i in range(2):
+            streamer = self.make_streamer(seed=None)
+            streamer.seed = None
+            streamer.get_split()
+        self.assertEqual(self.n_splits, 2)
+
+
+class TestSelectFileIds(unittest.TestCase):
+    def make_streamer(self):
+        streamer = MRISingleStream.__new__(MRISingleStream)
+        streamer.config = {"use_diagnoses": ["healthy", "health_mci"]}
+        streamer.silent = True
+        streamer.file_id_to_meta = MetaTable(make_rows())
+        return streamer
+
+    def test_select(self):
+        streamer = self.make_streamer()
+        self.assertEqual(
+            streamer.select_file_ids(["I5", "I1", "I2", "I3"]),
+            ["I5", "I2", "I3"]
+        )
+
+    def test_missing_diagnosis_raises(self):
+        # I4 has no diagnosis
+        with self.assertRaises(ValueError):
+            self.make_streamer().select_file_ids(["I1", "I4"])
+
+
+class TestImageCacheSize(unittest.TestCase):
+    def make_streamer(self, **config):
+        streamer = AgeFixedDeltaStream.__new__(AgeFixedDeltaStream)
+        streamer.config = dict({"prefetch": 10, "cache_images": True},
+                               **config)
+        return streamer
+
+    def test_unbounded_by_default(self):
+        streamer = self.make_streamer()
+        self.assertIsNone(streamer.get_image_cache_size())
+        streamer.set_up_image_cache()
+        self.assertIsNone(streamer.image_cache.max_size)
+
+    def test_explicit_size(self):
+        streamer = self.make_streamer(image_cache_size=3)
+        streamer.set_up_image_cache()
+        self.assertEqual(streamer.image_cache.max_size, 3)
+
+
+def nested_loop_pairs(streamer, file_ids):
+    """
+    Pair enumeration of AgeFixedDeltaStream before the PatientIndex.
+    """
+    keep_fids = set()
+    for g in streamer.make_patient_groups(sorted(file_ids)):
+        diagnoses = set([streamer.get_diagnose(fid) for fid in g.file_ids])
+        if len(diagnoses) > 1 and not streamer.use_converting:
+            continue
+
+        age_ascending = sorted(g.file_ids, key=streamer.get_exact_age)
+        if not streamer.use_retest:
+            age_ascending = [
+                fid for i, fid in enumerate(age_ascending)
+                if i == 0 or streamer.get_exact_age(fid) !=
+                streamer.get_exact_age(age_ascending[i - 1])
+            ]
+
+        for i, i_fid in enumerate(age_ascending):
+            for j_fid in age_ascending[i + 1:]:
+                delta = streamer.get_exact_age(j_fid) - \
+                    streamer.get_exact_age(i_fid)
+                if streamer.is_valid_delta(delta) and \
+                        streamer.get_diagnose(i_fid) in \
+                        streamer.use_diagnoses and \
+                        streamer.get_diagnose(j_fid) in \
+                        streamer.use_diagnoses:
+                    keep_fids.update([i_fid, j_fid])
+
+    pairs = []
+    for g in streamer.make_patient_groups(sorted(keep_fids)):
+        age_ascending = sorted(g.file_ids, key=streamer.get_exact_age)
+        for i, i_fid in enumerate(age_ascending):
+            for j_fid in age_ascending[i + 1:]:
+                delta = streamer.get_exact_age(j_fid) - \
+                    streamer.get_exact_age(i_fid)
+                if streamer.is_valid_delta(delta):
+                    pairs.append((i_fid, j_fid))
+
+    return sorted(keep_fids), pairs
+
+
+class TestPairEnumeration(unittest.TestCase):
+    def setUp(self):
+        # small synthetic patient table with retests and converters
+        rs = np.random.RandomState(5)
+        self.meta = {}
+        for fid in range(120):
+            patient = rs.randint(15)
+            self.meta["I{}".format(fid)] = {
+                "file_path": "I{}.nii.gz".format(fid),
+                "patient_label": patient,
+                "age_exact": 70 + rs.randint(12) / 2.0,
+                "diagnose": ["health", "MCI", "AD"][
+                    (patient + (rs.rand() < 0.2)) % 3
+                ]
+            }
+        self.meta["I200"] = {"patient_label": 0}
+
+    def make_streamer(self, _class, **config):
+        streamer = _class.__new__(_class)
+        streamer.file_id_to_meta = self.meta
+        streamer.get_patient_id = lambda fid: self.meta[fid]["patient_label"]
+        streamer.get_exact_age = lambda fid: self.meta[fid]["age_exact"]
+        streamer.get_diagnose = lambda fid: self.meta[fid]["diagnose"]
+        streamer.image_type = lambda streamer, fid1, fid2: (fid1, fid2)
+        streamer.patient_index = None
+        streamer.pairs_cache = {}
+        streamer.use_diagnoses = ["health", "MCI"]
+        streamer.use_converting = False
+        streamer.use_retest = False
+        for k, v in config.items():
+            setattr(streamer, k, v)
+        return streamer
+
+    def check_streamer(self, streamer):
+        file_ids = sorted(self.meta.keys())[::2]
+        keep_fids, pairs = nested_loop_pairs(streamer, file_ids)
+        self.assertTrue(len(pairs) > 0)
+        self.assertEqual(streamer.select_file_ids(file_ids), keep_fids)
+        self.assertEqual(streamer.build_pairs(file_ids), pairs)
+        # cached pairs
+        self.assertEqual(streamer.build_pairs(file_ids), pairs)
+
+    def test_fixed_delta(self):
+        for converting in [False, True]:
+            for retest in [False, True]:
+                self.check_streamer(self.make_streamer(
+                    AgeFixedDeltaStream, delta_min=0.5, delta_max=2.5,
+                    use_converting=converting, use_retest=retest
+                ))
+
+    def test_variable_delta(self):
+        for retest in [False, True]:
+            self.check_streamer(self.make_streamer(
+                AgeVariableDeltaStream, use_converting=True,
+                use_retest=retest,
+                delta_ranges={1.0: [0.5, 1.0], 3.0: [2.5, 3.5]}
+            ))
+
+    def test_missing_diagnose_raises(self):
+        streamer = self.make_streamer(AgeFixedDeltaStream,
+                                      delta_min=0.5, delta_max=2.5)
+
+        def get_diagnose(fid):
+            raise ValueError("diagnosis not found for id {}".format(fid))
+
+        streamer.get_diagnose = get_diagnose
+        with self.assertRaises(ValueError):
+            streamer.select_file_ids(["I0", "I1"])
+
+
 class TestBatchOrder(unittest.TestCase):
     def setUp(self):
         with open("tests/configs/test_streamer.yaml") as f:
@@ -0,0 +1,114 @@
+import itertools
+import unittest
+import numpy as np
+from sklearn.metrics import recall_score, precision_score, \
+    accuracy_score, f1_score
+
+from src.conversion.threshold_search import threshold_scores, \
+    best_threshold, weight_grid, search_weights
+
+
+def reference_scores(y_true, y_pred):
+    return {
+        "accuracy": round(accuracy_score(y_true, y_pred), 6),
+        "recall": round(recall_score(y_true, y_pred), 6),
+        "precision": round(precision_score(y_true, y_pred), 6),
+        "specificity": round(recall_score(1 - y_true, 1 - y_pred), 6),
+        "f1": round(f1_score(y_true, y_pred), 6),
+    }
+
+
+def reference_threshold(labels, probs, target_metric, all_eps):
+    all_scores = [reference_scores(labels, (probs > eps).astype(np.float32))
+                  for eps in all_eps]
+    i = np.argmax([s[target_metric] for s in all_scores])
+    return all_eps[i], all_scores[i]
+
+
+class TestThresholdSearch(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(40)
+        self.labels = (np.random.rand(60) > 0.6).astype(np.int64)
+        # rounding creates ties with the thresholds
+        self.probs = np.round(np.random.rand(60), 2)
+
+    def test_scores_match_sklearn(self):
+        all_eps = np.linspace(-0.1, 1.1, 25)
+        scores = threshold_scores(self.labels, self.probs, all_eps)
+        for i, eps in enumerate(all_eps):
+            preds = (self.probs > eps).astype(np.float32)
+            ref = reference_scores(self.labels, preds)
+            for k, v in ref.items():
+                self.assertAlmostEqual(scores[k][i], v, places=6)
+
+    def test_best_threshold(self):
+        all_eps = np.linspace(0, 1, 100)
+        for metric in ["accuracy", "f1", "recall", "specificity"]:
+            eps, scores = best_threshold(
+                self.labels, self.probs, metric, all_eps
+            )
+            ref_eps, ref_scores = reference_threshold(
+                self.labels, self.probs, metric, all_eps
+            )
+            self.assertEqual(eps, ref_eps)
+            for k, v in ref_scores.items():
+                self.assertAlmostEqual(scores[k], v, places=6)
+
+    def test_unsorted_and_nan_thresholds(self):
+        probs = np.copy(self.probs)
+        probs[:3] = np.nan
+        all_eps = np.copy(probs)
+        eps, scores = best_threshold(self.labels, probs, "f1", all_eps)
+        ref_eps, ref_scores = reference_threshold(
+            self.labels, probs, "f1", all_eps
+        )
+        self.assertEqual(eps, ref_eps)
+        self.assertEqual(scores["f1"], ref_scores["f1"])
+
+    def test_weight_grid_order(self):
+        vals = [0.1, 0.5, 1.0]
+        grid = weight_grid(vals, 3)
+        ref = np.array(list(itertools.product(vals, repeat=3)))
+        self.assertTrue(np.array_equal(grid, ref))
+
+    def test_search_weights(self):
+        all_probs = np.random.rand(60, 3)
+        weight_vals = np.linspace(0.0, 1, 3)
+        all_eps = np.linspace(0, 1, 10)
+
+        def combine(combos):
+            return np.sum(
+                combos[np.newaxis, :, :] * all_probs[:, np.newaxis, :],
+                axis=2
+            )
+
+        best_eps, best_weights, best_scores = search_weights(
+            self.labels, combine, weight_vals, 3, "f1", all_eps,
+            batch_size=7
+        )
+
+        ref_score = -1
+        for combo in itertools.product(weight_vals, repeat=3):
+            weighted = np.sum(np.array(combo) * all_probs, axis=1)
+            eps, scores = reference_threshold(
+                self.labels, weighted, "f1", all_eps
+            )
+            if scores["f1"] > ref_score:
+                ref_score = scores["f1"]
+                ref_eps = eps
+                ref_weights = np.array(combo)
+
+        self.assertEqual(best_eps, ref_eps)
+        self.assertTrue(np.array_equal(best_weights, ref_weights))
+        self.assertAlmostEqual(best_scores["f1"], ref_score, places=6)
+
+        _, coord_weights, coord_scores = search_weights(
+            self.labels, combine, weight_vals, 3, "f1", all_eps,
+            weight_search="coordinate"
+        )
+        self.assertEqual(coord_weights.shape, (3,))
+        self.assertTrue(coord_scores["f1"] <= ref_score)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,89 @@
+import unittest
+import numpy as np
+
+from src.conversion.two_step_conversion import ProbabilityStore, \
+    TwoStepConversion
+
+
+class FakeEstimator(object):
+    def __init__(self, checkpoint, offset):
+        self.checkpoint = checkpoint
+        self.offset = offset
+        self.predicted = []
+
+    def latest_checkpoint(self):
+        return self.checkpoint
+
+    def predict(self, input_fn, keys):
+        for fid, vagan_steps in input_fn:
+            self.predicted.append((fid, vagan_steps))
+            p = self.offset + int(fid[1:]) / 100.0 + vagan_steps / 1000.0
+            yield {"probs": [1 - p, p]}
+
+
+class FakeStreamer(object):
+    def get_input_fn_for_groups(self, groups, vagan_steps=0):
+        return [(g.file_ids[0], vagan_steps) for g in groups]
+
+
+class FakeStreamerHolder(object):
+    def __init__(self):
+        self.streamer = FakeStreamer()
+
+
+class TestProbabilityStore(unittest.TestCase):
+    def setUp(self):
+        conv = TwoStepConversion.__new__(TwoStepConversion)
+        conv.prob_store = ProbabilityStore()
+        conv.clf_only_est = FakeEstimator("clf/model.ckpt-10", 0.)
+        conv.clf_vagan_est = FakeEstimator("clf/model.ckpt-10", 0.)
+        conv.clf_only_obj = conv.clf_vagan_obj = FakeStreamerHolder()
+        conv.vagan_rescale = False
+        self.conv = conv
+
+    def test_shared_across_strategies_and_splits(self):
+        conv = self.conv
+        split_1 = ["I1", "I2", "I3"]
+        split_2 = ["I3", "I4", "I1"]
+        # every threshold strategy asks for the same probabilities
+        for strategy in range(3):
+            probs = conv.get_clf_probs(split_1)
+            self.assertTrue(np.allclose(probs, [0.01, 0.02, 0.03]))
+        probs = conv.get_clf_probs(split_2)
+        self.assertTrue(np.allclose(probs, [0.03, 0.04, 0.01]))
+
+        self.assertEqual(
+            sorted(conv.clf_only_est.predicted),
+            [("I1", 0), ("I2", 0), ("I3", 0), ("I4", 0)]
+        )
+
+        # vagan probabilities are stored per number of steps
+        for strategy in range(2):
+            conv.get_vagan_probs(split_1, 1)
+            conv.get_vagan_probs(split_2, 2)
+        self.assertTrue(np.allclose(
+            conv.get_vagan_probs(["I3"], 2), [0.032]
+        ))
+        self.assertEqual(len(conv.clf_vagan_est.predicted), 3 + 3)
+
+    def test_key_separates_classifiers(self):
+        store = ProbabilityStore()
+        streamer = FakeStreamer()
+        est_1 = FakeEstimator("clf_1/model.ckpt-10", 0.)
+        est_2 = FakeEstimator("clf_2/model.ckpt-10", 0.5)
+        fids = ["I1", "I2"]
+
+        probs_1 = store.get_probs(est_1, streamer, fids, ("image",))
+        probs_2 = store.get_probs(est_2, streamer, fids, ("image",))
+        self.assertTrue(np.allclose(probs_1, [0.01, 0.02]))
+        self.assertTrue(np.allclose(probs_2, [0.51, 0.52]))
+        self.assertEqual(len(est_2.predicted), 2)
+
+        # a new checkpoint of the same classifier is predicted again
+        est_1.checkpoint = "clf_1/model.ckpt-20"
+        store.get_probs(est_1, streamer, fids, ("image",))
+        self.assertEqual(len(est_1.predicted), 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -34,6 +34,45 @@ class TestVMFSamplint(unittest.TestCase):
         references = np.asarray([[0, 1, 0]] * 4)
         rot = pt._rotation_matrices(vectors, references)
 
+    def test_rotation_matrices(self):
+        np.random.seed(4)
+        vectors = np.random.randn(6, 3)
+        vectors /= np.linalg.norm(vectors, axis=1)[:, np.newaxis]
+        references = np.random.randn(6, 3)
+        references /= np.linalg.norm(references, axis=1)[:, np.newaxis]
+        # antiparallel and equal vectors
+        references[0] = -vectors[0]
+        references[1] = vectors[1]
+        vectors[2] = [0, 0, 1]
+        references[2] = [0, 0, -1]
+
+        rot = pt._rotation_matrices(vectors, references)
+        self.assertTrue(np.allclose(
+            np.matmul(rot, vectors[:, :, np.newaxis])[:, :, 0], references
+        ))
+        self.assertTrue(np.allclose(
+            np.matmul(rot, np.transpose(rot, (0, 2, 1))), np.eye(3)
+        ))
+        self.assertTrue(np.allclose(np.linalg.det(rot), 1))
+
+        points = np.random.randn(6, 3)
+        self.assertTrue(np.allclose(
+            pt._rotate(vectors, references, points),
+            np.matmul(rot, points[:, :, np.newaxis])[:, :, 0]
+        ))
+
+    def test_sample_vMF_without_matrices(self):
+        mu = np.random.randn(100, 3)
+        mu /= np.linalg.norm(mu, axis=1)[:, np.newaxis]
+        mu[0] = [0, 0, -1]
+        k = np.random.rand(100) * 10 + 1
+        np.random.seed(9)
+        samples = pt.sample_vMF(mu, k)
+        np.random.seed(9)
+        direct = pt.sample_vMF(mu, k, materialize_rotations=False)
+        self.assertTrue(np.allclose(samples, direct))
+        self.assertTrue(np.allclose(np.linalg.norm(samples, axis=1), 1))
+
 
 if __name__ == '__main__':
     unittest.main()